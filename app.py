@@ -1,43 +1,123 @@
 import dotenv
 from quart import Quart, request, jsonify, Response
+from quart.wrappers import Request
+from quart.wrappers.response import DataBody, IterableBody
 import httpx
 import json
 import uuid
 from datetime import datetime, timezone, timedelta
 from urllib.parse import urlencode
+from email.utils import parsedate_to_datetime
 import os
 import sys
 import gzip
+import zlib
 import brotli
 import re
 import asyncio
 import time
 import logging
+import logging.handlers
+import queue
+import atexit
 import base64
 import aiofiles
 import typing
+import collections
+import bisect
+import math
+import hashlib
+import contextlib
+import abc
+import contextvars
+import random
+import glob
+from json.encoder import encode_basestring_ascii
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
+try:
+    import fcntl # 跨进程文件锁，仅 POSIX 平台可用
+except ImportError:
+    fcntl = None
 
 app = Quart(__name__)
+app.config['RESPONSE_TIMEOUT'] = 3600  # 设置Quart的响应超时 (多进程模式下工作进程不会执行 __main__)
+
+# 尽早加载 .env，使下方各项可配置参数 (包括日志配置) 也能从 .env 读取
+dotenv.load_dotenv(".env")
+
 # --- Logging Configuration ---
+# 事件循环线程只把日志记录放入有界队列，格式化与写 stdout 由后台线程完成，stdout 管道变慢时不会阻塞任何流。
+# 队列已满时丢弃新日志并计数，而不是阻塞事件循环。LOG_FORMAT=json 时每行输出一个 JSON 对象。
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower() # text | json
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_EVERY = max(1, int(os.getenv("LOG_SAMPLE_EVERY", "100"))) # 高频重复警告每多少条记录一条
+LOG_STATS = {"dropped": 0, "sampled_out": 0}
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process,
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    不在调用方线程格式化: 记录原样入队，由 QueueListener 的线程调用 getMessage() 与格式化，
+    因此 %-风格参数的拼接也不占用事件循环。队列已满时丢弃并计数。
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_STATS["dropped"] += 1
+
 handler = logging.StreamHandler(sys.stdout)
-handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+LOG_QUEUE: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+LOG_LISTENER = logging.handlers.QueueListener(LOG_QUEUE, handler, respect_handler_level=False)
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop) # 退出时写完队列中剩余的日志
 app.logger.handlers.clear()
-app.logger.addHandler(handler)
-app.logger.setLevel(logging.INFO)
+app.logger.addHandler(DroppingQueueHandler(LOG_QUEUE))
+app.logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+app.logger.propagate = False
+
+LOG_SAMPLE_COUNTS: collections.Counter = collections.Counter()
+
+def log_sampled(key, level, message, *args):
+    """高频重复的日志 (例如逐行的解析警告) 只记录第一条和之后每 LOG_SAMPLE_EVERY 条中的一条。"""
+    count = LOG_SAMPLE_COUNTS[key] = LOG_SAMPLE_COUNTS[key] + 1
+    if count != 1 and count % LOG_SAMPLE_EVERY:
+        LOG_STATS["sampled_out"] += 1
+        return
+    if count > 1:
+        message, args = message + " (同类日志已出现 %d 次，按 1/%d 采样记录)", (*args, count, LOG_SAMPLE_EVERY)
+    app.logger.log(level, message, *args)
 
 # --- Vertical Studio AI 接口地址 ---
-LOGIN_URL = "https://app.verticalstudio.ai/login"
-LOGIN_PASSWORD_DATA_URL = "https://app.verticalstudio.ai/login-password.data"
-CHAT_API_URL = "https://app.verticalstudio.ai/api/chat"
-ARCHIVE_CHAT_URL = "https://app.verticalstudio.ai/api/chat/archive.data"
-STREAM_BASE_URL = "https://app.verticalstudio.ai/stream"
-STREAM_CORNERS_BASE_URL = "https://app.verticalstudio.ai/stream/corners"
-STREAM_DATA_URL = "https://app.verticalstudio.ai/stream.data"
+# VS_BASE_URL 可指向本地的模拟上游 (bench/mock_upstream.py)，用于离线压测。
+VS_BASE_URL = os.getenv("VS_BASE_URL", "https://app.verticalstudio.ai").rstrip("/")
+LOGIN_URL = f"{VS_BASE_URL}/login"
+LOGIN_PASSWORD_DATA_URL = f"{VS_BASE_URL}/login-password.data"
+CHAT_API_URL = f"{VS_BASE_URL}/api/chat"
+ARCHIVE_CHAT_URL = f"{VS_BASE_URL}/api/chat/archive.data"
+STREAM_BASE_URL = f"{VS_BASE_URL}/stream"
+STREAM_CORNERS_BASE_URL = f"{VS_BASE_URL}/stream/corners"
+STREAM_DATA_URL = f"{VS_BASE_URL}/stream.data"
 TEXT_CORNER_TYPE = "text"
-MAX_HISTORY_TOKENS = 100000
+MAX_HISTORY_TOKENS = int(os.getenv("MAX_HISTORY_TOKENS", "100000")) # 未在 MODEL_HISTORY_BUDGETS 中配置的模型使用此预算
 
 # --- 基础请求头 ---
 BASE_HEADERS = {
@@ -45,13 +125,46 @@ BASE_HEADERS = {
     "Accept-Encoding": "gzip, deflate, br",
     "Accept-Language": "zh-CN,zh;q=0.9",
     "Cache-Control": "no-cache",
-    "Origin": "https://app.verticalstudio.ai",
+    "Origin": VS_BASE_URL,
     "Sec-Fetch-Dest": "empty",
     "Sec-Fetch-Mode": "cors", "Sec-Fetch-Site": "same-origin",
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36"
 }
 # --- Timeout Configuration ---
-DEFAULT_REQUEST_TIMEOUT = httpx.Timeout(3600.0, connect=3600.0, read=3600.0, write=3600.0)
+# 普通上游请求 (会话创建、归档) 的各阶段超时；流式对话的读超时是两个数据块之间允许的最长空闲时间。
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "10")) # seconds
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "60")) # seconds
+UPSTREAM_WRITE_TIMEOUT = float(os.getenv("UPSTREAM_WRITE_TIMEOUT", "30")) # seconds
+UPSTREAM_POOL_TIMEOUT = 30.0 # seconds, 等待连接池空闲连接的最长时间
+UPSTREAM_STREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_STREAM_READ_TIMEOUT", "300")) # seconds
+DEFAULT_REQUEST_TIMEOUT = httpx.Timeout(connect=UPSTREAM_CONNECT_TIMEOUT, read=UPSTREAM_READ_TIMEOUT, write=UPSTREAM_WRITE_TIMEOUT, pool=UPSTREAM_POOL_TIMEOUT)
+STREAM_REQUEST_TIMEOUT = httpx.Timeout(connect=UPSTREAM_CONNECT_TIMEOUT, read=UPSTREAM_STREAM_READ_TIMEOUT, write=UPSTREAM_WRITE_TIMEOUT, pool=UPSTREAM_POOL_TIMEOUT)
+
+# --- 重试策略与熔断 (Retry Policy & Circuit Breaker) ---
+# 每个客户端请求在上游建立阶段 (创建会话、发起对话及其重试) 有一个截止时间，经 contextvar 传递到所有上游调用，
+# 单次请求的超时按剩余时间收紧；剩余时间不够等待下一次重试时直接放弃。
+# 重试使用带完全抖动 (full jitter) 的指数退避，上游给出 Retry-After 时以其为准；
+# 进程级重试预算把重试次数限制在请求数的一定比例内，上游大面积故障时不会把流量放大数倍。
+# 上游主机的失败率过高时熔断器打开，期间请求立即返回 503，冷却后放行探测请求，成功则恢复。
+UPSTREAM_REQUEST_DEADLINE = float(os.getenv("UPSTREAM_REQUEST_DEADLINE", "120")) # seconds
+ARCHIVE_REQUEST_DEADLINE = 30.0 # seconds, 单次归档 (含重试) 的截止时间
+RETRY_BACKOFF_BASE = float(os.getenv("RETRY_BACKOFF_BASE", "0.5")) # seconds, 第 n 次重试前最多等待 base * 2^n 秒
+RETRY_BACKOFF_MAX = float(os.getenv("RETRY_BACKOFF_MAX", "10")) # seconds
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2")) # 重试次数占请求数的比例上限
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", "1")) # 低流量时每秒保底的重试额度
+RETRY_BUDGET_BURST = 20 # 预算最多累积的重试次数
+CIRCUIT_BREAKER_FAILURE_RATIO = float(os.getenv("CIRCUIT_BREAKER_FAILURE_RATIO", "0.5")) # 0 表示不熔断
+CIRCUIT_BREAKER_MIN_REQUESTS = int(os.getenv("CIRCUIT_BREAKER_MIN_REQUESTS", "20")) # 窗口内至少有这么多请求才会判断失败率
+CIRCUIT_BREAKER_WINDOW = float(os.getenv("CIRCUIT_BREAKER_WINDOW", "30")) # seconds, 统计失败率的滑动窗口
+CIRCUIT_BREAKER_OPEN_SECONDS = float(os.getenv("CIRCUIT_BREAKER_OPEN_SECONDS", "15")) # seconds, 打开后多久放行探测请求
+CIRCUIT_BREAKER_HALF_OPEN_PROBES = 1 # 半开状态下同时放行的探测请求数
+
+# --- 上游连接池配置 ---
+# 所有上游请求(登录、会话创建、流式对话、归档)共用同一个长连接传输层，避免每次请求重新进行 TCP/TLS(及代理)握手。
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60")) # seconds
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() in ("1", "true", "yes")
 
 # --- 文本模型映射 ---
 MODEL_MAPPING = {
@@ -70,133 +183,746 @@ MODEL_MAPPING = {
     "grok-3": "grok-3",
 }
 
+# --- 历史记录 Token 预算 ---
+# 每个模型可用于 系统提示词 + 历史消息 的 token 数 (已为输出预留空间)，键为 MODEL_MAPPING 中对外暴露的模型名。
+# 可通过环境变量 MODEL_HISTORY_BUDGETS (JSON, 例如 {"gpt-4o": 60000}) 覆盖。
+MODEL_HISTORY_BUDGETS = {
+    "claude-3-7-sonnet-thinking": 160000,
+    "claude-4-sonnet-thinking": 160000,
+    "claude-4-opus-thinking": 160000,
+    "deepseek-r1": 56000,
+    "deepseek-v3": 56000,
+    "gemini-2.5-flash-preview": 800000,
+    "gemini-2.5-pro-preview": 800000,
+    "gpt-4.1": 800000,
+    "gpt-4.1-mini": 800000,
+    "gpt-4o": 100000,
+    "o3": 160000,
+    "o4-mini": 160000,
+    "grok-3": 100000,
+}
+MODEL_HISTORY_BUDGETS.update(json.loads(os.getenv("MODEL_HISTORY_BUDGETS", "{}")))
+TOKEN_ESTIMATOR = os.getenv("TOKEN_ESTIMATOR", "heuristic") # heuristic | tiktoken | 通过 register_token_estimator() 注册的名称
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "50000")) # 按内容哈希缓存的单条消息 token 数上限
+MESSAGE_TOKEN_OVERHEAD = 4 # 每条消息的角色前缀与分隔符
+
 # --- 全局状态变量 ---
-GLOBAL_COOKIES = httpx.Cookies()
-COOKIE_LAST_REFRESH = None
 COOKIE_REFRESH_INTERVAL = 12 * 60 * 60  # 12 hours
 MAX_RETRIES = 3
-RETRY_DELAY = 2  # seconds
-COOKIE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cookies.json")
-SESSIONS = {}
-CHAT_IDS = {}
+DATA_DIR = os.getenv("VS_DATA_DIR", os.path.dirname(os.path.abspath(__file__))) # Cookie 与待归档记录的存放目录
+COOKIE_FILE = os.path.join(DATA_DIR, "cookies.json")
 initialization_complete = asyncio.Event() # Signals that the server is ready to accept requests
 login_pending = asyncio.Event() # Signals if a background login/setup task is active. Set = idle/complete, Clear = active.
 login_pending.set() # Initialize as idle
-cookies_are_genuinely_valid = False # Tracks if cookies are verified and usable
-HTTP_CLIENT: typing.Optional[httpx.AsyncClient] = None # Global HTTP client
-PROXY_CONFIG: typing.Optional[dict] = None # Global proxy config
+UPSTREAM_TRANSPORT: typing.Optional[httpx.AsyncHTTPTransport] = None # Shared connection pool behind every upstream client
+PROXY_URL: typing.Optional[str] = None # Global proxy config
+
+# --- 多进程 (Multi-Worker) ---
+# WORKERS > 1 时由 Hypercorn 启动多个工作进程，共用同一个监听端口。Cookie 文件是各进程共享的认证状态:
+# 登录在按账号的跨进程文件锁内进行，拿到锁后先检查其他进程是否已经换过 Cookie，因此同一时刻只有一个进程登录；
+# Cookie 文件以原子替换的方式写入，各进程轮询其 mtime 并加载新 Cookie。
+# 持有 leader.lock 的进程为主进程，负责定时刷新 Cookie 与接管已退出进程遗留的待归档会话；主进程退出后由其他进程接任。
+WORKERS = max(1, int(os.getenv("WORKERS", "1")))
+if WORKERS > 1 and fcntl is None:
+    app.logger.warning("当前平台不支持 fcntl 文件锁，多进程模式不可用，将以单进程运行。")
+    WORKERS = 1
+MULTI_WORKER = WORKERS > 1
+EVENT_LOOP = os.getenv("EVENT_LOOP", "asyncio").lower() # asyncio | uvloop
+COOKIE_SYNC_INTERVAL = float(os.getenv("COOKIE_SYNC_INTERVAL", "2")) # seconds, 检查其他进程写入的 Cookie 的间隔
+CROSS_PROCESS_LOCK_POLL_INTERVAL = 0.05 # seconds
+WORKER_ID = uuid.uuid4().hex[:8] # 区分同一数据目录下各进程的私有文件
+LEADER_LOCK_FILE = os.path.join(DATA_DIR, "leader.lock")
+IS_LEADER = not MULTI_WORKER # 单进程时本进程就是主进程
+PROCESS_LOCK_FDS: dict = {} # 进程存活期间一直持有的文件锁: 路径 -> fd
+COOKIE_SYNC_TASK: typing.Optional[asyncio.Task] = None
+
+# --- 多账号池 (Account Pool) ---
+# 每个上游账号拥有独立的 Cookie、客户端、刷新计划、Cookie 文件、健康状态与并发上限。
+# 请求被路由到负载最低的健康账号；返回 401/403 或 429 的账号会自动移出轮转，重新登录成功或冷却结束后再放回。
+ACCOUNT_BALANCE_POLICY = os.getenv("ACCOUNT_BALANCE_POLICY", "least_inflight").lower() # least_inflight | ewma
+ACCOUNT_MAX_CONCURRENCY = int(os.getenv("ACCOUNT_MAX_CONCURRENCY", "0")) # 每个账号的默认并发上限，0 表示不限制
+ACCOUNT_RATE_LIMIT_COOLDOWN = float(os.getenv("ACCOUNT_RATE_LIMIT_COOLDOWN", "60")) # seconds, 收到 429 且无 Retry-After 时的冷却时间
+ACCOUNT_LOGIN_RETRY_INTERVAL = float(os.getenv("ACCOUNT_LOGIN_RETRY_INTERVAL", "300")) # seconds, 登录失败后再次尝试的间隔
+ACCOUNT_WAIT_TIMEOUT = 30 # seconds, 所有健康账号都达到并发上限时等待空位的最长时间
+ACCOUNT_HEALTH_CHECK_INTERVAL = 60 # seconds
+ACCOUNT_LATENCY_EWMA_ALPHA = 0.2
+ACCOUNTS: list = []
+ACCOUNTS_BY_EMAIL: dict = {}
+ACCOUNT_WAITERS: collections.deque = collections.deque() # 等待账号空位的 Future
+CREDENTIALS_CACHE: typing.Optional[list] = None # load_credentials() 的结果，只解析一次
+
+# --- 预热会话池 (Chat Session Pool) ---
+# 每次请求前创建会话需要三次串行的上游往返，因此在后台为每个账号预先创建一批可用的 Chat ID，
+# 请求到来时直接取用；池为空时才退回到按需创建。
+CHAT_POOL_TARGET_SIZE = int(os.getenv("CHAT_POOL_SIZE", "4")) # 每个账号的目标大小，0 表示禁用会话池
+CHAT_POOL_REFILL_CONCURRENCY = max(1, int(os.getenv("CHAT_POOL_REFILL_CONCURRENCY", "2")))
+CHAT_POOL_MAX_AGE = float(os.getenv("CHAT_POOL_MAX_AGE", "600")) # seconds
+CHAT_POOL_RETRY_DELAY = 5 # seconds, 补充失败或认证未就绪时的等待时间
+CHAT_POOL_REFILL_EVENT = asyncio.Event()
+CHAT_POOL_TASK: typing.Optional[asyncio.Task] = None
+CHAT_POOL_STATS = {"hits": 0, "misses": 0, "refills": 0, "refill_failures": 0, "expired": 0}
+
+# --- 异步归档队列 (Archive Queue) ---
+# 临时会话的归档(删除)不再阻塞客户端响应，而是交给后台 worker 处理。
+# ARCHIVE_PENDING 是待归档 ID 的权威记录，会定期持久化，重启后继续处理。
+ARCHIVE_QUEUE_MAX_SIZE = int(os.getenv("ARCHIVE_QUEUE_MAX_SIZE", "1000"))
+ARCHIVE_WORKERS = max(1, int(os.getenv("ARCHIVE_WORKERS", "3")))
+ARCHIVE_MAX_ATTEMPTS = int(os.getenv("ARCHIVE_MAX_ATTEMPTS", "5"))
+ARCHIVE_BACKOFF_BASE = 2 # seconds, 第 n 次失败后等待 base * 2^(n-1) 秒
+ARCHIVE_BACKOFF_MAX = 300 # seconds
+ARCHIVE_PERSIST_INTERVAL = 5 # seconds
+ARCHIVE_FLUSH_TIMEOUT = float(os.getenv("ARCHIVE_FLUSH_TIMEOUT", "30")) # seconds, 关闭时等待队列清空的最长时间
+# 多进程时每个进程各自持久化，避免互相覆盖；进程退出后由主进程接管
+ARCHIVE_PENDING_FILE = os.path.join(DATA_DIR, f"archive_pending.{WORKER_ID}.json" if MULTI_WORKER else "archive_pending.json")
+ARCHIVE_QUEUE: typing.Optional[asyncio.Queue] = None
+ARCHIVE_PENDING: dict = {} # chat_id -> {"account": email, "failures": 已失败次数}
+ARCHIVE_OVERFLOW: collections.deque = collections.deque() # 队列已满或未启动时暂存的 chat_id
+ARCHIVE_PENDING_DIRTY = False
+ARCHIVE_TASKS: list = []
+ARCHIVE_STATS = {"enqueued": 0, "archived": 0, "retried": 0, "abandoned": 0, "overflowed": 0}
+
+# --- SSE 输出合并 (Token Coalescing) ---
+# 开启后，上游已到达的多个同类 delta 会合并成一个 SSE 帧发送，减少 ASGI send 与系统调用次数。
+# 每种 delta (正文/思考) 的第一个 token 总是立即发送，因此首 token 延迟不变。
+# 可通过请求头 X-Stream-Coalesce: on/off 按请求覆盖默认值。
+SSE_COALESCE_ENABLED = os.getenv("SSE_COALESCE_ENABLED", "false").lower() in ("1", "true", "yes", "on")
+SSE_COALESCE_MAX_DELAY = float(os.getenv("SSE_COALESCE_MAX_DELAY_MS", "20")) / 1000 # seconds, 一个合并帧最多等待的时间
+SSE_COALESCE_MAX_CHARS = int(os.getenv("SSE_COALESCE_MAX_CHARS", "2048")) # 单个合并帧的最大字符数
+
+# --- SSE 心跳与流缓冲 ---
+# 所有流共用一个时间轮调度心跳，只有连续空闲满一个间隔的流才会收到心跳帧。
+# 非共享的生成使用有界缓冲区: 客户端读取过慢时暂停读取上游，而不是在内存中堆积事件。
+SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", "5")) # seconds
+SSE_HEARTBEAT_RESOLUTION = float(os.getenv("SSE_HEARTBEAT_RESOLUTION", "0.5")) # seconds, 时间轮每格的粒度
+STREAM_BUFFER_EVENTS = int(os.getenv("STREAM_BUFFER_EVENTS", "256")) # 每个流最多缓冲的上游事件数
+STREAM_STATS = {"heartbeats": 0, "backpressure_waits": 0, "upstream_decode_errors": 0}
+
+# --- Server-Timing ---
+# 每个对话响应附带 Server-Timing 头 (流式响应在结束帧之后追加一个 ": server-timing ..." 注释帧)，
+# 列出构建提示词、排队、创建会话、上游首 token 等阶段的耗时 (毫秒)，便于在客户端直接定位慢在哪里。
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+
+# --- 响应压缩 (Compression) ---
+# 按 Accept-Encoding 协商 br / gzip。JSON 等完整响应体超过 COMPRESSION_MIN_BYTES 时整体压缩，
+# 流式响应 (SSE、批处理结果下载) 使用流式压缩，每个发出的帧都做一次 sync flush，不会因压缩器缓冲而推迟 token。
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024")) # 小于此大小的完整响应体不压缩
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6")) # 1-9
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4")) # 0-11, 越高越慢
+COMPRESSION_ENCODINGS = ("br", "gzip") # 客户端对两者的权重相同时优先 br
+COMPRESSION_MIMETYPES = frozenset({"application/json", "application/jsonl", "text/event-stream", "text/plain"})
+COMPRESSION_STREAM_WINDOW_BITS = 15 # 流式压缩的窗口 (32KB)，限制每个长连接占用的压缩器内存
+COMPRESSION_OFFLOAD_BYTES = 256 * 1024 # 超过此大小的响应体在线程中压缩，不阻塞事件循环
+COMPRESSION_STATS = {"br": 0, "gzip": 0, "streams": 0, "skipped_small": 0, "bytes_in": 0, "bytes_out": 0}
+
+# --- 响应缓存 (Response Cache) ---
+# 对相同的 模型 + 提示词 + 采样参数 直接返回缓存的结果，跳过创建会话、上游生成与归档。
+# 默认只缓存 temperature 为 0 的请求；请求头 Cache-Control: no-cache / no-store 或 X-Proxy-Cache: bypass 可按请求跳过缓存。
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() in ("1", "true", "yes", "on")
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))) # 缓存内容的总字节预算
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600")) # seconds
+RESPONSE_CACHE_DETERMINISTIC_ONLY = os.getenv("RESPONSE_CACHE_DETERMINISTIC_ONLY", "true").lower() in ("1", "true", "yes", "on")
+RESPONSE_CACHE_SAMPLING_PARAMS = ("temperature", "top_p", "max_tokens", "stop", "presence_penalty", "frequency_penalty", "seed")
+
+# --- 进行中请求合并 (In-flight Coalescing) ---
+# 开启后，与正在生成的请求完全相同 (指纹同响应缓存) 的新请求不再单独请求上游，而是订阅同一次生成的输出。
+INFLIGHT_COALESCE_ENABLED = os.getenv("INFLIGHT_COALESCE_ENABLED", "false").lower() in ("1", "true", "yes", "on")
+INFLIGHT_GENERATIONS: dict = {} # fingerprint -> ChatGeneration
+INFLIGHT_STATS = {"leaders": 0, "followers": 0, "cancelled": 0}
+
+# --- 多选项与多模型并行 (Fan-out) ---
+# n>1 的请求，以及用扩展字段 "models": [...] 同时请求多个模型的请求，在各自独立的会话上并行生成，
+# 流式输出合并到同一个 SSE 响应中 (每个 chunk 带有对应选项的 index)，usage 为各分支之和。
+FANOUT_MAX_CHOICES = int(os.getenv("FANOUT_MAX_CHOICES", "8")) # 每个请求最多的选项数 (n × 模型数)
+FANOUT_STATS = {"requests": 0, "branches": 0, "branch_errors": 0}
+
+# --- 批处理 (Batch API) ---
+# OpenAI 风格的离线批处理: POST /v1/files 上传 JSONL (每行 {"custom_id", "method", "url", "body"})，POST /v1/batches 创建任务。
+# 任务在后台以有限并发执行，与在线请求共用准入控制、账号、会话池与连接池；结果逐行追加到输出文件，
+# 进度随输出文件保存在 VS_DATA_DIR/batches 中，重启后从断点继续。多进程模式下每个任务只由一个进程执行。
+BATCH_DIR = os.path.join(DATA_DIR, "batches")
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4")) # 本进程所有批处理任务同时执行的请求数
+BATCH_MAX_FILE_BYTES = int(os.getenv("BATCH_MAX_FILE_BYTES", str(512 * 1024 * 1024))) # 上传文件的大小上限
+BATCH_ITEM_MAX_ATTEMPTS = int(os.getenv("BATCH_ITEM_MAX_ATTEMPTS", "5")) # 单个请求遇到 429/503/504 时的最大尝试次数
+BATCH_PROGRESS_INTERVAL = 1.0 # seconds, 进度写盘的最小间隔
+BATCH_SCAN_INTERVAL = 5.0 # seconds, 检查无人执行的任务 (新启动或执行它的进程已退出)
+BATCH_READ_CHUNK_SIZE = 1024 * 1024
+BATCH_ACTIVE_STATUSES = ("validating", "in_progress", "cancelling")
+BATCH_TASKS: dict = {} # batch_id -> 本进程中执行该任务的 asyncio.Task
+BATCH_FINISHED: set = set() # 已结束的任务，扫描时跳过
+BATCH_SUPERVISOR_TASK: typing.Optional[asyncio.Task] = None
+BATCH_SEMAPHORE = asyncio.Semaphore(BATCH_CONCURRENCY)
+BATCH_STATS = {"requests_completed": 0, "requests_failed": 0, "requests_retried": 0, "batches_completed": 0, "batches_failed": 0, "batches_cancelled": 0}
+
+# --- 多轮对话会话复用 (Sticky Sessions) ---
+# 开启后，成功完成的对话不立即归档，而是保留其上游会话，键为 "模型 + 系统提示词 + 全部消息 (含本次回答)" 的哈希。
+# 下一轮请求的消息前缀 (直到最后一条 assistant 消息) 命中时，只把之后新增的用户消息发送到原会话，不再重放整个历史。
+# 请求头 X-Conversation-Id 可指定对话 ID，此时按 ID 查找并校验前缀，不一致时归档旧会话并完整重放。
+# 保留的会话按 LRU 与空闲时间淘汰 (在取出或放回会话时检查)，淘汰的会话进入后台归档队列。只在单个进程内生效。
+STICKY_SESSIONS_ENABLED = os.getenv("STICKY_SESSIONS_ENABLED", "false").lower() in ("1", "true", "yes", "on")
+STICKY_SESSION_MAX_ENTRIES = int(os.getenv("STICKY_SESSION_MAX_ENTRIES", "1000")) # 最多保留的会话数
+STICKY_SESSION_TTL = float(os.getenv("STICKY_SESSION_TTL", "900")) # seconds, 会话空闲多久后归档
+
+# --- 准入控制 (Admission Control) ---
+# 限制同时进行的上游生成数量 (全局与按模型)，超出的请求进入有界 FIFO 队列等待；
+# 队列已满或等待超时时立即返回 429 与 Retry-After，避免突发流量让所有请求一起变慢。
+# 缓存命中与合并到进行中生成的请求不占用名额。
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "0")) # 全局同时进行的生成数上限，0 表示不限制
+ADMISSION_MODEL_LIMITS = json.loads(os.getenv("ADMISSION_MODEL_LIMITS", "{}")) # 按模型 (MODEL_MAPPING 的键) 的上限, 例如 {"claude-4-opus-thinking": 2}
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "100")) # 等待队列长度上限
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "30")) # seconds, 在队列中等待的最长时间
+ADMISSION_EWMA_ALPHA = 0.2 # 平均占用时间与等待时间的平滑系数
+
+# --- 首 token 对冲 (TTFT Hedging) ---
+# 上游会话偶尔会卡住，连接已建立却长时间不产出任何内容。在截止时间内没有收到第一个 0:/g: 行时，
+# 在新的会话上发起对冲尝试，先产出第一个 token 的尝试胜出，其余尝试被取消并归档。
+# 此时还没有任何内容发给客户端，因此切换对客户端不可见。HEDGE_RACE_MODELS 中的模型从一开始就同时发起两个尝试。
+HEDGE_TTFT_DEADLINE = float(os.getenv("HEDGE_TTFT_DEADLINE", "0")) # seconds, 0 表示不对冲
+HEDGE_MAX_ATTEMPTS = max(1, int(os.getenv("HEDGE_MAX_ATTEMPTS", "2"))) # 每次生成最多同时存在的尝试数 (含第一个)
+HEDGE_RACE_MODELS = {model.strip() for model in os.getenv("HEDGE_RACE_MODELS", "").split(",") if model.strip()}
+HEDGE_STATS = {"hedged": 0, "raced": 0, "hedge_won": 0, "primary_won": 0, "losers_cancelled": 0, "attempts_failed": 0}
+
+# --- 模型路由与故障转移 (Model Routing) ---
+# MODEL_ROUTES 把对外的模型名映射为一组上游 modelId (路由组)，例如
+#   {"claude-4-sonnet-thinking": ["claude-4-sonnet-20250514", "claude-3-7-sonnet-20250219"],
+#    "fast": {"models": {"gpt-4.1-mini": 3, "o4-mini": 1}, "ttft_slo": 2}}
+# 列表按顺序优先，{modelId: 权重} 按权重随机选择，也可以直接写 MODEL_MAPPING 中的模型名；未配置的模型名仍按 MODEL_MAPPING 一对一映射。
+# 每个上游模型的首 token 时间与错误率以 EWMA 统计，错误率超过上限或首 token 时间超过 SLO 的模型排到组内最后，
+# 每隔 ROUTING_PROBE_INTERVAL 放行一个请求作为探测。尝试在首 token 之前失败，或在 SLO 内没有产出首 token 时，
+# 在组内的下一个模型上重新发起 (与对冲相同，此时还没有内容发给客户端)。
+MODEL_ROUTES = json.loads(os.getenv("MODEL_ROUTES", "{}"))
+ROUTING_TTFT_SLO = float(os.getenv("ROUTING_TTFT_SLO", "0")) # seconds, 路由组的默认首 token 时间 SLO，0 表示不按延迟切换
+ROUTING_MAX_ERROR_RATE = float(os.getenv("ROUTING_MAX_ERROR_RATE", "0.5")) # EWMA 错误率超过此值的模型被降级
+ROUTING_MIN_SAMPLES = int(os.getenv("ROUTING_MIN_SAMPLES", "5")) # 样本数达到此值后才根据统计降级
+ROUTING_PROBE_INTERVAL = float(os.getenv("ROUTING_PROBE_INTERVAL", "30")) # seconds, 降级的模型每隔多久放行一个探测请求
+ROUTING_EWMA_ALPHA = 0.2 # 首 token 时间与错误率的平滑系数
+ROUTING_STATS = {"failover_error": 0, "failover_slo": 0, "degraded_skipped": 0, "probes": 0, "unknown_model": 0}
+
+# --- 指标 (Prometheus Metrics) ---
+# /metrics 以 Prometheus 文本格式输出各阶段耗时直方图、重试计数与运行状态。
+# 服务运行在单个事件循环中，记录只是对列表元素加一，无需加锁；逐 token 的路径上不做任何记录。
+# 队列长度、Cookie 年龄等状态量在抓取时才计算。
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_GENERATION_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+def _format_metric_labels(labelnames, labels):
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, labels):
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+class MetricCounter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name, self.documentation, self.labelnames = name, documentation, labelnames
+        self.values: dict = {} # labels tuple -> count
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_metric_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class MetricGauge:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name, self.documentation, self.labelnames = name, documentation, labelnames
+        self.values: dict = {} if labelnames else {(): 0} # labels tuple -> value
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_metric_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class MetricHistogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=METRICS_LATENCY_BUCKETS):
+        self.name, self.documentation, self.labelnames = name, documentation, labelnames
+        self.buckets = tuple(buckets)
+        self.series: dict = {} # labels tuple -> [每个桶的计数 (非累积, 最后一个为 +Inf), 总和, 次数]
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        bucket_labelnames = self.labelnames + ("le",)
+        for labels, (bucket_counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_metric_labels(bucket_labelnames, labels + (le,))} {cumulative}")
+            label_str = _format_metric_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {total}")
+            lines.append(f"{self.name}_count{label_str} {count}")
+        return lines
+
+METRIC_SESSION_STEP_SECONDS = MetricHistogram("vs_session_step_seconds", "Duration of each create_new_chat_session step.", ("step",))
+METRIC_SESSION_CREATE_SECONDS = MetricHistogram("vs_session_create_seconds", "Total duration of create_new_chat_session.", ("outcome",))
+METRIC_UPSTREAM_TTFB_SECONDS = MetricHistogram("vs_upstream_ttfb_seconds", "Time from sending the chat request to the first upstream body line.", ("model",))
+METRIC_CLIENT_TTFT_SECONDS = MetricHistogram("vs_client_ttft_seconds", "Time from request arrival to the first token frame sent to a streaming client.", ("model",))
+METRIC_GENERATION_SECONDS = MetricHistogram("vs_generation_seconds", "Total duration of an upstream generation.", ("model", "outcome"), buckets=METRICS_GENERATION_BUCKETS)
+METRIC_ARCHIVE_SECONDS = MetricHistogram("vs_archive_seconds", "Duration of delete_chat_session.", ("outcome",))
+METRIC_LOGIN_SECONDS = MetricHistogram("vs_login_seconds", "Duration of an account login.", ("outcome",))
+METRIC_UPSTREAM_RETRIES = MetricCounter("vs_upstream_retries_total", "Upstream request retries by status code (network for transport errors).", ("status",))
+METRIC_ACTIVE_STREAMS = MetricGauge("vs_active_streams", "SSE responses currently being streamed to clients.")
+METRIC_UPSTREAM_MODEL_GENERATIONS = MetricCounter("vs_upstream_model_generations_total", "Generations by requested model, serving upstream modelId and outcome.", ("model", "upstream_model", "outcome"))
+
+def metric_model_label(model_requested):
+    """模型标签只使用已知的模型名，避免客户端传入任意字符串造成标签基数爆炸。"""
+    return model_requested if model_requested in MODEL_MAPPING or model_requested in MODEL_ROUTES else "other"
+
+class UpstreamAccount:
+    """一个上游账号及其独立的认证状态、连接客户端与负载统计。"""
+
+    def __init__(self, index, email, password, max_concurrency=0):
+        self.index = index
+        self.email = email
+        self.password = password
+        self.max_concurrency = max_concurrency
+        # 第一个账号沿用原来的 cookies.json，以兼容单账号部署
+        self.cookie_file = COOKIE_FILE if index == 0 else os.path.join(os.path.dirname(COOKIE_FILE), f"cookies_{index}.json")
+        self.cookies = httpx.Cookies()
+        self.last_refresh: typing.Optional[datetime] = None
+        self.client: typing.Optional[httpx.AsyncClient] = None
+        self.valid = False # Cookie 已验证可用
+        self.cooldown_until = 0.0 # time.monotonic()，冷却期内不参与路由
+        self.inflight = 0
+        self.latency_ewma: typing.Optional[float] = None # seconds
+        self.total_requests = 0
+        self.chat_pool: collections.deque = collections.deque() # 预热会话，元素为 (chat_id, created_at_monotonic)
+        self.refresh_task: typing.Optional[asyncio.Task] = None
+        self.cookie_file_mtime: typing.Optional[int] = None # 本进程最后一次读写时 Cookie 文件的 mtime (ns)
+        # 单飞登录: 同一时刻每个账号最多只有一个登录任务，所有遇到认证失败的请求共同等待它的结果。
+        # auth_generation 在每次替换 Cookie 时递增，请求据此判断自己的 401 是否来自已被替换的旧 Cookie。
+        self.login_task: typing.Optional[asyncio.Task] = None
+        self.auth_generation = 0
+
+    @property
+    def label(self):
+        name, _, domain = self.email.partition("@")
+        return f"#{self.index}({name[:2]}***@{domain})"
+
+    def is_available(self):
+        return self.valid and time.monotonic() >= self.cooldown_until
+
+    def has_capacity(self):
+        return self.max_concurrency <= 0 or self.inflight < self.max_concurrency
+
+    def load_score(self):
+        if ACCOUNT_BALANCE_POLICY == "ewma":
+            return ((self.latency_ewma or 0.0) * (self.inflight + 1), self.total_requests)
+        return (self.inflight, self.latency_ewma or 0.0, self.total_requests)
+
+    def record_latency(self, seconds):
+        if self.latency_ewma is None:
+            self.latency_ewma = seconds
+        else:
+            self.latency_ewma += ACCOUNT_LATENCY_EWMA_ALPHA * (seconds - self.latency_ewma)
+
+    def set_cookies(self, cookies):
+        self.cookies = cookies
+        self.auth_generation += 1
+        if self.client:
+            # A single reference swap: requests already in flight keep the old jar, new ones see the new jar.
+            self.client.cookies = cookies
+
+    def cool_down(self, seconds, reason):
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+        app.logger.warning(f"账号 {self.label} 暂时移出轮转 {seconds:.0f} 秒: {reason}")
+
+    def snapshot(self):
+        return {
+            "account": self.label,
+            "valid": self.valid,
+            "available": self.is_available(),
+            "inflight": self.inflight,
+            "max_concurrency": self.max_concurrency,
+            "cooldown_remaining": max(0.0, round(self.cooldown_until - time.monotonic(), 1)),
+            "latency_ewma_ms": round(self.latency_ewma * 1000, 1) if self.latency_ewma is not None else None,
+            "total_requests": self.total_requests,
+            "pooled_chats": len(self.chat_pool),
+            "last_refresh": self.last_refresh.isoformat() if self.last_refresh else None,
+        }
 
 def load_credentials():
+    """
+    返回账号列表 [(email, password, max_concurrency), ...]。
+    VS_EMAIL/VS_PASSWORD 作为第一个账号；VS_ACCOUNTS 可追加更多账号，格式为
+    "email1:password1,email2:password2" 或 JSON 数组 [{"email": ..., "password": ..., "max_concurrency": ...}]。
+    结果会被缓存，之后的调用不会再次读取 .env。
+    """
+    global CREDENTIALS_CACHE
+    if CREDENTIALS_CACHE is not None:
+        return CREDENTIALS_CACHE
     dotenv.load_dotenv(".env")
+    credentials = []
     email = os.getenv("VS_EMAIL")
     password = os.getenv("VS_PASSWORD")
-    if not email or not password:
-        app.logger.error("环境变量 VS_EMAIL 或 VS_PASSWORD 未设置!")
-        return None, None
-    app.logger.info("成功从环境变量加载凭据。")
-    return email, password
+    if email and password:
+        credentials.append((email, password, ACCOUNT_MAX_CONCURRENCY))
+
+    raw_accounts = os.getenv("VS_ACCOUNTS", "").strip()
+    if raw_accounts:
+        try:
+            if raw_accounts.startswith("["):
+                for entry in json.loads(raw_accounts):
+                    credentials.append((entry["email"], entry["password"], int(entry.get("max_concurrency", ACCOUNT_MAX_CONCURRENCY))))
+            else:
+                for entry in re.split(r"[,\n]", raw_accounts):
+                    entry = entry.strip()
+                    if not entry:
+                        continue
+                    entry_email, sep, entry_password = entry.partition(":")
+                    if not sep or not entry_email or not entry_password:
+                        app.logger.error(f"VS_ACCOUNTS 中的条目格式无效，已跳过 (应为 email:password)。")
+                        continue
+                    credentials.append((entry_email, entry_password, ACCOUNT_MAX_CONCURRENCY))
+        except (ValueError, KeyError, TypeError) as e:
+            app.logger.error(f"解析 VS_ACCOUNTS 失败: {e}")
+
+    unique_credentials, seen_emails = [], set()
+    for entry in credentials:
+        if entry[0] not in seen_emails:
+            seen_emails.add(entry[0])
+            unique_credentials.append(entry)
+
+    if not unique_credentials:
+        app.logger.error("环境变量 VS_EMAIL/VS_PASSWORD 或 VS_ACCOUNTS 未设置!")
+        return []
+    app.logger.info(f"成功从环境变量加载 {len(unique_credentials)} 个账号的凭据。")
+    CREDENTIALS_CACHE = unique_credentials
+    return unique_credentials
 
 def load_proxy_config():
-    global PROXY_CONFIG
+    global PROXY_URL
     proxy_url = os.getenv("PROXY")
     if proxy_url:
-        PROXY_CONFIG = {
-            "http://": proxy_url,
-            "https://": proxy_url,
-        }
+        PROXY_URL = proxy_url
         app.logger.info(f"通用代理已配置，将用于所有请求: {proxy_url}")
     else:
         app.logger.info("未找到 PROXY 环境变量，跳过代理设置。")
 
-async def load_cookies_from_file():
-    global COOKIE_LAST_REFRESH, GLOBAL_COOKIES
-    if os.path.exists(COOKIE_FILE):
+def create_upstream_transport():
+    http2 = HTTP2_ENABLED
+    if http2:
         try:
-            async with aiofiles.open(COOKIE_FILE, 'r') as f:
-                content = await f.read()
-                data = json.loads(content)
-                cookies_dict = data.get("cookies")
-                last_refresh_str = data.get("last_refresh")
-                if cookies_dict and last_refresh_str:
-                    GLOBAL_COOKIES = httpx.Cookies(cookies_dict)
-                    COOKIE_LAST_REFRESH = datetime.fromisoformat(last_refresh_str)
-                    app.logger.info("成功从文件加载Cookie。")
-                    return True
-        except Exception as e:
-            app.logger.error(f"加载Cookie文件失败: {e}")
-    return False
+            import h2  # noqa: F401 -- httpx needs it for HTTP/2
+        except ImportError:
+            app.logger.warning("HTTP2_ENABLED 已开启，但未安装 h2 包，将回退到 HTTP/1.1。")
+            http2 = False
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    app.logger.info(f"上游连接池: 最大连接 {HTTP_MAX_CONNECTIONS}, 保活连接 {HTTP_MAX_KEEPALIVE_CONNECTIONS}, 保活时间 {HTTP_KEEPALIVE_EXPIRY}s, HTTP/2: {http2}")
+    return httpx.AsyncHTTPTransport(limits=limits, http2=http2, proxy=PROXY_URL)
+
+def new_upstream_client(cookies=None, timeout=DEFAULT_REQUEST_TIMEOUT):
+    """
+    创建一个挂载在共享连接池上的客户端，仅持有自己的 Cookie 与默认参数。
+    注意: 不要对返回的客户端调用 aclose()，那会关闭所有客户端共用的传输层；传输层由 shutdown() 统一关闭。
+    """
+    if UPSTREAM_TRANSPORT is None:
+        raise RuntimeError("上游连接池尚未初始化")
+    return httpx.AsyncClient(transport=UPSTREAM_TRANSPORT, headers=BASE_HEADERS, cookies=cookies, timeout=timeout, follow_redirects=True)
+
+def setup_accounts(credentials):
+    ACCOUNTS.clear()
+    ACCOUNTS_BY_EMAIL.clear()
+    for index, (email, password, max_concurrency) in enumerate(credentials):
+        account = UpstreamAccount(index, email, password, max_concurrency)
+        account.client = new_upstream_client(account.cookies)
+        ACCOUNTS.append(account)
+        ACCOUNTS_BY_EMAIL[email] = account
+
+def has_available_account():
+    return any(account.is_available() for account in ACCOUNTS)
+
+def pending_logins():
+    return [account.login_task for account in ACCOUNTS if account.login_task is not None]
+
+def select_account():
+    candidates = [account for account in ACCOUNTS if account.is_available() and account.has_capacity()]
+    if not candidates:
+        return None
+    return min(candidates, key=UpstreamAccount.load_score)
+
+def seconds_until_cooldown_ends():
+    """最早结束冷却的有效账号还需冷却的秒数；没有处于冷却中的有效账号时返回 None。"""
+    now = time.monotonic()
+    remaining = [account.cooldown_until - now for account in ACCOUNTS if account.valid and account.cooldown_until > now]
+    return min(remaining) if remaining else None
+
+async def acquire_account():
+    """
+    选择负载最低的健康账号并占用一个并发名额；所有健康账号都已满载时排队等待空位，
+    没有健康账号但有账号正在重新登录时等待登录完成。冷却中的账号在等待期限内恢复时，
+    等待者在冷却结束时被唤醒 (冷却结束不会经过 release_account())。
+    """
+    deadline = time.monotonic() + ACCOUNT_WAIT_TIMEOUT
+    while True:
+        account = select_account()
+        if account:
+            account.inflight += 1
+            account.total_requests += 1
+            return account
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        cooldown_wait = seconds_until_cooldown_ends()
+        wait_timeout = min(remaining, cooldown_wait) if cooldown_wait is not None else remaining
+        if not has_available_account():
+            logins = pending_logins()
+            if logins:
+                await asyncio.wait(logins, timeout=wait_timeout, return_when=asyncio.FIRST_COMPLETED)
+            elif cooldown_wait is not None and cooldown_wait < remaining:
+                await asyncio.sleep(cooldown_wait)
+            else:
+                return None # 期限内没有账号能恢复
+            continue
+        waiter = asyncio.get_running_loop().create_future()
+        ACCOUNT_WAITERS.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout=wait_timeout)
+        except asyncio.TimeoutError:
+            pass # 冷却结束或到达期限，重新检查
 
-async def save_cookies_to_file():
-    global GLOBAL_COOKIES, COOKIE_LAST_REFRESH
-    if GLOBAL_COOKIES and COOKIE_LAST_REFRESH:
+def try_acquire_account(account):
+    """不等待地占用指定账号的一个并发名额 (在该账号已有的会话上继续对话时使用)，账号不可用或已满载时返回 False。"""
+    if not (account.is_available() and account.has_capacity()):
+        return False
+    account.inflight += 1
+    account.total_requests += 1
+    return True
+
+def release_account(account):
+    account.inflight -= 1
+    while ACCOUNT_WAITERS:
+        waiter = ACCOUNT_WAITERS.popleft()
+        if not waiter.done():
+            waiter.set_result(None)
+            break
+
+def note_account_response_status(account, response):
+    """根据上游响应状态更新账号健康状态: 429 进入冷却。"""
+    if response.status_code == 429:
+        retry_after = parse_retry_after(response.headers)
+        cooldown = retry_after if retry_after is not None else ACCOUNT_RATE_LIMIT_COOLDOWN
+        account.cool_down(cooldown, "上游返回 429 (请求过于频繁)")
+
+def try_lock_file(path):
+    """以非阻塞方式对 path 加排他 flock，成功时返回持有锁的 fd，锁已被其他进程持有时返回 None。"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd
+    except BlockingIOError:
+        os.close(fd)
+        return None
+
+@contextlib.asynccontextmanager
+async def cross_process_lock(path):
+    """
+    跨进程互斥锁 (flock)。以轮询方式等待，等待中的任务可以被安全取消；不支持 flock 的平台上直接放行。
+    关闭 fd 即释放锁，持有锁的进程崩溃时锁也会随之释放。
+    """
+    if fcntl is None:
+        yield
+        return
+    while (fd := try_lock_file(path)) is None:
+        await asyncio.sleep(CROSS_PROCESS_LOCK_POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        os.close(fd)
+
+async def read_cookie_file(account):
+    """读取账号的 Cookie 文件，返回 (cookies, last_refresh)；文件不存在、损坏或属于其他账号时返回 None。"""
+    if not os.path.exists(account.cookie_file):
+        return None
+    try:
+        async with aiofiles.open(account.cookie_file, 'r') as f:
+            data = json.loads(await f.read())
+        if data.get("email", account.email) != account.email:
+            app.logger.info(f"Cookie文件 {account.cookie_file} 属于其他账号，已忽略。")
+            return None
+        cookies_dict = data.get("cookies")
+        last_refresh_str = data.get("last_refresh")
+        if cookies_dict and last_refresh_str:
+            return httpx.Cookies(cookies_dict), datetime.fromisoformat(last_refresh_str)
+    except Exception as e:
+        app.logger.error(f"加载Cookie文件失败: {e}")
+    return None
+
+async def load_cookies_from_file(account):
+    stored = await read_cookie_file(account)
+    if stored is None:
+        return False
+    account.set_cookies(stored[0])
+    account.last_refresh = stored[1]
+    app.logger.info(f"成功从文件加载账号 {account.label} 的Cookie。")
+    return True
+
+async def adopt_newer_cookies_from_file(account):
+    """Cookie 文件中的 Cookie 比本进程持有的更新 (由其他进程登录写入) 时直接采用，返回是否采用。"""
+    stored = await read_cookie_file(account)
+    if stored is None or (account.last_refresh and stored[1] <= account.last_refresh):
+        return False
+    account.set_cookies(stored[0])
+    account.last_refresh = stored[1]
+    account.valid = True
+    return True
+
+async def save_cookies_to_file(account):
+    if account.cookies and account.last_refresh:
         try:
-            async with aiofiles.open(COOKIE_FILE, 'w') as f:
+            # 先写临时文件再原子替换，其他进程不会读到写了一半的文件
+            tmp_file = f"{account.cookie_file}.{WORKER_ID}.tmp"
+            async with aiofiles.open(tmp_file, 'w') as f:
                 await f.write(json.dumps({
-                    "cookies": dict(GLOBAL_COOKIES),
-                    "last_refresh": COOKIE_LAST_REFRESH.isoformat()
+                    "email": account.email,
+                    "cookies": dict(account.cookies),
+                    "last_refresh": account.last_refresh.isoformat()
                 }))
-            app.logger.info(f"Cookie已成功保存到 {COOKIE_FILE}")
+            os.replace(tmp_file, account.cookie_file)
+            account.cookie_file_mtime = os.stat(account.cookie_file).st_mtime_ns
+            app.logger.info(f"Cookie已成功保存到 {account.cookie_file}")
         except IOError as e:
             app.logger.error(f"保存Cookie到文件失败: {e}")
 
-async def login_and_get_cookies(email, password):
-    global COOKIE_LAST_REFRESH, GLOBAL_COOKIES, HTTP_CLIENT
-    app.logger.info("正在尝试登录...")
+async def login_and_get_cookies(account):
+    """
+    在该账号的跨进程登录锁内登录。等锁期间其他进程可能已经登录并写入了新 Cookie，
+    此时直接采用，不再重复登录，因此无论有多少个工作进程，同一份 Cookie 只会被换一次。
+    """
+    seen_refresh = account.last_refresh
+    async with cross_process_lock(f"{account.cookie_file}.lock"):
+        if account.last_refresh != seen_refresh or await adopt_newer_cookies_from_file(account):
+            account.valid = True
+            app.logger.info(f"账号 {account.label} 的Cookie已由其他进程更新，直接使用，无需重新登录。")
+            return True
+        return await login_with_password(account)
+
+async def login_with_password(account):
+    app.logger.info(f"账号 {account.label} 正在尝试登录...")
+    login_started = time.monotonic()
+    logged_in = False
     try:
-        # Use a temporary client for the login process to avoid altering global client's state prematurely
-        async with httpx.AsyncClient(headers=BASE_HEADERS, timeout=30, follow_redirects=True, proxies=PROXY_CONFIG) as login_client:
-            await login_client.get(LOGIN_URL)
-            email_encoded = urlencode({"email": email})
-            login_password_url = f"{LOGIN_PASSWORD_DATA_URL}?{email_encoded}"
-            await login_client.get(login_password_url)
-            
-            form_data = {"email": email, "password": password}
-            response = await login_client.post(login_password_url, data=form_data, headers={"Content-Type": "application/x-www-form-urlencoded;charset=UTF-8"})
-            
-            if response.status_code in [200, 202, 302] and any('auth-token' in name for name in login_client.cookies):
-                GLOBAL_COOKIES = login_client.cookies
-                COOKIE_LAST_REFRESH = datetime.now(timezone.utc)
-                if HTTP_CLIENT:
-                    HTTP_CLIENT.cookies = GLOBAL_COOKIES # Update global client's cookies
-                app.logger.info(f"登录成功，已更新Cookies (全局和HTTP_CLIENT)!")
-                await save_cookies_to_file()
-                return True
-            else:
-                app.logger.error(f"登录失败: 状态码 {response.status_code}, 响应: {response.text[:200]}... Cookies: {login_client.cookies}")
-                return False
+        # Use a separate cookie jar for the login process to avoid altering the account client's state prematurely.
+        # The client shares the pooled transport, so it must not be closed here.
+        login_client = new_upstream_client(timeout=30)
+        await login_client.get(LOGIN_URL)
+        email_encoded = urlencode({"email": account.email})
+        login_password_url = f"{LOGIN_PASSWORD_DATA_URL}?{email_encoded}"
+        await login_client.get(login_password_url)
+
+        form_data = {"email": account.email, "password": account.password}
+        response = await login_client.post(login_password_url, data=form_data, headers={"Content-Type": "application/x-www-form-urlencoded;charset=UTF-8"})
+
+        if response.status_code in [200, 202, 302] and any('auth-token' in name for name in login_client.cookies):
+            account.set_cookies(login_client.cookies)
+            account.last_refresh = datetime.now(timezone.utc)
+            account.valid = True
+            app.logger.info(f"账号 {account.label} 登录成功，已更新Cookies!")
+            logged_in = True
+            await save_cookies_to_file(account)
+            return True
+        else:
+            app.logger.error(f"账号 {account.label} 登录失败: 状态码 {response.status_code}, 响应: {response.text[:200]}...")
+            return False
     except httpx.RequestError as e:
-        app.logger.error(f"登录过程中发生网络错误: {e}")
+        app.logger.error(f"账号 {account.label} 登录过程中发生网络错误: {e}")
         return False
+    finally:
+        METRIC_LOGIN_SECONDS.observe(time.monotonic() - login_started, "ok" if logged_in else "failed")
 
-def check_cookie_refresh():
-    if not COOKIE_LAST_REFRESH:
+async def run_account_login(account, take_out_of_rotation):
+    if take_out_of_rotation:
+        account.valid = False
+    try:
+        if await login_and_get_cookies(account):
+            return True
+        if take_out_of_rotation:
+            account.cool_down(ACCOUNT_LOGIN_RETRY_INTERVAL, "重新登录失败")
+        return False
+    finally:
+        account.login_task = None
+
+async def single_flight_login(account, take_out_of_rotation=True):
+    """
+    启动或加入该账号正在进行的登录，返回登录是否成功。
+    take_out_of_rotation=False 用于定时刷新: 旧 Cookie 仍然有效，刷新期间账号继续参与路由。
+    """
+    if account.login_task is None:
+        account.login_task = asyncio.create_task(run_account_login(account, take_out_of_rotation))
+    elif take_out_of_rotation:
+        account.valid = False
+    # shield: 某个等待者被取消(例如客户端断开)时不能连带取消共享的登录任务
+    return await asyncio.shield(account.login_task)
+
+async def relogin_account(account, seen_generation):
+    """
+    处理认证失败。seen_generation 是发出失败请求时账号的 auth_generation:
+    如果 Cookie 已经被替换，直接用新 Cookie 重试，不再重复登录；否则加入单飞登录。
+    失败时账号进入冷却，由定时任务稍后重试。
+    """
+    if account.auth_generation != seen_generation:
+        return True
+    return await single_flight_login(account)
+
+def check_cookie_refresh(account):
+    if not account.last_refresh:
         return True
-    return (datetime.now(timezone.utc) - COOKIE_LAST_REFRESH).total_seconds() > COOKIE_REFRESH_INTERVAL
+    return (datetime.now(timezone.utc) - account.last_refresh).total_seconds() > COOKIE_REFRESH_INTERVAL
 
-async def schedule_cookie_refresh(email, password):
+def schedule_cookie_refresh(account):
     async def refresh_loop():
         while True:
-            await asyncio.sleep(60 * 60) # 1 hour
-            if check_cookie_refresh():
-                app.logger.info("Cookie需要刷新，尝试重新登录...")
-                if not await login_and_get_cookies(email, password):
-                    app.logger.error("Cookie自动刷新失败。")
+            await asyncio.sleep(ACCOUNT_HEALTH_CHECK_INTERVAL)
+            if not account.valid:
+                # 认证失效的账号在冷却结束后重新登录，成功后自动回到轮转
+                if time.monotonic() >= account.cooldown_until:
+                    app.logger.info(f"账号 {account.label} 冷却结束，尝试重新登录...")
+                    await single_flight_login(account)
+            elif check_cookie_refresh(account) and IS_LEADER: # 其他进程通过 Cookie 文件同步刷新结果
+                app.logger.info(f"账号 {account.label} 的Cookie需要刷新，尝试重新登录...")
+                if not await single_flight_login(account, take_out_of_rotation=False):
+                    app.logger.error(f"账号 {account.label} 的Cookie自动刷新失败。")
                 else:
-                    app.logger.info("Cookie自动刷新成功。")
-
-    asyncio.create_task(refresh_loop())
-    app.logger.info("已启动Cookie定时刷新任务。")
+                    app.logger.info(f"账号 {account.label} 的Cookie自动刷新成功。")
 
-async def create_new_chat_session(corner_type=TEXT_CORNER_TYPE): # Removed client argument
-    if not HTTP_CLIENT:
-        app.logger.error("创建新聊天会话失败：全局 HTTP_CLIENT 未初始化。")
-        raise Exception("内部服务器错误: HTTP客户端未就绪")
+    if account.refresh_task is None:
+        account.refresh_task = asyncio.create_task(refresh_loop())
+        app.logger.info(f"已启动账号 {account.label} 的Cookie定时刷新任务。")
 
-    app.logger.info(f"尝试为 '{corner_type}' 类型创建新的VS会话...")
+async def create_new_chat_session(account, corner_type=TEXT_CORNER_TYPE):
+    app.logger.info("尝试为 '%s' 类型创建新的VS会话 (账号 %s)...", corner_type, account.label)
+    session_started = time.monotonic()
+    new_chat_id = None
     try:
         # Step 1: Initial GET to stream base URL (seems like a pre-step, session warmer?)
         # Using make_request_with_retry to handle potential issues like client not ready or network errors
-        response_stream_base = await make_request_with_retry("GET", STREAM_BASE_URL)
+        step_started = time.monotonic()
+        response_stream_base = await make_request_with_retry(account, "GET", STREAM_BASE_URL)
+        METRIC_SESSION_STEP_SECONDS.observe(time.monotonic() - step_started, "stream_base")
         if not response_stream_base:
             app.logger.error(f"创建VS Chat ID的第一步GET {STREAM_BASE_URL} 失败。")
             return None
@@ -204,7 +930,9 @@ async def create_new_chat_session(corner_type=TEXT_CORNER_TYPE): # Removed clien
         # Step 2: POST dummy prompt
         dummy_prompt_val = str(uuid.uuid4())
         post_form_data = {"prompt": dummy_prompt_val, "intent": "execute-prompt"}
-        response_post_dummy = await make_request_with_retry("POST", f"{STREAM_DATA_URL}?searchType=studio", data=post_form_data, headers={"Content-Type": "application/x-www-form-urlencoded;charset=UTF-8"})
+        step_started = time.monotonic()
+        response_post_dummy = await make_request_with_retry(account, "POST", f"{STREAM_DATA_URL}?searchType=studio", data=post_form_data, headers={"Content-Type": "application/x-www-form-urlencoded;charset=UTF-8"})
+        METRIC_SESSION_STEP_SECONDS.observe(time.monotonic() - step_started, "post_prompt")
         if not response_post_dummy:
              app.logger.error(f"创建VS Chat ID的第二步POST {STREAM_DATA_URL} 失败。")
              return None
@@ -212,13 +940,12 @@ async def create_new_chat_session(corner_type=TEXT_CORNER_TYPE): # Removed clien
         # Step 3: GET specific corner data URL, expecting a redirect or chat ID in response
         specific_corner_data_url = f"{STREAM_CORNERS_BASE_URL}/{corner_type}.data?prompt={dummy_prompt_val}"
         
-        # This specific GET in original code used follow_redirects=False and parsed Location header.
-        # We need a client instance that has follow_redirects=False for this step.
-        # It's safer to create a temporary client for this specific request if global HTTP_CLIENT follows redirects.
-        async with httpx.AsyncClient(headers=BASE_HEADERS, cookies=GLOBAL_COOKIES, timeout=30, follow_redirects=False, proxies=PROXY_CONFIG) as temp_redirect_client:
-            response_get_corner = await temp_redirect_client.get(specific_corner_data_url)
+        # This step must not follow redirects: the chat ID is parsed from the Location header.
+        # Redirect handling is overridden per request, so the pooled connection is reused.
+        step_started = time.monotonic()
+        response_get_corner = await send_upstream_request(account, "GET", specific_corner_data_url, follow_redirects=False)
+        METRIC_SESSION_STEP_SECONDS.observe(time.monotonic() - step_started, "corner_redirect")
 
-        new_chat_id = None
         if response_get_corner.status_code in [202, 301, 302, 303, 307, 308] and 'Location' in response_get_corner.headers:
             location_url = response_get_corner.headers['Location']
             match = re.search(rf'/stream/corners/{corner_type}/([\w-]+)', location_url)
@@ -229,81 +956,300 @@ async def create_new_chat_session(corner_type=TEXT_CORNER_TYPE): # Removed clien
             if match: new_chat_id = match.group(1)
 
         if new_chat_id:
-            app.logger.info(f"成功提取到Chat ID: {new_chat_id}")
+            app.logger.info("成功提取到Chat ID: %s", new_chat_id)
             return new_chat_id
         else:
             # Log more info for debugging if chat_id extraction fails
             app.logger.error(f"未能提取Chat ID。URL: {specific_corner_data_url}, 状态: {response_get_corner.status_code}, 头: {response_get_corner.headers}, 响应体(部分): {response_get_corner.text[:200]}")
             return None
     except httpx.RequestError as e: # Catch network errors from any step
-        app.logger.error(f"创建VS Chat ID时发生网络错误: {e}。这通常表示DNS解析失败或网络连接问题。请检查您的网络设置和到 'app.verticalstudio.ai' 的连接。")
+        app.logger.error(f"创建VS Chat ID时发生网络错误: {e}。这通常表示DNS解析失败或网络连接问题。请检查您的网络设置和到 '{VS_BASE_URL}' 的连接。")
         raise e # Re-raise to be caught by the calling handler (e.g., handle_chat_request)
+    finally:
+        METRIC_SESSION_CREATE_SECONDS.observe(time.monotonic() - session_started, "ok" if new_chat_id else "failed")
+
+class UpstreamUnavailableError(Exception):
+    """熔断器打开或截止时间已到，不再向上游发起请求。status_code 与 retry_after 用于返回给客户端。"""
+
+    def __init__(self, message, status_code=503, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+UPSTREAM_DEADLINE: contextvars.ContextVar = contextvars.ContextVar("upstream_deadline", default=None) # time.monotonic() 截止时间
+
+def set_upstream_deadline(seconds):
+    """为当前上下文 (及之后创建的子任务) 设置上游请求的截止时间；已有更早的截止时间时保留更早的。返回可用于 reset 的 token。"""
+    deadline = time.monotonic() + seconds
+    current = UPSTREAM_DEADLINE.get()
+    return UPSTREAM_DEADLINE.set(deadline if current is None else min(current, deadline))
+
+def deadline_remaining():
+    deadline = UPSTREAM_DEADLINE.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def request_timeout(base=DEFAULT_REQUEST_TIMEOUT, clip_read=True):
+    """按截止时间的剩余时间收紧单次请求的超时；截止时间已过时抛出 UpstreamUnavailableError (504)。"""
+    remaining = deadline_remaining()
+    if remaining is None:
+        return base
+    if remaining <= 0:
+        raise UpstreamUnavailableError("上游请求已超过截止时间。", status_code=504)
+    def clip(value):
+        return remaining if value is None else min(value, remaining)
+    return httpx.Timeout(connect=clip(base.connect), read=clip(base.read) if clip_read else base.read, write=clip(base.write), pool=clip(base.pool))
+
+def parse_retry_after(headers):
+    """解析 Retry-After (秒数或 HTTP 日期)，返回秒数；没有或无法解析时返回 None。"""
+    value = headers.get("Retry-After", "").strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class RetryBudget:
+    """
+    进程级重试预算 (令牌桶): 每个新请求存入 ratio 个令牌，每次重试消耗一个，另按每秒 min_per_second 个补充保底额度。
+    上游大面积故障时重试总量被限制在请求数的 ratio 倍左右，而不是每个请求都重试满 MAX_RETRIES 次。
+    """
+
+    def __init__(self, ratio, min_per_second, burst):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.stats = {"requests": 0, "retries": 0, "exhausted": 0}
+
+    def _refill(self, amount=0.0):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.min_per_second + amount)
+        self.updated = now
+
+    def record_request(self):
+        self.stats["requests"] += 1
+        self._refill(self.ratio)
+
+    def try_spend(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.stats["retries"] += 1
+            return True
+        self.stats["exhausted"] += 1
+        return False
+
+class CircuitBreaker:
+    """
+    上游主机的熔断器。滑动窗口内的请求数达到 min_requests 且失败 (5xx、网络错误与超时) 比例达到 failure_ratio 时打开，
+    打开期间 before_request() 直接抛出 UpstreamUnavailableError；open_seconds 之后进入半开状态，
+    放行少量探测请求，探测成功则关闭，失败则重新打开。
+    before_request() 返回的凭据 (是否为探测, 状态代次) 须原样传给 record()：半开状态只看探测请求的结果，
+    熔断打开之前放行、之后才结束的慢请求不会影响新的状态。
+    """
+
+    def __init__(self, failure_ratio, min_requests, window, open_seconds, half_open_probes):
+        self.failure_ratio = failure_ratio
+        self.min_requests = max(1, min_requests)
+        self.window = window
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = "closed" # closed | open | half_open
+        self.opened_at = 0.0
+        self.epoch = 0 # 每次打开时加一，用于识别状态变化之前放行的请求
+        self.probes_inflight = 0
+        self.outcomes: collections.deque = collections.deque() # (time.monotonic(), failed)
+        self.failures = 0
+        self.stats = {"opened": 0, "rejected": 0, "probes": 0}
+
+    def retry_after(self):
+        return max(1, math.ceil(self.opened_at + self.open_seconds - time.monotonic()))
+
+    def is_open(self):
+        """熔断器处于打开状态且尚未到探测时间。"""
+        return self.state == "open" and time.monotonic() - self.opened_at < self.open_seconds
+
+    def before_request(self):
+        """放行时返回凭据 (是否为探测, 状态代次)，熔断器关闭功能时返回 None；拒绝时抛出 UpstreamUnavailableError。"""
+        if self.failure_ratio <= 0:
+            return None
+        if self.state == "open":
+            if self.is_open():
+                self.stats["rejected"] += 1
+                raise UpstreamUnavailableError("上游服务暂时不可用 (熔断中)，请稍后重试。", retry_after=self.retry_after())
+            self.state = "half_open"
+            app.logger.info("上游熔断器进入半开状态，放行探测请求。")
+        if self.state == "half_open":
+            if self.probes_inflight >= self.half_open_probes:
+                self.stats["rejected"] += 1
+                raise UpstreamUnavailableError("上游服务暂时不可用 (熔断探测中)，请稍后重试。", retry_after=1)
+            self.probes_inflight += 1
+            self.stats["probes"] += 1
+            return (True, self.epoch)
+        return (False, self.epoch)
+
+    def record(self, ticket, success):
+        """记录一次请求的结果；success 为 None 表示请求被取消，只释放探测名额。"""
+        if ticket is None:
+            return
+        probe, epoch = ticket
+        if epoch != self.epoch:
+            return # 放行之后熔断器已经打开过，结果属于旧的状态
+        if probe:
+            self.probes_inflight = max(0, self.probes_inflight - 1)
+            if success is None or self.state != "half_open":
+                return
+            if success:
+                self.state = "closed"
+                self.outcomes.clear()
+                self.failures = 0
+                app.logger.info("上游探测请求成功，熔断器已关闭。")
+            else:
+                self._open()
+            return
+        if success is None or self.state != "closed":
+            return # 半开状态只计入探测请求的结果
+        now = time.monotonic()
+        self.outcomes.append((now, not success))
+        self.failures += not success
+        while self.outcomes and now - self.outcomes[0][0] > self.window:
+            self.failures -= self.outcomes.popleft()[1]
+        if len(self.outcomes) >= self.min_requests and self.failures / len(self.outcomes) >= self.failure_ratio:
+            self._open()
+
+    def _open(self):
+        self.state = "open"
+        self.epoch += 1
+        self.probes_inflight = 0
+        self.opened_at = time.monotonic()
+        self.outcomes.clear()
+        self.failures = 0
+        self.stats["opened"] += 1
+        app.logger.error(f"上游失败率过高，熔断器打开 {self.open_seconds:.0f} 秒，期间请求将直接返回 503。")
+
+    def snapshot(self):
+        return {**self.stats, "state": self.state, "window_requests": len(self.outcomes), "window_failures": self.failures}
+
+RETRY_BUDGET = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND, RETRY_BUDGET_BURST)
+UPSTREAM_BREAKER = CircuitBreaker(CIRCUIT_BREAKER_FAILURE_RATIO, CIRCUIT_BREAKER_MIN_REQUESTS, CIRCUIT_BREAKER_WINDOW,
+                                  CIRCUIT_BREAKER_OPEN_SECONDS, CIRCUIT_BREAKER_HALF_OPEN_PROBES)
+
+def retry_backoff(attempt):
+    """第 attempt 次 (从 0 开始) 失败后的等待时间: 指数退避加完全抖动，避免大量请求在同一时刻重试。"""
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * (2 ** attempt)))
+
+async def wait_before_retry(attempt, reason, retry_after=None):
+    """
+    判断第 attempt 次失败后能否重试: 需要还有剩余次数、且重试预算未耗尽。可以重试时等待退避时间
+    (或上游给出的 Retry-After) 并返回 True；剩余时间不够等待时抛出 UpstreamUnavailableError，不再占用客户端的时间。
+    """
+    if attempt >= MAX_RETRIES - 1:
+        return False
+    delay = retry_after if retry_after is not None else retry_backoff(attempt)
+    remaining = deadline_remaining()
+    if remaining is not None and delay >= remaining:
+        app.logger.warning(f"剩余时间 {max(0.0, remaining):.1f} 秒不足以等待 {delay:.1f} 秒后重试，放弃重试。")
+        if retry_after is not None:
+            raise UpstreamUnavailableError("上游服务暂时不可用，请稍后重试。", retry_after=math.ceil(retry_after))
+        raise UpstreamUnavailableError("上游请求未能在截止时间内完成。", status_code=504)
+    if not RETRY_BUDGET.try_spend():
+        app.logger.warning("重试预算已耗尽，放弃重试。")
+        return False
+    METRIC_UPSTREAM_RETRIES.inc(reason)
+    await asyncio.sleep(delay)
+    return True
+
+async def send_upstream_request(account, method, url, **kwargs):
+    """经熔断器发起一次上游请求 (不重试)，超时按截止时间收紧，结果计入熔断器。"""
+    breaker_ticket = UPSTREAM_BREAKER.before_request()
+    success = None
+    try:
+        kwargs.setdefault("timeout", request_timeout())
+        response = await account.client.request(method, url, **kwargs)
+        success = response.status_code < 500
+        return response
+    except httpx.RequestError:
+        success = False
+        raise
+    finally:
+        UPSTREAM_BREAKER.record(breaker_ticket, success)
 
-async def make_request_with_retry(method, url, **kwargs): # Removed client argument
-    if not HTTP_CLIENT:
-        app.logger.error("全局 HTTP_CLIENT 未初始化! 无法执行请求。")
+async def make_request_with_retry(account, method, url, **kwargs):
+    if not account.client or UPSTREAM_TRANSPORT is None:
+        app.logger.error("上游连接池未初始化! 无法执行请求。")
         # This is a critical internal error.
         # Depending on context, might raise an exception or return a specific error indicator.
         return None
 
     # kwargs can include 'json', 'data', 'headers'.
-    # HTTP_CLIENT.cookies is assumed to be managed and up-to-date via login_and_get_cookies.
-    
+    # account.client.cookies is assumed to be managed and up-to-date via login_and_get_cookies.
+    # UpstreamUnavailableError (熔断或超过截止时间) 会直接抛给调用方。
+    RETRY_BUDGET.record_request()
     for attempt in range(MAX_RETRIES):
         try:
-            response = await HTTP_CLIENT.request(method, url, **kwargs)
+            request_started = time.monotonic()
+            auth_generation = account.auth_generation
+            response = await send_upstream_request(account, method, url, **kwargs)
 
             if response.status_code in [401, 403]: # Unauthorized or Forbidden
-                app.logger.warning(f"请求 {method} {url} 认证失败 (状态码 {response.status_code})。尝试重新登录...")
-                email_creds, password_creds = load_credentials() # Ensure var names don't clash if this is nested
-                if email_creds and password_creds:
-                    if await login_and_get_cookies(email_creds, password_creds): # This updates HTTP_CLIENT.cookies
-                        app.logger.info("重新登录成功。将重试之前的请求。")
-                        # Cookies in HTTP_CLIENT are now fresh. Continue to the next attempt to retry the request.
-                        if attempt < MAX_RETRIES - 1: # Only sleep and continue if there are retries left
-                             await asyncio.sleep(RETRY_DELAY) # Wait a bit before retrying
-                             continue # Retry the request in the next iteration of the loop
-                        else:
-                             app.logger.error(f"重新登录成功，但已达到对 {method} {url} 的最大重试次数。")
-                             return response # Return the 401/403 response after last attempt
+                if account.auth_generation != auth_generation and attempt < MAX_RETRIES - 1:
+                    # The jar that produced this 401 has already been replaced by another request's login.
+                    METRIC_UPSTREAM_RETRIES.inc(str(response.status_code))
+                    continue
+                app.logger.warning(f"请求 {method} {url} 认证失败 (账号 {account.label}, 状态码 {response.status_code})。尝试重新登录...")
+                if await relogin_account(account, auth_generation): # Joins the in-flight login, updates account.client.cookies
+                    app.logger.info("重新登录成功。将重试之前的请求。")
+                    # Cookies in account.client are now fresh, so the retry does not need a backoff or the retry budget.
+                    if attempt < MAX_RETRIES - 1:
+                         METRIC_UPSTREAM_RETRIES.inc(str(response.status_code))
+                         continue # Retry the request in the next iteration of the loop
                     else:
-                        app.logger.error(f"重新登录失败。无法重试请求 {method} {url}。")
-                        return response # Return the 401/403 response
+                         app.logger.error(f"重新登录成功，但已达到对 {method} {url} 的最大重试次数。")
+                         return response # Return the 401/403 response after last attempt
                 else:
-                    app.logger.error(f"无法加载凭据进行重新登录以重试 {method} {url}。")
+                    app.logger.error(f"重新登录失败。无法重试请求 {method} {url}。")
                     return response # Return the 401/403 response
-            
+
+            note_account_response_status(account, response)
             response.raise_for_status() # Raise an HTTPStatusError for other 4xx/5xx responses
+            account.record_latency(time.monotonic() - request_started)
             return response
         
         except httpx.HTTPStatusError as e: # Errors raised by response.raise_for_status() or non-401/403 status codes
             app.logger.warning(f"请求 {method} {url} 失败 (尝试 {attempt + 1}/{MAX_RETRIES}): 状态码 {e.response.status_code}, 响应(部分): {e.response.text[:200]}")
-            # Retry only for specific server-side errors or if configured
+            # Retry only for specific server-side errors
             if e.response.status_code in [500, 502, 503, 504]: # Common retryable server errors
-                if attempt < MAX_RETRIES - 1:
-                    await asyncio.sleep(RETRY_DELAY * (attempt + 1)) # Exponential backoff might be better
+                if await wait_before_retry(attempt, str(e.response.status_code), parse_retry_after(e.response.headers)):
                     continue
             return e.response # Return the error response if not retrying or after last retry
             
         except httpx.RequestError as e: # Network-level errors (ConnectTimeout, ReadTimeout, DNS error etc.)
             app.logger.error(f"请求 {method} {url} (尝试 {attempt + 1}/{MAX_RETRIES}) 发生网络错误: {type(e).__name__} - {e}")
-        
-        # Common delay for retries due to RequestError or if loop continues after HTTPStatusError retry
-        if attempt < MAX_RETRIES - 1:
-            await asyncio.sleep(RETRY_DELAY * (attempt + 1))
+            if await wait_before_retry(attempt, "network"):
+                continue
+            break
             
-    app.logger.error(f"对 {method} {url} 的所有 {MAX_RETRIES} 次重试均失败。")
+    app.logger.error(f"对 {method} {url} 的请求在重试后仍然失败。")
     return None # Indicate all retries failed
 
-async def delete_chat_session(chat_id_to_delete): # Removed client argument
-    if not HTTP_CLIENT:
-        app.logger.error("删除聊天会话失败：全局 HTTP_CLIENT 未初始化。")
-        return
+async def archive_with_deadline(account, chat_id):
+    token = set_upstream_deadline(ARCHIVE_REQUEST_DEADLINE)
+    try:
+        return await delete_chat_session(account, chat_id)
+    finally:
+        UPSTREAM_DEADLINE.reset(token)
+
+async def delete_chat_session(account, chat_id_to_delete):
     if not chat_id_to_delete:
         app.logger.debug("delete_chat_session called with no chat_id_to_delete.")
-        return
+        return True
 
-    app.logger.info(f"准备删除临时VS Chat会话: {chat_id_to_delete}")
+    app.logger.info("准备删除临时VS Chat会话: %s", chat_id_to_delete)
+    archive_started = time.monotonic()
     try:
         headers = {
             "Content-Type": "application/x-www-form-urlencoded;charset=UTF-8",
@@ -311,71 +1257,389 @@ async def delete_chat_session(chat_id_to_delete): # Removed client argument
         }
         payload = {"chat": chat_id_to_delete}
         # Use make_request_with_retry for deleting the session as well
-        response = await make_request_with_retry("POST", ARCHIVE_CHAT_URL, headers=headers, data=payload)
+        response = await make_request_with_retry(account, "POST", ARCHIVE_CHAT_URL, headers=headers, data=payload)
         
         if response and response.status_code == 200:
-            app.logger.info(f"临时VS Chat会话 {chat_id_to_delete} 删除成功!")
+            app.logger.info("临时VS Chat会话 %s 删除成功!", chat_id_to_delete)
+            METRIC_ARCHIVE_SECONDS.observe(time.monotonic() - archive_started, "ok")
+            return True
         elif response: # Response received, but not 200 OK
             app.logger.warning(f"删除临时VS Chat会话 {chat_id_to_delete} 失败，状态码: {response.status_code}, 响应(部分): {response.text[:200]}")
         else: # No response from make_request_with_retry, meaning all retries failed
              app.logger.warning(f"删除临时VS Chat会话 {chat_id_to_delete} 失败，所有重试均未成功或未收到响应。")
     except Exception as e: # Catch any other unexpected errors during the delete process
         app.logger.error(f"删除临时VS Chat会话 {chat_id_to_delete} 时发生意外错误: {type(e).__name__} - {e}", exc_info=True)
+    METRIC_ARCHIVE_SECONDS.observe(time.monotonic() - archive_started, "failed")
+    return False
+
+def archive_chat_later(account, chat_id):
+    """将会话放入后台归档队列，立即返回，不会给客户端响应增加任何延迟。"""
+    global ARCHIVE_PENDING_DIRTY
+    if not chat_id or chat_id in ARCHIVE_PENDING:
+        return
+    ARCHIVE_PENDING[chat_id] = {"account": account.email, "failures": 0}
+    ARCHIVE_PENDING_DIRTY = True
+    ARCHIVE_STATS["enqueued"] += 1
+    enqueue_archive(chat_id)
+
+def enqueue_archive(chat_id):
+    if ARCHIVE_QUEUE is None:
+        # 队列尚未启动(或已关闭)，保留在待处理记录中，稍后或下次启动时处理
+        ARCHIVE_OVERFLOW.append(chat_id)
+        return
+    try:
+        ARCHIVE_QUEUE.put_nowait(chat_id)
+    except asyncio.QueueFull:
+        ARCHIVE_STATS["overflowed"] += 1
+        ARCHIVE_OVERFLOW.append(chat_id)
+
+async def schedule_archive_retry(chat_id, delay):
+    await asyncio.sleep(delay)
+    enqueue_archive(chat_id)
+
+async def archive_worker(worker_id):
+    global ARCHIVE_PENDING_DIRTY
+    while True:
+        chat_id = await ARCHIVE_QUEUE.get()
+        try:
+            entry = ARCHIVE_PENDING.get(chat_id)
+            account = ACCOUNTS_BY_EMAIL.get(entry["account"]) if entry else None
+            if account is None:
+                # 会话所属的账号已不在配置中，无法再归档
+                if entry:
+                    app.logger.warning(f"会话 {chat_id} 所属的账号已不在配置中，放弃归档。")
+                    ARCHIVE_PENDING.pop(chat_id, None)
+                    ARCHIVE_STATS["abandoned"] += 1
+            elif UPSTREAM_BREAKER.is_open():
+                # 熔断期间不计入失败次数，熔断结束后再试
+                asyncio.create_task(schedule_archive_retry(chat_id, UPSTREAM_BREAKER.retry_after()))
+            elif await archive_with_deadline(account, chat_id):
+                ARCHIVE_PENDING.pop(chat_id, None)
+                ARCHIVE_STATS["archived"] += 1
+            else:
+                failures = entry["failures"] + 1
+                if failures >= ARCHIVE_MAX_ATTEMPTS:
+                    app.logger.error(f"归档会话 {chat_id} 已失败 {failures} 次，放弃归档。")
+                    ARCHIVE_PENDING.pop(chat_id, None)
+                    ARCHIVE_STATS["abandoned"] += 1
+                else:
+                    delay = min(ARCHIVE_BACKOFF_BASE * (2 ** (failures - 1)), ARCHIVE_BACKOFF_MAX)
+                    app.logger.warning(f"归档会话 {chat_id} 失败 (第 {failures} 次)，{delay} 秒后重试。")
+                    entry["failures"] = failures
+                    ARCHIVE_STATS["retried"] += 1
+                    asyncio.create_task(schedule_archive_retry(chat_id, delay))
+            ARCHIVE_PENDING_DIRTY = True
+        except Exception as e:
+            app.logger.error(f"归档 worker {worker_id} 处理 {chat_id} 时发生意外错误: {type(e).__name__} - {e}", exc_info=True)
+        finally:
+            ARCHIVE_QUEUE.task_done()
+
+def drain_archive_overflow():
+    while ARCHIVE_OVERFLOW and not ARCHIVE_QUEUE.full():
+        ARCHIVE_QUEUE.put_nowait(ARCHIVE_OVERFLOW.popleft())
+
+async def load_pending_archives(path=None):
+    """把 path (默认为本进程的文件) 中的待归档会话并入 ARCHIVE_PENDING，返回新增的数量；读取失败时返回 None。"""
+    path = path or ARCHIVE_PENDING_FILE
+    if not os.path.exists(path):
+        return 0
+    restored = 0
+    try:
+        async with aiofiles.open(path, 'r') as f:
+            data = json.loads(await f.read())
+        for chat_id, entry in data.get("pending", {}).items():
+            if isinstance(entry, int): # 单账号版本的旧格式: chat_id -> failures
+                entry = {"account": ACCOUNTS[0].email, "failures": entry}
+            if chat_id not in ARCHIVE_PENDING:
+                ARCHIVE_PENDING[chat_id] = entry
+                ARCHIVE_OVERFLOW.append(chat_id)
+                restored += 1
+        if restored:
+            app.logger.info(f"从文件 {path} 恢复了 {restored} 个待归档会话。")
+        return restored
+    except Exception as e:
+        app.logger.error(f"加载待归档会话文件失败: {e}")
+        return None
 
-async def background_login_and_setup(email, password):
-    global cookies_are_genuinely_valid, login_pending
+async def adopt_orphaned_archives():
+    """
+    主进程接管其他进程遗留的待归档文件: 存活锁已无人持有 (进程已退出)，或是单进程模式留下的文件。
+    先把接管的会话写入本进程的文件，再删除原文件，中途崩溃不会丢失记录。
+    """
+    own_file = os.path.abspath(ARCHIVE_PENDING_FILE)
+    pattern = os.path.join(DATA_DIR, "archive_pending*.json")
+    # 没有待归档会话的进程只留下存活锁，同样需要清理
+    paths = set(glob.glob(pattern)) | {lock_path[:-len(".lock")] for lock_path in glob.glob(f"{pattern}.lock")}
+    for path in sorted(paths):
+        if os.path.abspath(path) == own_file:
+            continue
+        lock_path = f"{path}.lock"
+        fd = None
+        if fcntl is not None and os.path.exists(lock_path):
+            fd = try_lock_file(lock_path)
+            if fd is None:
+                continue # 所属进程仍在运行
+        try:
+            if os.path.exists(path):
+                if await load_pending_archives(path) is None:
+                    continue
+                await save_pending_archives()
+                if ARCHIVE_PENDING_DIRTY:
+                    continue
+                os.remove(path)
+            if fd is not None:
+                os.remove(lock_path)
+        finally:
+            if fd is not None:
+                os.close(fd)
+    drain_archive_overflow()
+
+async def save_pending_archives():
+    global ARCHIVE_PENDING_DIRTY
+    ARCHIVE_PENDING_DIRTY = False
+    try:
+        tmp_file = f"{ARCHIVE_PENDING_FILE}.tmp"
+        async with aiofiles.open(tmp_file, 'w') as f:
+            await f.write(json.dumps({"pending": ARCHIVE_PENDING}))
+        os.replace(tmp_file, ARCHIVE_PENDING_FILE)
+    except IOError as e:
+        ARCHIVE_PENDING_DIRTY = True
+        app.logger.error(f"保存待归档会话到文件失败: {e}")
+
+async def archive_maintenance_loop():
+    while True:
+        await asyncio.sleep(ARCHIVE_PERSIST_INTERVAL)
+        drain_archive_overflow() # 队列有空位时，把溢出的会话重新放回队列
+        if ARCHIVE_PENDING_DIRTY:
+            await save_pending_archives()
+
+async def start_archive_workers():
+    global ARCHIVE_QUEUE
+    ARCHIVE_QUEUE = asyncio.Queue(maxsize=ARCHIVE_QUEUE_MAX_SIZE)
+    await load_pending_archives()
+    if IS_LEADER:
+        await adopt_orphaned_archives()
+    drain_archive_overflow()
+    ARCHIVE_TASKS.extend(asyncio.create_task(archive_worker(i)) for i in range(ARCHIVE_WORKERS))
+    ARCHIVE_TASKS.append(asyncio.create_task(archive_maintenance_loop()))
+    app.logger.info(f"归档队列已启动 ({ARCHIVE_WORKERS} 个 worker，队列上限 {ARCHIVE_QUEUE_MAX_SIZE})。")
+
+async def stop_archive_workers():
+    global ARCHIVE_QUEUE
+    if ARCHIVE_QUEUE is None:
+        return
+    drain_archive_overflow()
+    if not ARCHIVE_QUEUE.empty():
+        app.logger.info(f"正在清空归档队列 (剩余 {ARCHIVE_QUEUE.qsize()} 个)...")
+    try:
+        await asyncio.wait_for(ARCHIVE_QUEUE.join(), timeout=ARCHIVE_FLUSH_TIMEOUT)
+    except asyncio.TimeoutError:
+        app.logger.warning(f"归档队列在 {ARCHIVE_FLUSH_TIMEOUT} 秒内未能清空，剩余会话将在下次启动时继续归档。")
+    for task in ARCHIVE_TASKS:
+        task.cancel()
+    await asyncio.gather(*ARCHIVE_TASKS, return_exceptions=True)
+    ARCHIVE_TASKS.clear()
+    ARCHIVE_QUEUE = None
+    await save_pending_archives()
+    if ARCHIVE_PENDING:
+        app.logger.info(f"{len(ARCHIVE_PENDING)} 个未完成的归档已保存到 {ARCHIVE_PENDING_FILE}。")
+
+def is_pooled_chat_valid(created_at):
+    return (time.monotonic() - created_at) < CHAT_POOL_MAX_AGE
+
+async def acquire_chat_session(account):
+    """从该账号的预热池中取出一个可用的 Chat ID；池为空时按需创建。"""
+    while account.chat_pool:
+        chat_id, created_at = account.chat_pool.popleft()
+        if is_pooled_chat_valid(created_at):
+            CHAT_POOL_STATS["hits"] += 1
+            CHAT_POOL_REFILL_EVENT.set()
+            return chat_id
+        # 过期的会话不能再用，但仍需在上游清理
+        CHAT_POOL_STATS["expired"] += 1
+        archive_chat_later(account, chat_id)
+
+    if CHAT_POOL_TARGET_SIZE > 0:
+        CHAT_POOL_STATS["misses"] += 1
+        CHAT_POOL_REFILL_EVENT.set()
+    return await create_new_chat_session(account)
+
+def evict_expired_pooled_chats(account):
+    valid = [(chat_id, created_at) for chat_id, created_at in account.chat_pool if is_pooled_chat_valid(created_at)]
+    if len(valid) == len(account.chat_pool):
+        return
+    expired = [chat_id for chat_id, created_at in account.chat_pool if not is_pooled_chat_valid(created_at)]
+    account.chat_pool.clear()
+    account.chat_pool.extend(valid)
+    CHAT_POOL_STATS["expired"] += len(expired)
+    app.logger.info(f"账号 {account.label} 的会话池中 {len(expired)} 个会话已过期，将在后台清理。")
+    for chat_id in expired:
+        archive_chat_later(account, chat_id)
+
+async def refill_one_pooled_chat(account):
+    token = set_upstream_deadline(UPSTREAM_REQUEST_DEADLINE)
+    try:
+        chat_id = await create_new_chat_session(account)
+    except Exception as e:
+        app.logger.warning(f"会话池补充时发生错误: {type(e).__name__} - {e}")
+        chat_id = None
+    finally:
+        UPSTREAM_DEADLINE.reset(token)
+    if not chat_id:
+        CHAT_POOL_STATS["refill_failures"] += 1
+        return False
+    account.chat_pool.append((chat_id, time.monotonic()))
+    CHAT_POOL_STATS["refills"] += 1
+    return True
+
+async def chat_pool_refill_loop():
+    app.logger.info(f"会话池后台补充任务已启动 (每账号目标大小: {CHAT_POOL_TARGET_SIZE}, 并发: {CHAT_POOL_REFILL_CONCURRENCY}, 最长存活: {CHAT_POOL_MAX_AGE}s)。")
+    while True:
+        try:
+            # 没有请求消耗时也定期醒来，以便淘汰过期的会话
+            await asyncio.wait_for(CHAT_POOL_REFILL_EVENT.wait(), timeout=CHAT_POOL_MAX_AGE / 2)
+        except asyncio.TimeoutError:
+            pass
+        CHAT_POOL_REFILL_EVENT.clear()
+
+        for account in ACCOUNTS:
+            evict_expired_pooled_chats(account)
+        if not has_available_account():
+            await asyncio.sleep(CHAT_POOL_RETRY_DELAY)
+            CHAT_POOL_REFILL_EVENT.set()
+            continue
+
+        # 每个缺口对应一个补充任务，按并发上限分批执行
+        refill_slots = [account for account in ACCOUNTS if account.is_available()
+                        for _ in range(CHAT_POOL_TARGET_SIZE - len(account.chat_pool))]
+        for start in range(0, len(refill_slots), CHAT_POOL_REFILL_CONCURRENCY):
+            batch = refill_slots[start:start + CHAT_POOL_REFILL_CONCURRENCY]
+            results = await asyncio.gather(*(refill_one_pooled_chat(account) for account in batch))
+            if not all(results):
+                # 上游出现问题时不要立即重试，避免放大故障
+                await asyncio.sleep(CHAT_POOL_RETRY_DELAY)
+                CHAT_POOL_REFILL_EVENT.set()
+                break
+
+def start_chat_pool():
+    global CHAT_POOL_TASK
+    if CHAT_POOL_TARGET_SIZE <= 0:
+        app.logger.info("CHAT_POOL_SIZE 为 0，会话池已禁用。")
+        return
+    CHAT_POOL_TASK = asyncio.create_task(chat_pool_refill_loop())
+    CHAT_POOL_REFILL_EVENT.set()
+
+async def stop_chat_pool():
+    global CHAT_POOL_TASK
+    if CHAT_POOL_TASK:
+        CHAT_POOL_TASK.cancel()
+        try:
+            await CHAT_POOL_TASK
+        except asyncio.CancelledError:
+            pass
+        CHAT_POOL_TASK = None
+    for account in ACCOUNTS:
+        for chat_id, _ in account.chat_pool:
+            archive_chat_later(account, chat_id)
+        account.chat_pool.clear()
+
+async def background_login_and_setup(accounts):
+    global login_pending
     
     login_pending.clear() # Indicate background login is in progress
-    app.logger.info("后台登录和设置任务已启动。")
+    app.logger.info(f"后台登录和设置任务已启动 ({len(accounts)} 个账号)。")
     
+    async def login_one(account):
+        try:
+            # This updates the account's cookies and client; a failed login puts the account into cool-down
+            if await single_flight_login(account):
+                app.logger.info(f"账号 {account.label} 后台登录成功。Cookies 已验证并更新。")
+        except Exception as e:
+            account.cool_down(ACCOUNT_LOGIN_RETRY_INTERVAL, f"后台登录任务中发生意外错误: {type(e).__name__} - {e}")
+        # The refresh loop also brings accounts whose login failed back into rotation later.
+        schedule_cookie_refresh(account)
+
     try:
-        if await login_and_get_cookies(email, password): # This updates GLOBAL_COOKIES and HTTP_CLIENT.cookies
-            cookies_are_genuinely_valid = True
-            app.logger.info("后台登录成功。Cookies 已验证并更新。")
-            # Schedule regular refreshes only after a successful login
-            # Pass email and password to the task directly.
-            asyncio.create_task(schedule_cookie_refresh(email, password))
-        else:
-            cookies_are_genuinely_valid = False
-            app.logger.error("后台登录失败。服务可能无法正常处理依赖认证的请求。将不会启动定时刷新。")
-            # Consider adding more robust retry logic for background_login_and_setup itself if initial fails,
-            # or a periodic check to re-attempt background_login_and_setup.
-    except Exception as e:
-        cookies_are_genuinely_valid = False
-        app.logger.error(f"后台登录任务中发生意外错误: {type(e).__name__} - {e}", exc_info=True)
+        await asyncio.gather(*(login_one(account) for account in accounts))
     finally:
         login_pending.set() # Signal completion of this login attempt (success or fail)
-        app.logger.info(f"后台登录和设置任务已结束。最终认证状态: {cookies_are_genuinely_valid}")
+        app.logger.info(f"后台登录和设置任务已结束。可用账号: {sum(a.is_available() for a in ACCOUNTS)}/{len(ACCOUNTS)}")
 
-async def initialize():
-    global cookies_are_genuinely_valid, COOKIE_LAST_REFRESH, GLOBAL_COOKIES, HTTP_CLIENT
+def try_become_leader():
+    global IS_LEADER
+    fd = try_lock_file(LEADER_LOCK_FILE)
+    if fd is None:
+        return False
+    PROCESS_LOCK_FDS[LEADER_LOCK_FILE] = fd
+    IS_LEADER = True
+    app.logger.info(f"本进程 (pid {os.getpid()}) 成为主进程，负责定时刷新Cookie与接管遗留的归档。")
+    return True
+
+async def cookie_sync_loop():
+    """轮询各账号 Cookie 文件的 mtime，采用其他进程写入的新 Cookie；非主进程同时尝试接任已退出的主进程。"""
+    while True:
+        await asyncio.sleep(COOKIE_SYNC_INTERVAL)
+        try:
+            if not IS_LEADER and try_become_leader():
+                await adopt_orphaned_archives()
+            for account in ACCOUNTS:
+                try:
+                    mtime = os.stat(account.cookie_file).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                if mtime == account.cookie_file_mtime:
+                    continue
+                account.cookie_file_mtime = mtime
+                if await adopt_newer_cookies_from_file(account):
+                    app.logger.info(f"已从其他进程同步账号 {account.label} 的新Cookie。")
+        except Exception as e:
+            app.logger.error(f"同步多进程状态时发生错误: {e}", exc_info=True)
 
-    load_proxy_config() # Load proxy settings at startup
-    email, password = load_credentials()
-    if not (email and password):
+def start_worker_coordination():
+    """多进程模式: 持有本进程的存活锁，参与主进程选举，并启动 Cookie 同步任务。"""
+    global COOKIE_SYNC_TASK
+    if not MULTI_WORKER:
+        return
+    # 主进程据此判断本进程的待归档文件是否已无人负责
+    liveness_fd = try_lock_file(f"{ARCHIVE_PENDING_FILE}.lock")
+    if liveness_fd is not None:
+        PROCESS_LOCK_FDS[f"{ARCHIVE_PENDING_FILE}.lock"] = liveness_fd
+    else:
+        app.logger.warning(f"无法获得 {ARCHIVE_PENDING_FILE}.lock (另一个进程使用了相同的 WORKER_ID?)，本进程的待归档记录可能被主进程提前接管。")
+    if not try_become_leader():
+        app.logger.info(f"本进程 (pid {os.getpid()}) 作为工作进程运行，Cookie 由主进程刷新并通过文件同步。")
+    COOKIE_SYNC_TASK = asyncio.create_task(cookie_sync_loop())
+
+def stop_worker_coordination():
+    if COOKIE_SYNC_TASK:
+        COOKIE_SYNC_TASK.cancel()
+    for fd in PROCESS_LOCK_FDS.values():
+        if fd is not None:
+            os.close(fd) # 释放主进程锁与存活锁，由其他进程接任
+    PROCESS_LOCK_FDS.clear()
+
+async def initialize():
+    credentials = load_credentials()
+    if not credentials:
         app.logger.critical("未能加载凭据，无法继续初始化。程序退出。")
         # Instead of sys.exit, let Quart handle startup failure if possible, or raise a specific exception.
-        raise RuntimeError("VS_EMAIL or VS_PASSWORD not set in environment.")
-
-    # Try to load cookies from file first. This updates GLOBAL_COOKIES and COOKIE_LAST_REFRESH.
-    if await load_cookies_from_file():
-        if not check_cookie_refresh(): # Check if loaded cookies are still fresh and valid
-            cookies_are_genuinely_valid = True
-            if HTTP_CLIENT: # Ensure global client uses these loaded cookies
-                 HTTP_CLIENT.cookies = GLOBAL_COOKIES # This should be the same object instance if load_cookies_from_file modifies GLOBAL_COOKIES in place
-            app.logger.info("成功从文件加载有效且未过期的Cookie。将安排后台刷新。")
+        raise RuntimeError("VS_EMAIL/VS_PASSWORD or VS_ACCOUNTS not set in environment.")
+    setup_accounts(credentials)
+
+    accounts_needing_login = []
+    for account in ACCOUNTS:
+        # Try to load cookies from file first. This updates the account's cookies and last refresh time.
+        if await load_cookies_from_file(account) and not check_cookie_refresh(account):
+            account.valid = True
+            app.logger.info(f"账号 {account.label} 从文件加载了有效且未过期的Cookie。将安排后台刷新。")
             # Schedule refresh task even if current cookies are valid, for future expirations.
-            asyncio.create_task(schedule_cookie_refresh(email, password))
+            schedule_cookie_refresh(account)
         else:
-            # Cookies loaded from file but are expired or failed staleness check
-            app.logger.info("从文件加载的Cookie已过期或无效。将在后台尝试刷新/登录。")
-            cookies_are_genuinely_valid = False # Mark as invalid until background login succeeds
-            asyncio.create_task(background_login_and_setup(email, password))
-    else:
-        # Failed to load cookies from file (e.g., first run, or file corrupted)
-        app.logger.info("未能从文件加载Cookie。将在后台尝试执行初始登录。")
-        cookies_are_genuinely_valid = False
-        asyncio.create_task(background_login_and_setup(email, password))
+            # First run, corrupted file, or cookies loaded from file are expired
+            app.logger.info(f"账号 {account.label} 没有可用的Cookie。将在后台尝试执行登录。")
+            accounts_needing_login.append(account)
+    if accounts_needing_login:
+        asyncio.create_task(background_login_and_setup(accounts_needing_login))
 
     app.logger.info("核心初始化逻辑已调度。服务器即将启动。")
     app.logger.info("注意: 依赖认证的API功能可能需要等待后台登录/Cookie验证完成。")
@@ -395,32 +1659,789 @@ def create_manual_openai_error_chunk(message, error_type="invalid_request_error"
         }
     }
 
-def generate_stream_response(content_chunk, model, message_id):
-    chunk_data = {"id": message_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
-                  "choices": [{"delta": {"content": content_chunk}, "index": 0, "finish_reason": None}]}
-    return f"data: {json.dumps(chunk_data)}\n\n"
+_COALESCE_TIMEOUT = object() # Sentinel: the coalescing window closed before the next queue item arrived
+
+class SSEChunkEncoder:
+    """
+    单个流的 OpenAI chunk 编码器。id、model、created 在流内不变，因此预先编码成字节前缀/后缀，
+    每个 token 只需对 delta 字符串做一次 JSON 转义。输出与对完整 chunk 调用 json.dumps 的结果逐字节一致。
+    """
+    __slots__ = ("model", "message_id", "created", "index", "_content_prefix", "_reasoning_prefix", "_suffix")
+
+    def __init__(self, model, message_id, created=None, index=0):
+        self.model = model
+        self.message_id = message_id
+        self.created = int(time.time()) if created is None else created
+        self.index = index # 选项序号，n>1 或多模型请求时每个选项一个编码器
+        # '{"id": ..., "object": ..., "created": ..., "model": ...' without the closing brace
+        envelope_head = json.dumps({"id": message_id, "object": "chat.completion.chunk", "created": self.created, "model": model})[:-1]
+        self._content_prefix = f'data: {envelope_head}, "choices": [{{"delta": {{"content": '.encode('utf-8')
+        self._reasoning_prefix = f'data: {envelope_head}, "choices": [{{"delta": {{"reasoning_content": '.encode('utf-8')
+        self._suffix = f'}}, "index": {index}, "finish_reason": null}}]}}\n\n'.encode('utf-8')
+
+    @staticmethod
+    def _encode_delta(value):
+        if type(value) is str:
+            return encode_basestring_ascii(value).encode('ascii')
+        return json.dumps(value).encode('utf-8')
+
+    def content(self, content_chunk):
+        return self._content_prefix + self._encode_delta(content_chunk) + self._suffix
+
+    def reasoning(self, reasoning_chunk):
+        return self._reasoning_prefix + self._encode_delta(reasoning_chunk) + self._suffix
+
+    def done(self, usage=None, finish_reason="stop"):
+        done_data = {"id": self.message_id, "object": "chat.completion.chunk", "created": self.created, "model": self.model,
+                     "choices": [{"delta": {}, "index": self.index, "finish_reason": finish_reason}]}
+        if usage:
+            done_data['usage'] = usage
+        return f"data: {json.dumps(done_data)}\n\n".encode('utf-8')
+
+
+class UpstreamStreamDecoder:
+    """
+    上游数据流协议 (每行一个 "<类型>:<JSON>") 的增量解码器，直接处理 aiter_bytes() 的字节块，不经过文本解码与逐行切分。
+    在字节缓冲区中按换行切分并按两字节前缀分派；不含转义的纯字符串 delta 直接按 UTF-8 解码，
+    含转义的字符串只调用 JSON 的字符串扫描器，其它值才走完整的 json.loads。
+    跨块的半行留在缓冲区中等待下一个块 (换行符不会出现在多字节 UTF-8 字符内部，因此只有完整的行才会被解码)。
+    产出的事件为 (类型, 值): ("content", str) 对应 0:，("reasoning", str) 对应 g:，("finish", usage 或 None) 对应 e:/d:；
+    其它类型的行被忽略，无法解析的行计数后跳过。
+    """
+
+    __slots__ = ("buffer", "errors")
+
+    PREFIXES = {b"0:": "content", b"g:": "reasoning", b"e:": "finish", b"d:": "finish"}
+
+    def __init__(self):
+        self.buffer = b""
+        self.errors = 0
+
+    def feed(self, chunk):
+        """解码一个字节块，返回其中完整的行产生的事件列表。"""
+        if self.buffer:
+            chunk = self.buffer + chunk
+        lines = chunk.split(b"\n")
+        self.buffer = lines.pop() # Partial line (or b"") carried over to the next chunk
+        return self.decode_lines(lines)
+
+    def flush(self):
+        """上游结束时调用: 最后一行可能没有换行符。"""
+        line, self.buffer = self.buffer, b""
+        return self.decode_lines((line,)) if line else []
+
+    def decode_lines(self, lines):
+        events = []
+        prefixes, scanstring = self.PREFIXES, json.decoder.scanstring
+        for line in lines:
+            kind = prefixes.get(line[:2])
+            if kind is None:
+                continue
+            try:
+                if kind == "finish":
+                    payload = line[2:].strip()
+                    events.append((kind, json.loads(payload).get("usage") if payload else None))
+                elif line[-1] == 0x22 and line[2] == 0x22 and line.count(0x22) == 2 and 0x5C not in line:
+                    # Fast path: a JSON string without escapes is its own UTF-8 content between the quotes
+                    events.append((kind, line[3:-1].decode("utf-8")))
+                else:
+                    text = line[2:].decode("utf-8")
+                    value, end = scanstring(text, 1) if text[:1] == '"' else (None, -1)
+                    events.append((kind, value if end == len(text) else json.loads(text)))
+            except Exception as e:
+                self.errors += 1
+                STREAM_STATS["upstream_decode_errors"] += 1
+                log_sampled("upstream_line_parse", logging.WARNING, "处理流数据行时出错: %.200r, Error: %s", line, e)
+        return events
+
+async def iter_upstream_chat_events(account, payload, headers, model_label="other"):
+    """
+    向 CHAT_API_URL 发起流式请求，用 UpstreamStreamDecoder 增量解码响应字节并产出其事件。
+    流式与非流式请求共用此消费者: 不会在内存中保留完整的响应体，收到结束标记(e:/d:)后立即关闭上游连接。
+    在产出第一个事件之前，认证失败、5xx 与网络错误会像 make_request_with_retry 一样重试，并同样受熔断器、截止时间与重试预算约束。
+    连接与发送阶段的超时按截止时间收紧；读超时是两个数据块之间允许的最长空闲时间，不受截止时间限制。
+    调用方应使用 contextlib.aclosing() 包裹，以便提前退出时及时释放连接。
+    """
+    RETRY_BUDGET.record_request()
+    upstream_model = payload["settings"]["modelId"]
+    for attempt in range(MAX_RETRIES):
+        can_retry = attempt < MAX_RETRIES - 1
+        auth_generation = account.auth_generation
+        request_started = time.monotonic()
+        yielded_any = False
+        breaker_ticket = UPSTREAM_BREAKER.before_request()
+        success = None # 计入熔断器的结果，None 表示请求被取消
+        try:
+            timeout = request_timeout(STREAM_REQUEST_TIMEOUT, clip_read=False)
+            async with account.client.stream("POST", CHAT_API_URL, json=payload, headers=headers, timeout=timeout, follow_redirects=False) as response:
+                success = response.status_code < 500
+                UPSTREAM_BREAKER.record(breaker_ticket, success)
+                if not success:
+                    MODEL_ROUTER.record_outcome(upstream_model, False) # 每次 5xx 都计入该模型的错误率，包括随后被重试的
+                note_account_response_status(account, response)
+                if response.status_code in [401, 403]:
+                    await response.aread()
+                    app.logger.warning(f"请求 POST {CHAT_API_URL} 认证失败 (账号 {account.label}, 状态码 {response.status_code})。尝试重新登录...")
+                    if await relogin_account(account, auth_generation) and can_retry:
+                        METRIC_UPSTREAM_RETRIES.inc(str(response.status_code))
+                        continue
+                    raise httpx.HTTPStatusError(f"上游API认证失败: {response.status_code}", request=response.request, response=response)
+                if response.status_code != 200:
+                    await response.aread()
+                    app.logger.warning(f"请求 POST {CHAT_API_URL} 失败 (尝试 {attempt + 1}/{MAX_RETRIES}): 状态码 {response.status_code}, 响应(部分): {response.text[:200]}")
+                    if response.status_code in [500, 502, 503, 504] and await wait_before_retry(attempt, str(response.status_code), parse_retry_after(response.headers)):
+                        continue
+                    raise httpx.HTTPStatusError(f"上游API响应错误: {response.status_code}", request=response.request, response=response)
+
+                account.record_latency(time.monotonic() - request_started)
+                ttfb_recorded = False
+                decoder = UpstreamStreamDecoder()
+                async for chunk in response.aiter_bytes():
+                    if not ttfb_recorded:
+                        METRIC_UPSTREAM_TTFB_SECONDS.observe(time.monotonic() - request_started, model_label)
+                        ttfb_recorded = True
+                    for event in decoder.feed(chunk):
+                        yielded_any = True
+                        yield event
+                        if event[0] == "finish":
+                            return # Leaving the context closes the upstream connection right away
+                for event in decoder.flush():
+                    yield event
+                return
+        except httpx.RequestError as e:
+            if success is None:
+                success = False
+                UPSTREAM_BREAKER.record(breaker_ticket, False)
+                MODEL_ROUTER.record_outcome(upstream_model, False)
+            # 已经向调用方产出过数据时无法透明重试
+            if yielded_any:
+                raise
+            app.logger.error(f"请求 POST {CHAT_API_URL} (尝试 {attempt + 1}/{MAX_RETRIES}) 发生网络错误: {type(e).__name__} - {e}")
+            if not await wait_before_retry(attempt, "network"):
+                raise
+        finally:
+            if success is None:
+                UPSTREAM_BREAKER.record(breaker_ticket, None) # 释放半开状态下的探测名额
+
+def resolve_stream_coalescing(headers):
+    override = headers.get("X-Stream-Coalesce", "").strip().lower()
+    if override in ("1", "true", "yes", "on"):
+        return True
+    if override in ("0", "false", "no", "off"):
+        return False
+    return SSE_COALESCE_ENABLED
+
+class ResponseCache:
+    """
+    按字节预算限制大小的 LRU + TTL 响应缓存。
+    条目保存最终的正文、思考内容与 usage，可以还原为 JSON 响应，也可以重放为 SSE 流。
+    """
+
+    ENTRY_OVERHEAD = 256 # 估算每个条目的固定开销 (key、时间戳、usage 等)
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = collections.OrderedDict() # key -> (expires_at, size, content, reasoning, usage)
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "bypassed": 0, "stored": 0, "evicted": 0, "expired": 0, "rejected": 0}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        if entry[0] <= time.monotonic():
+            self._remove(key)
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry[2], entry[3], entry[4]
+
+    def put(self, key, content, reasoning, usage):
+        size = len(content.encode('utf-8')) + len(reasoning.encode('utf-8')) + self.ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            self.stats["rejected"] += 1
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, size, content, reasoning, usage)
+        self.total_bytes += size
+        self.stats["stored"] += 1
+        while self.total_bytes > self.max_bytes:
+            oldest_key = next(iter(self.entries))
+            self._remove(oldest_key)
+            self.stats["evicted"] += 1
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry[1]
+
+    def snapshot(self):
+        return {**self.stats, "entries": len(self.entries), "bytes": self.total_bytes, "max_bytes": self.max_bytes, "ttl": self.ttl}
+
+RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL)
+
+class StickySessionStore:
+    """
+    多轮对话复用的上游会话，按 LRU 与空闲时间淘汰，淘汰的会话交给后台归档。
+    会话在使用期间被取出 (checkout)，对话成功完成后以新的键放回 (checkin)，因此同一个会话不会被两个请求同时使用。
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict() # key -> (expires_at, account, chat_id, digest)
+        self.stats = {"hits": 0, "misses": 0, "mismatched": 0, "fallbacks": 0, "stored": 0, "evicted": 0, "expired": 0}
+
+    def checkout(self, key, digest):
+        """取出键对应的会话 (账号, chat_id)。会话保存的对话与请求的消息前缀 (digest) 不一致时归档并返回 None。"""
+        self.expire()
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        _, account, chat_id, entry_digest = entry
+        if entry_digest != digest:
+            self.stats["mismatched"] += 1
+            archive_chat_later(account, chat_id)
+            return None
+        self.stats["hits"] += 1
+        return account, chat_id
+
+    def checkin(self, key, account, chat_id, digest):
+        self.expire()
+        previous = self.entries.pop(key, None)
+        if previous is not None and previous[2] != chat_id:
+            archive_chat_later(previous[1], previous[2])
+        self.entries[key] = (time.monotonic() + self.ttl, account, chat_id, digest)
+        self.stats["stored"] += 1
+        while len(self.entries) > self.max_entries:
+            _, (_, evicted_account, evicted_chat_id, _) = self.entries.popitem(last=False)
+            archive_chat_later(evicted_account, evicted_chat_id)
+            self.stats["evicted"] += 1
+
+    def expire(self):
+        # 条目按最近使用排序，最久未用的在最前面
+        now = time.monotonic()
+        while self.entries:
+            key, (expires_at, account, chat_id, _) = next(iter(self.entries.items()))
+            if expires_at > now:
+                break
+            del self.entries[key]
+            archive_chat_later(account, chat_id)
+            self.stats["expired"] += 1
+
+    def clear(self):
+        for _, account, chat_id, _ in self.entries.values():
+            archive_chat_later(account, chat_id)
+        self.entries.clear()
+
+STICKY_SESSIONS = StickySessionStore(STICKY_SESSION_MAX_ENTRIES, STICKY_SESSION_TTL)
+
+class StickyTurn:
+    """
+    一次请求的会话复用计划: 查找已有会话的键与前缀摘要、只含新增用户消息的提示词，
+    以及对话成功后放回会话所用的键 (由 store_key() 结合本次回答计算)。
+    """
+
+    def __init__(self, conversation_id, history_hasher, prefix_digest, delta_prompt):
+        self.conversation_id = conversation_id
+        self.history_hasher = history_hasher # 覆盖全部历史消息的 sha256 对象
+        self.prefix_digest = prefix_digest # 直到最后一条 assistant 消息的摘要，没有可复用的前缀时为 None
+        self.delta_prompt = delta_prompt
+
+    @property
+    def lookup_key(self):
+        if self.prefix_digest is None:
+            return None
+        return f"conversation:{self.conversation_id}" if self.conversation_id else self.prefix_digest
+
+    def store_key(self, reply):
+        """返回 (键, 摘要): 把本次回答接到历史之后的对话摘要。"""
+        hasher = self.history_hasher.copy()
+        update_conversation_digest(hasher, ASSISTANT_PREFIX, reply)
+        digest = hasher.hexdigest()
+        return (f"conversation:{self.conversation_id}" if self.conversation_id else digest), digest
+
+def update_conversation_digest(hasher, prefix, content):
+    hasher.update(prefix.encode('utf-8'))
+    hasher.update(content.encode('utf-8'))
+    hasher.update(b"\0")
+
+def plan_sticky_turn(headers, messages_array, model_requested, system_prompt):
+    """
+    计算请求的会话复用计划。最后一条 assistant 消息之后只有用户消息时，这些消息就是本轮的增量，
+    可以发送到保存了之前对话的上游会话；否则 (首轮、或以 assistant 消息结尾) 只在完成后保存会话。
+    """
+    conversation_id = headers.get("X-Conversation-Id", "").strip() or None
+    _, history_messages = normalize_chat_messages(messages_array)
+    hasher = hashlib.sha256(f"{model_requested}\0{system_prompt}\0".encode('utf-8'))
+    last_assistant = max((i for i, (prefix, _) in enumerate(history_messages) if prefix == ASSISTANT_PREFIX), default=-1)
+    prefix_digest = None
+    for i, (prefix, content) in enumerate(history_messages):
+        update_conversation_digest(hasher, prefix, content)
+        if i == last_assistant:
+            prefix_digest = hasher.hexdigest()
+    delta = history_messages[last_assistant + 1:]
+    if not delta:
+        prefix_digest = None # Nothing new to send
+    delta_prompt = "".join(prefix + content for prefix, content in delta).lstrip() + "\n\nAssistant:"
+    return StickyTurn(conversation_id, hasher, prefix_digest, delta_prompt)
+
+def request_bypasses_shared_results(headers):
+    """请求头 Cache-Control: no-cache / no-store 或 X-Proxy-Cache: bypass 表示不使用缓存，也不与其它请求共享生成结果。"""
+    cache_control = headers.get("Cache-Control", "").lower()
+    return headers.get("X-Proxy-Cache", "").strip().lower() == "bypass" or "no-cache" in cache_control or "no-store" in cache_control
+
+def compute_request_fingerprint(data, model_requested, system_prompt, final_prompt):
+    """
+    请求指纹: 模型、规范化后的提示词与采样参数的 JSON 规范形式的 sha256。
+    响应缓存与进行中请求合并共用此指纹。n != 1 的请求没有指纹。
+    """
+    if data.get("n", 1) != 1:
+        return None
+    canonical = json.dumps({
+        "model": model_requested,
+        "system": system_prompt.strip(),
+        "prompt": final_prompt.strip(),
+        "params": {name: data[name] for name in RESPONSE_CACHE_SAMPLING_PARAMS if data.get(name) is not None},
+    }, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def resolve_response_cache_key(data, fingerprint, bypassed):
+    """
+    返回 (缓存键, 缓存状态)。缓存状态为 "MISS" (可读写缓存)、"BYPASS" (请求头要求跳过) 或 None (不适用)。
+    """
+    if not RESPONSE_CACHE_ENABLED:
+        return None, None
+    if bypassed:
+        RESPONSE_CACHE.stats["bypassed"] += 1
+        return None, "BYPASS"
+    if not fingerprint:
+        return None, None
+    temperature = data.get("temperature")
+    if RESPONSE_CACHE_DETERMINISTIC_ONLY and (not isinstance(temperature, (int, float)) or temperature != 0):
+        return None, None
+    return fingerprint, "MISS"
 
-def generate_stream_done(model, message_id, usage=None):
-    done_data = {"id": message_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
-                 "choices": [{"delta": {}, "index": 0, "finish_reason": "stop"}]}
-    if usage:
-        done_data['usage'] = usage
-    return f"data: {json.dumps(done_data)}\n\n"
+_HEARTBEAT = object() # Sentinel: injected into an idle subscription by the heartbeat wheel
+SSE_HEARTBEAT_FRAME = b":heartbeat\n\n"
 
-def generate_stream_reasoning_response(reasoning_chunk, model, message_id):
-    chunk_data = {"id": message_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
-                  "choices": [{"delta": {"reasoning_content": reasoning_chunk}, "index": 0, "finish_reason": None}]}
-    return f"data: {json.dumps(chunk_data)}\n\n"
+class GenerationSubscription(abc.ABC):
+    """
+    订阅者读取生成事件的接口，与 asyncio.Queue 的 get / get_nowait 用法一致。
+    生成结束且事件读完后返回 None；心跳调度器注入的心跳以 _HEARTBEAT 返回，但只在没有待读事件时返回。
+    """
 
+    def __init__(self, generation):
+        self.generation = generation
+        self.closed = False
+        self.pending_heartbeats = 0
+        self.readable = asyncio.Event()
 
-def build_prompt_with_history_and_instructions(messages_array):
-    if not messages_array:
-        return "", ""
+    @abc.abstractmethod
+    def next_event(self):
+        """返回下一个待读事件；生成结束且已读完时返回 None，暂无事件时抛出 asyncio.QueueEmpty。"""
 
-    system_prompts = []
-    history_messages = []
+    def get_nowait(self):
+        # 先读缓冲区 / 游标: 已有数据时心跳是多余的，不能排在数据之前发出
+        try:
+            item = self.next_event()
+        except asyncio.QueueEmpty:
+            if not self.pending_heartbeats:
+                raise
+            self.pending_heartbeats -= 1
+            return _HEARTBEAT
+        self.pending_heartbeats = 0
+        return item
+
+    async def get(self):
+        while True:
+            try:
+                return self.get_nowait()
+            except asyncio.QueueEmpty:
+                self.readable.clear()
+                await self.readable.wait()
+
+    def wake(self):
+        self.readable.set()
+
+    def heartbeat(self):
+        self.pending_heartbeats += 1
+        self.readable.set()
+
+    def close(self):
+        self.closed = True
+
+class BufferedSubscription(GenerationSubscription):
+    """
+    非共享生成的唯一订阅者。缓冲区满时生成任务在 push() 处等待，上游响应随之暂停读取 (背压)，
+    慢速客户端占用的内存因此有上限。
+    """
+
+    def __init__(self, generation, max_events):
+        super().__init__(generation)
+        self.max_events = max(1, max_events)
+        self.buffer = collections.deque()
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    async def push(self, item):
+        while len(self.buffer) >= self.max_events and not self.closed:
+            STREAM_STATS["backpressure_waits"] += 1
+            self.writable.clear()
+            await self.writable.wait()
+        if self.closed:
+            return
+        self.buffer.append(item)
+        self.readable.set()
+
+    def next_event(self):
+        if self.buffer:
+            item = self.buffer.popleft()
+            self.writable.set()
+            return item
+        if self.generation.finished:
+            return None
+        raise asyncio.QueueEmpty
+
+    def close(self):
+        super().close()
+        self.buffer.clear()
+        self.writable.set() # 不让生成任务继续等待一个已离开的客户端
+
+class CursorSubscription(GenerationSubscription):
+    """
+    共享生成的订阅者，只保存自己在 generation.events 中的读取位置。
+    事件本身由生成保留一份，多个订阅者不复制；生成任务不等待任何订阅者，慢速客户端不会拖慢其它订阅者。
+    """
+
+    def __init__(self, generation):
+        super().__init__(generation)
+        self.position = 0
+
+    def next_event(self):
+        events = self.generation.events
+        if self.position < len(events):
+            item = events[self.position]
+            self.position += 1
+            return item
+        if self.generation.finished:
+            return None
+        raise asyncio.QueueEmpty
+
+class ChatGeneration:
+    """
+    一次上游生成及其订阅者。共享生成保留全部事件，订阅者按各自的读取位置消费，晚加入的订阅者从头读起；
+    非共享生成只有一个订阅者，使用有界缓冲区把客户端的读取速度反压到上游读取。
+    最后一个订阅者离开时取消上游生成。
+    """
+
+    def __init__(self, key=None, retain_events=False):
+        self.key = key # 进行中请求合并的指纹，None 表示不与其它请求共享
+        self.retain_events = retain_events or key is not None # 共享或需要写入缓存时保留全部事件
+        self.events = []
+        self.subscribers = set()
+        self.finished = False
+        self.completed = False # 已收到上游的结束标记
+        self.chat_id = None
+        self.upstream_model = None # 实际使用的上游 modelId (路由与故障转移之后)
+        self.task = None
+        self.timings = {} # 阶段名 -> 耗时 (秒)，由生成任务记录，用于 Server-Timing
+        # 准备阶段的结果: None 表示上游生成已开始，否则为 (错误信息, 状态码, Retry-After)
+        self.ready = asyncio.get_running_loop().create_future()
+
+    def subscribe(self):
+        if self.key is not None:
+            subscription = CursorSubscription(self)
+        else:
+            subscription = BufferedSubscription(self, STREAM_BUFFER_EVENTS)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        self.subscribers.discard(subscription)
+        if not self.subscribers and not self.finished and not self.completed and self.task and not self.task.done():
+            INFLIGHT_STATS["cancelled"] += 1
+            self.task.cancel()
+
+    async def publish(self, item):
+        if self.retain_events:
+            self.events.append(item)
+        if self.key is not None:
+            for subscription in self.subscribers:
+                subscription.wake()
+            return
+        for subscription in tuple(self.subscribers):
+            await subscription.push(item)
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        for subscription in self.subscribers:
+            subscription.wake() # Signal completion
+
+class HeartbeatHandle:
+    __slots__ = ("subscription", "last_activity", "active")
+
+    def __init__(self, subscription, last_activity):
+        self.subscription = subscription
+        self.last_activity = last_activity
+        self.active = True
+
+class HeartbeatWheel:
+    """
+    所有 SSE 流共用的心跳调度器 (时间轮)。只有一个后台任务按固定粒度转动，
+    到期的流只有在真正空闲满一个间隔时才会收到心跳，否则按剩余空闲时间重新排入轮中。
+    有数据流动的流只需更新 last_activity，不创建也不重置任何计时器。
+    """
+
+    def __init__(self, interval, resolution):
+        self.interval = interval
+        self.resolution = max(0.01, min(resolution, interval))
+        self.slots = [[] for _ in range(math.ceil(self.interval / self.resolution) + 1)]
+        self.cursor = 0
+        self.registered = 0
+        self.task = None
+
+    def register(self, subscription):
+        handle = HeartbeatHandle(subscription, asyncio.get_running_loop().time())
+        self._schedule(handle, self.interval)
+        self.registered += 1
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return handle
+
+    def unregister(self, handle):
+        if handle.active:
+            handle.active = False # 惰性删除: 轮转到它所在的格子时丢弃
+            self.registered -= 1
+
+    def _schedule(self, handle, delay):
+        ticks = min(len(self.slots) - 1, max(1, math.ceil(delay / self.resolution)))
+        self.slots[(self.cursor + ticks) % len(self.slots)].append(handle)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self.registered > 0:
+            await asyncio.sleep(self.resolution)
+            self.cursor = (self.cursor + 1) % len(self.slots)
+            due, self.slots[self.cursor] = self.slots[self.cursor], []
+            now = loop.time()
+            for handle in due:
+                if not handle.active:
+                    continue
+                idle = now - handle.last_activity
+                if idle >= self.interval - self.resolution / 2:
+                    handle.subscription.heartbeat()
+                    handle.last_activity = now
+                    STREAM_STATS["heartbeats"] += 1
+                    self._schedule(handle, self.interval)
+                else:
+                    self._schedule(handle, self.interval - idle)
+        for slot in self.slots:
+            slot.clear() # 只剩已注销的句柄
+
+    async def stop(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+
+HEARTBEAT_WHEEL = HeartbeatWheel(SSE_HEARTBEAT_INTERVAL, SSE_HEARTBEAT_RESOLUTION)
+
+class AdmissionController:
+    """
+    全局与按模型的并发名额，以及一个有界的 FIFO 等待队列。
+    名额在释放时直接转交给队列中第一个可以放行的请求，新到达的请求无法插队。
+    """
+
+    def __init__(self, max_concurrency, model_limits, queue_size, max_wait):
+        self.max_concurrency = max_concurrency
+        self.model_limits = model_limits
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.active = 0
+        self.active_by_model = collections.Counter()
+        self.waiters: collections.deque = collections.deque() # (future, model, enqueued_at)
+        self.hold_time_ewma = 0.0 # 每个名额的平均占用时间，用于估算 Retry-After
+        self.wait_time_ewma = 0.0
+        self.stats = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0}
+
+    def can_admit(self, model):
+        if self.max_concurrency and self.active >= self.max_concurrency:
+            return False
+        model_limit = self.model_limits.get(model, 0)
+        return not model_limit or self.active_by_model[model] < model_limit
+
+    def _grant(self, model):
+        self.active += 1
+        self.active_by_model[model] += 1
+        self.stats["admitted"] += 1
+
+    def retry_after(self, model):
+        """按当前排队人数与平均占用时间估算多久后再试 (秒)。"""
+        limit = self.model_limits.get(model, 0) or self.max_concurrency or 1
+        estimate = self.hold_time_ewma * (len(self.waiters) + 1) / limit
+        return max(1, min(math.ceil(estimate), math.ceil(self.max_wait) or 1))
+
+    async def acquire(self, model):
+        """
+        申请一个名额，返回 (是否放行, 拒绝时建议的 Retry-After 秒数)。
+        放行后必须调用 release(model, admitted_at)。
+        """
+        if self.can_admit(model):
+            self._grant(model)
+            return True, None
+        if len(self.waiters) >= self.queue_size:
+            self.stats["rejected_queue_full"] += 1
+            return False, self.retry_after(model)
+
+        waiter = asyncio.get_running_loop().create_future()
+        enqueued_at = time.monotonic()
+        entry = (waiter, model, enqueued_at)
+        self.waiters.append(entry)
+        self.stats["queued"] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            if waiter.done(): # Granted just as the wait expired
+                return self._admitted_after_wait(enqueued_at)
+            self._remove_waiter(entry)
+            self.stats["rejected_timeout"] += 1
+            return False, self.retry_after(model)
+        except asyncio.CancelledError:
+            self._remove_waiter(entry)
+            if waiter.done(): # Granted, but the request went away; hand the slot on
+                self.release(model, time.monotonic())
+            raise
+        return self._admitted_after_wait(enqueued_at)
+
+    def _admitted_after_wait(self, enqueued_at):
+        waited = time.monotonic() - enqueued_at
+        self.wait_time_ewma = waited if not self.wait_time_ewma else ADMISSION_EWMA_ALPHA * waited + (1 - ADMISSION_EWMA_ALPHA) * self.wait_time_ewma
+        return True, None
+
+    def _remove_waiter(self, entry):
+        try:
+            self.waiters.remove(entry)
+        except ValueError:
+            pass
+
+    def release(self, model, admitted_at):
+        self.active -= 1
+        self.active_by_model[model] -= 1
+        if self.active_by_model[model] <= 0:
+            del self.active_by_model[model]
+        held = time.monotonic() - admitted_at
+        self.hold_time_ewma = held if not self.hold_time_ewma else ADMISSION_EWMA_ALPHA * held + (1 - ADMISSION_EWMA_ALPHA) * self.hold_time_ewma
+        self.dispatch()
+
+    def dispatch(self):
+        """按 FIFO 顺序把空出的名额交给可以放行的等待者 (按模型限流时，被限流模型的请求不会阻塞其它模型)。"""
+        for entry in list(self.waiters):
+            if self.max_concurrency and self.active >= self.max_concurrency:
+                break
+            waiter, model, _ = entry
+            if waiter.done():
+                self._remove_waiter(entry)
+                continue
+            if self.can_admit(model):
+                self._remove_waiter(entry)
+                self._grant(model)
+                waiter.set_result(None)
+
+    def snapshot(self):
+        now = time.monotonic()
+        return {
+            **self.stats,
+            "active": self.active,
+            "active_by_model": dict(self.active_by_model),
+            "queue_depth": len(self.waiters),
+            "oldest_wait_seconds": round(now - self.waiters[0][2], 3) if self.waiters else 0.0,
+            "avg_wait_seconds": round(self.wait_time_ewma, 3),
+            "avg_hold_seconds": round(self.hold_time_ewma, 3),
+            "max_concurrency": self.max_concurrency,
+            "model_limits": self.model_limits,
+            "queue_size": self.queue_size,
+            "max_wait": self.max_wait,
+        }
 
-    # 1. Separate system prompts from history messages
+ADMISSION = AdmissionController(ADMISSION_MAX_CONCURRENCY, ADMISSION_MODEL_LIMITS, ADMISSION_QUEUE_SIZE, ADMISSION_MAX_WAIT)
+
+def estimate_tokens_heuristic(text):
+    """
+    默认的本地 token 估算器，按 cl100k/o200k 类分词器校准: ASCII 文本约 4 字符一个 token，CJK 等多字节字符约 1 字符一个 token。
+    只做一次 UTF-8 编码 (C 实现)，不逐字符遍历: 多字节字符的数量由编码后多出的字节数近似得到。
+    """
+    if text.isascii():
+        return (len(text) + 3) // 4
+    extra_bytes = len(text.encode('utf-8', 'surrogatepass')) - len(text)
+    wide_chars = (extra_bytes + 1) // 2 # CJK 字符在 UTF-8 中占 3 字节
+    narrow_chars = max(len(text) - wide_chars, 0)
+    return (narrow_chars + 3) // 4 + wide_chars
+
+TOKEN_ESTIMATORS = {"heuristic": estimate_tokens_heuristic}
+
+def register_token_estimator(name, estimator):
+    """注册一个 token 估算器 (接受字符串、返回 token 数的函数)，之后可通过 TOKEN_ESTIMATOR 选用。"""
+    TOKEN_ESTIMATORS[name] = estimator
+    TOKEN_COUNT_CACHE.clear()
+
+def load_tiktoken_estimator():
+    try:
+        import tiktoken # optional dependency
+    except ImportError:
+        return None
+    encoding = tiktoken.get_encoding("o200k_base")
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+TOKEN_COUNT_CACHE: collections.OrderedDict = collections.OrderedDict() # (内容哈希, 长度) -> token 数，切换估算器时清空
+
+def get_token_estimator():
+    estimator = TOKEN_ESTIMATORS.get(TOKEN_ESTIMATOR)
+    if estimator is None and TOKEN_ESTIMATOR == "tiktoken":
+        estimator = load_tiktoken_estimator()
+        if estimator is None:
+            app.logger.warning("TOKEN_ESTIMATOR=tiktoken 但未安装 tiktoken，改用默认的 heuristic 估算器。")
+            estimator = estimate_tokens_heuristic
+        TOKEN_ESTIMATORS["tiktoken"] = estimator
+    elif estimator is None:
+        app.logger.warning(f"未知的 TOKEN_ESTIMATOR: {TOKEN_ESTIMATOR}，改用默认的 heuristic 估算器。")
+        estimator = TOKEN_ESTIMATORS[TOKEN_ESTIMATOR] = estimate_tokens_heuristic
+    return estimator
+
+def count_message_tokens(content):
+    """
+    单条消息的 token 数 (含角色前缀开销)，按内容哈希做 LRU 缓存，多轮对话中的旧消息不再运行估算器。
+    每个请求的消息都是新解析的字符串，计算哈希仍需遍历每条消息的全文，因此整体开销仍与历史长度成正比；
+    缓存省下的是估算器本身的开销 (对 tiktoken 明显，对 heuristic 很小)。
+    """
+    key = (hash(content), len(content)) # 不保留消息原文，缓存大小只与条目数有关
+    count = TOKEN_COUNT_CACHE.get(key)
+    if count is not None:
+        TOKEN_COUNT_CACHE.move_to_end(key)
+        return count
+    count = get_token_estimator()(content) + MESSAGE_TOKEN_OVERHEAD
+    TOKEN_COUNT_CACHE[key] = count
+    if len(TOKEN_COUNT_CACHE) > TOKEN_COUNT_CACHE_SIZE:
+        TOKEN_COUNT_CACHE.popitem(last=False)
+    return count
+
+def get_history_budget(model_requested):
+    return MODEL_HISTORY_BUDGETS.get(model_requested, MAX_HISTORY_TOKENS)
+
+HUMAN_PREFIX, ASSISTANT_PREFIX = "\n\nHuman: ", "\n\nAssistant: "
+
+def normalize_chat_messages(messages_array):
+    """把 OpenAI 格式的消息拆分为系统提示词列表与 [(前缀, 内容)] 形式的历史消息，跳过空消息与非字符串内容。"""
+    system_prompts = []
+    history_messages = [] # (prefix, content)
     for message in messages_array:
         role = message.get("role", "user").lower()
         content = message.get("content", "")
@@ -435,196 +2456,899 @@ def build_prompt_with_history_and_instructions(messages_array):
 
         if role == "system":
             system_prompts.append(content)
-        else:
-            history_messages.append({"role": role, "content": content})
+        elif role in ["user", "human"]:
+            history_messages.append((HUMAN_PREFIX, content))
+        elif role in ["assistant", "ai"]:
+            history_messages.append((ASSISTANT_PREFIX, content))
+    return system_prompts, history_messages
+
+def build_prompt_with_history_and_instructions(messages_array, model_requested=None):
+    if not messages_array:
+        return "", ""
 
+    # 1. Separate system prompts from history messages
+    system_prompts, history_messages = normalize_chat_messages(messages_array)
     system_prompt_content = "\n\n".join(system_prompts)
 
-    # 2. Build history, truncating from the oldest messages if token limit is exceeded.
-    # We iterate from newest to oldest to decide which messages to keep.
-    final_history_parts = []
-    current_token_count = 0
+    # 2. Build history, truncating from the oldest messages if the model's token budget is exceeded.
+    # We iterate from newest to oldest to decide which messages to keep. Token counts are memoized per message,
+    # and kept messages are joined once at the end instead of being formatted into intermediate strings.
+    history_budget = get_history_budget(model_requested)
+    reversed_parts = []
+    current_token_count = count_message_tokens(system_prompt_content) if system_prompt_content else 0
     
-    for message in reversed(history_messages):
-        role = message["role"]
-        content = message["content"]
-        
-        part_str = ""
-        if role in ["user", "human"]:
-            part_str = f"\n\nHuman: {content}"
-        elif role in ["assistant", "ai"]:
-            part_str = f"\n\nAssistant: {content}"
-        
-        # Using len() as a proxy for token count
-        part_token_count = len(part_str)
+    for prefix, content in reversed(history_messages):
+        part_token_count = count_message_tokens(content)
 
-        if current_token_count + part_token_count > MAX_HISTORY_TOKENS:
-            app.logger.info(f"History token limit ({MAX_HISTORY_TOKENS}) reached. Older messages will be discarded.")
+        if current_token_count + part_token_count > history_budget:
+            app.logger.info("History token limit (%s, model %s) reached. Older messages will be discarded.", history_budget, model_requested)
             break  # Stop adding older messages
         
-        final_history_parts.append(part_str)
+        reversed_parts.append(content)
+        reversed_parts.append(prefix)
         current_token_count += part_token_count
 
-    # The parts are in reverse order, so reverse them back to chronological order
-    formatted_history = "".join(reversed(final_history_parts)).strip()
+    # 3. Construct the final prompt for the API: chronological history followed by the assistant cue
+    if reversed_parts:
+        reversed_parts[-1] = reversed_parts[-1].lstrip() # The formatted history has no leading blank lines
+    reversed_parts.reverse()
+    reversed_parts.append("\n\nAssistant:")
     
-    # 3. Construct the final prompt for the API
-    final_prompt_elements = []
-    if formatted_history:
-        final_prompt_elements.append(formatted_history)
-    final_prompt_elements.append("\n\nAssistant:")
-    
-    final_prompt = "".join(final_prompt_elements)
+    final_prompt = "".join(reversed_parts)
     return system_prompt_content, final_prompt
 
-async def handle_chat_request(data) -> typing.Union[Response, tuple[Response, int]]:
+class UpstreamModelHealth:
+    """一个上游 modelId 的首 token 时间与错误率 (EWMA)。"""
+    __slots__ = ("ttft", "error_rate", "samples", "last_probe")
+
+    def __init__(self):
+        self.ttft: typing.Optional[float] = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.last_probe = 0.0
+
+    def is_degraded(self, ttft_slo):
+        if self.samples < ROUTING_MIN_SAMPLES:
+            return False
+        return self.error_rate > ROUTING_MAX_ERROR_RATE or bool(ttft_slo and self.ttft is not None and self.ttft > ttft_slo)
+
+class ModelRouter:
+    """
+    把对外的模型名解析为按优先级排列的上游 modelId 列表，第一个为首选，其余在故障转移时依次使用。
+    健康的模型按路由组的顺序 (或按权重随机) 排在前面，统计上表现不佳的模型排在最后。
+    """
+
+    def __init__(self, routes):
+        self.routes = {alias: ("ordered", [(upstream_model, 1.0)], ROUTING_TTFT_SLO) for alias, upstream_model in MODEL_MAPPING.items()}
+        for alias, spec in routes.items():
+            self.routes[alias] = self.parse_route(alias, spec)
+        self.default_alias = next(iter(MODEL_MAPPING))
+        self.health: dict = collections.defaultdict(UpstreamModelHealth) # modelId -> UpstreamModelHealth
+
+    @staticmethod
+    def parse_route(alias, spec):
+        """路由组配置 -> (策略, [(modelId, 权重)], 首 token SLO)。配置无效时抛出 ValueError。"""
+        ttft_slo = ROUTING_TTFT_SLO
+        if isinstance(spec, dict) and "models" in spec:
+            ttft_slo = float(spec.get("ttft_slo", ttft_slo))
+            spec = spec["models"]
+        if isinstance(spec, dict) and spec and all(isinstance(weight, (int, float)) and weight > 0 for weight in spec.values()):
+            strategy, targets = "weighted", [(model, float(weight)) for model, weight in spec.items()]
+        elif isinstance(spec, list) and spec and all(isinstance(model, str) for model in spec):
+            strategy, targets = "ordered", [(model, 1.0) for model in spec]
+        else:
+            raise ValueError(f"MODEL_ROUTES 中 {alias!r} 的配置无效: 需要 modelId 列表或 {{modelId: 正数权重}}。")
+        return strategy, [(MODEL_MAPPING.get(model, model), weight) for model, weight in targets], ttft_slo
+
+    def plan(self, alias):
+        """返回 (按优先级排列的上游 modelId 列表, 首 token SLO)。未知的模型名使用默认模型。"""
+        route = self.routes.get(alias)
+        if route is None:
+            ROUTING_STATS["unknown_model"] += 1
+            log_sampled("unknown_model", logging.WARNING, "未知的模型 %s，使用默认模型 %s。", alias, self.default_alias)
+            route = self.routes[self.default_alias]
+        strategy, targets, ttft_slo = route
+        if len(targets) == 1:
+            return [targets[0][0]], ttft_slo
+        if strategy == "weighted":
+            # 按权重的随机排列 (Efraimidis-Spirakis)，权重越大越可能排在前面
+            targets = sorted(targets, key=lambda target: random.random() ** (1.0 / target[1]), reverse=True)
+        now = time.monotonic()
+        preferred, degraded = [], []
+        for upstream_model, _ in targets:
+            health = self.health[upstream_model]
+            if not health.is_degraded(ttft_slo):
+                preferred.append(upstream_model)
+            elif now - health.last_probe >= ROUTING_PROBE_INTERVAL:
+                # 放行一个请求作为探测，恢复的模型由此重新积累统计
+                health.last_probe = now
+                ROUTING_STATS["probes"] += 1
+                preferred.append(upstream_model)
+            else:
+                degraded.append(upstream_model)
+        if degraded:
+            ROUTING_STATS["degraded_skipped"] += 1
+            degraded.sort(key=lambda upstream_model: (self.health[upstream_model].error_rate, self.health[upstream_model].ttft or 0.0))
+        return preferred + degraded, ttft_slo
+
+    def record_ttft(self, upstream_model, seconds):
+        health = self.health[upstream_model]
+        health.ttft = seconds if health.ttft is None else health.ttft + ROUTING_EWMA_ALPHA * (seconds - health.ttft)
+
+    def record_outcome(self, upstream_model, ok):
+        health = self.health[upstream_model]
+        health.samples += 1
+        health.error_rate += ROUTING_EWMA_ALPHA * ((0.0 if ok else 1.0) - health.error_rate)
+
+    def record_slo_miss(self, upstream_model, waited):
+        """超过首 token SLO 后被放弃的尝试: 真实的首 token 时间未知，至少为已等待的时间 (删失样本)，并计为一次失败。"""
+        self.record_ttft(upstream_model, waited)
+        self.record_outcome(upstream_model, False)
+
+    def snapshot(self):
+        # 同一个上游模型可能属于多个路由组，在任一组的 SLO 下被降级即视为降级
+        slos: dict = {}
+        for _, targets, ttft_slo in self.routes.values():
+            for upstream_model, _ in targets:
+                slos.setdefault(upstream_model, set()).add(ttft_slo)
+        return {
+            upstream_model: {"ttft_ewma": round(health.ttft, 3) if health.ttft is not None else None, "error_rate": round(health.error_rate, 3),
+                             "samples": health.samples, "degraded": any(health.is_degraded(slo) for slo in slos.get(upstream_model, {ROUTING_TTFT_SLO}))}
+            for upstream_model, health in self.health.items()
+        }
+
+MODEL_ROUTER = ModelRouter(MODEL_ROUTES)
+
+class ChatAttempt:
+    """一次上游对话尝试，占用一个账号的并发名额与一个会话。对冲时同一次生成可以有多个尝试。"""
+
+    def __init__(self, account, chat_id, upstream_model, events):
+        self.account = account
+        self.chat_id = chat_id
+        self.upstream_model = upstream_model
+        self.events = events # iter_upstream_chat_events() 返回的异步生成器，尚未开始读取
+        self.started_at = time.monotonic()
+        self.first_event_task: typing.Optional[asyncio.Future] = None
+        self.keep_session = False # 会话被保留用于下一轮对话时不归档
+
+    def wait_first_event(self):
+        self.first_event_task = asyncio.ensure_future(anext(self.events))
+        return self.first_event_task
+
+    async def close(self):
+        """关闭上游流，归档会话 (除非会话被保留) 并释放账号。"""
+        if self.first_event_task is not None and not self.first_event_task.done():
+            self.first_event_task.cancel()
+            await asyncio.wait({self.first_event_task}) # 生成器仍在运行时无法 aclose()
+        try:
+            await self.events.aclose()
+        except Exception as e:
+            app.logger.warning(f"关闭 chat {self.chat_id} 的上游流时出错: {e}")
+        if not self.keep_session:
+            archive_chat_later(self.account, self.chat_id)
+        release_account(self.account)
+
+async def start_chat_attempt(vs_text_model_id, system_prompt, final_prompt, model_label, sticky_session=None):
+    """
+    选择账号并取得会话，返回在上游模型 vs_text_model_id 上尚未开始读取的 ChatAttempt；没有可用账号时返回 None，取得会话失败时抛出异常。
+    sticky_session 为 (账号, chat_id) 时在该会话上继续对话，调用方已占用该账号的并发名额。
+    """
+    if sticky_session is not None:
+        account, chat_id = sticky_session
+    else:
+        account = await acquire_account()
+        if account is None:
+            return None
+        try:
+            chat_id = await acquire_chat_session(account)
+        except BaseException:
+            release_account(account)
+            raise
+        if not chat_id:
+            release_account(account)
+            raise Exception("无法创建新的聊天会话。请检查上游服务状态或网络连接。")
+
+    vs_msg_id = str(uuid.uuid4()).replace("-", "")[:16]
+    created_at_iso = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+    payload = {
+        "message": {"id": vs_msg_id, "createdAt": created_at_iso, "role": "user", "content": final_prompt, "parts": [{"type": "text", "text": final_prompt}]},
+        "cornerType": TEXT_CORNER_TYPE, "chatId": chat_id,
+        "settings": {"modelId": vs_text_model_id, "customSystemPrompt": system_prompt}
+    }
+    if "claude" in vs_text_model_id:
+        payload["settings"]["reasoning"] = "on"
+
+    chat_api_headers = {"Content-Type": "application/json", "Referer": f"{STREAM_CORNERS_BASE_URL}/{TEXT_CORNER_TYPE}/{chat_id}"}
+    return ChatAttempt(account, chat_id, vs_text_model_id, iter_upstream_chat_events(account, payload, chat_api_headers, model_label))
+
+async def race_chat_attempts(attempts, start_hedge, race_from_start=False, start_failover=None, failover_deadline=0.0):
+    """
+    等待 attempts 中第一个产出事件的尝试，返回 (尝试, 第一个事件)；上游流为空时事件为 None。
+    在 HEDGE_TTFT_DEADLINE 内没有任何尝试产出事件时，通过 start_hedge() 在新会话上启动对冲尝试，
+    总数不超过 HEDGE_MAX_ATTEMPTS。start_failover() 在路由组的下一个模型上启动尝试 (没有更多模型时返回 None)，
+    在所有尝试都已失败、或 failover_deadline (首 token SLO) 内没有产出事件时调用。
+    新尝试的准备 (选择账号与取得会话) 在后台进行，期间已有的尝试产出的第一个事件不会被耽搁。
+    胜出后其余尝试与仍在准备中的尝试被取消并从 attempts 中移除；所有尝试都失败时抛出最后一个错误。
+    """
+    pending = {attempt.wait_first_event(): attempt for attempt in attempts}
+    starting = {} # 准备中的尝试: task -> (类型, 原因)
+    hedging_possible, failover_possible = True, start_failover is not None
+    last_error = None
+    slo_missed = set() # 超过首 token SLO 而触发了故障转移的尝试
+
+    def launch_attempt(kind, reason):
+        start = start_hedge if kind == "hedge" else start_failover
+        starting[asyncio.ensure_future(start())] = (kind, reason)
+
+    def starting_count(kind):
+        return sum(1 for started_kind, _ in starting.values() if started_kind == kind)
+
+    def attempt_started(task, kind, reason):
+        nonlocal hedging_possible, failover_possible
+        try:
+            attempt = task.result()
+        except Exception as e:
+            attempt = None
+            app.logger.warning(f"启动新的上游尝试失败 ({reason}): {e}")
+        if attempt is None:
+            if kind == "hedge":
+                hedging_possible = False # 没有可用账号或会话，继续等待已有的尝试
+            else:
+                failover_possible = False
+            return
+        (HEDGE_STATS if kind == "hedge" else ROUTING_STATS)[reason] += 1
+        attempts.append(attempt)
+        pending[attempt.wait_first_event()] = attempt
+
+    try:
+        if race_from_start and HEDGE_MAX_ATTEMPTS > 1:
+            launch_attempt("hedge", "raced")
+
+        while pending or starting:
+            can_hedge = hedging_possible and HEDGE_TTFT_DEADLINE > 0 and len(attempts) + starting_count("hedge") < HEDGE_MAX_ATTEMPTS
+            slo_failover = (failover_possible and failover_deadline > 0 and not starting_count("failover")
+                            and (not can_hedge or failover_deadline <= HEDGE_TTFT_DEADLINE))
+            timeout = failover_deadline if slo_failover else HEDGE_TTFT_DEADLINE if can_hedge else None
+            done, _ = await asyncio.wait({*pending, *starting}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if slo_failover:
+                    app.logger.warning(f"上游模型 {attempts[-1].upstream_model} 在 {failover_deadline} 秒内没有产出第一个 token，切换到路由组中的下一个模型。")
+                    slo_missed.add(attempts[-1])
+                    launch_attempt("failover", "failover_slo")
+                else:
+                    app.logger.warning(f"chat {attempts[-1].chat_id} 在 {HEDGE_TTFT_DEADLINE} 秒内没有产出第一个 token，在新会话上发起对冲尝试。")
+                    launch_attempt("hedge", "hedged")
+                continue
+
+            for task in [task for task in done if task in starting]:
+                attempt_started(task, *starting.pop(task))
+
+            winner, first_event = None, None
+            for task in [task for task in done if task in pending]:
+                attempt = pending.pop(task)
+                if winner is not None:
+                    continue # 同时完成的其它尝试按落败处理
+                try:
+                    first_event = task.result()
+                    winner = attempt
+                except StopAsyncIteration:
+                    winner = attempt
+                except Exception as e:
+                    last_error = e
+                    HEDGE_STATS["attempts_failed"] += 1 # 5xx 与网络错误已在 iter_upstream_chat_events 中逐次计入模型错误率
+                    app.logger.warning(f"chat {attempt.chat_id} 的上游尝试失败 (模型 {attempt.upstream_model}): {e}")
+                    attempts.remove(attempt)
+                    await attempt.close()
+            if winner is None:
+                if not pending and failover_possible and not starting_count("failover"):
+                    launch_attempt("failover", "failover_error")
+                continue
+
+            MODEL_ROUTER.record_ttft(winner.upstream_model, time.monotonic() - winner.started_at)
+            if len(attempts) > 1 or starting:
+                HEDGE_STATS["primary_won" if winner is attempts[0] else "hedge_won"] += 1
+                for loser in [attempt for attempt in attempts if attempt is not winner]:
+                    HEDGE_STATS["losers_cancelled"] += 1
+                    # 超过 SLO 的尝试记一个删失的首 token 样本，否则总是超时的模型永远不会被降级；
+                    # 其它落败的尝试没有样本，它们在被取消前收到的 5xx 或网络错误已经计入了错误率
+                    if loser in slo_missed:
+                        MODEL_ROUTER.record_slo_miss(loser.upstream_model, max(failover_deadline, time.monotonic() - loser.started_at))
+                    attempts.remove(loser)
+                    await loser.close()
+            return winner, first_event
+        raise last_error
+    finally:
+        if starting:
+            # 胜负已分 (或调用方被取消) 时仍在准备的尝试: 取消准备，已经取得的会话归档、账号释放
+            for task in starting:
+                task.cancel()
+            await asyncio.wait(starting)
+            for task in starting:
+                if not task.cancelled() and task.exception() is None and task.result() is not None:
+                    HEDGE_STATS["losers_cancelled"] += 1
+                    await task.result().close()
+
+async def run_chat_generation(generation, model_requested, system_prompt, final_prompt, cache_key, sticky=None):
+    """
+    生成任务: 通过准入控制、选择账号、取得会话、驱动上游流并把事件广播给订阅者，结束后归档会话并释放账号与名额。
+    准备阶段 (名额、账号与会话) 的结果通过 generation.ready 通知所有订阅者。
+    sticky 为 StickyTurn 时优先在保留的会话上只发送新增消息，成功完成后保留本次的会话供下一轮使用。
+    """
+    attempts, finished, admitted_at, winner = [], False, None, None
+    sticky_session, reply_parts = None, []
+    model_label, generation_started, outcome = metric_model_label(model_requested), None, "error"
+    task_started = time.monotonic()
+    try:
+        if UPSTREAM_BREAKER.is_open():
+            # 熔断期间不占用准入名额与账号，直接失败
+            generation.ready.set_result(("上游服务暂时不可用 (熔断中)，请稍后重试。", 503, UPSTREAM_BREAKER.retry_after()))
+            return
+        admitted, retry_after = await ADMISSION.acquire(model_requested)
+        if not admitted:
+            app.logger.warning(f"准入控制拒绝请求 (模型 {model_requested}): 并发已满且等待队列已满或等待超时。")
+            generation.ready.set_result(("服务繁忙，请求过多，请稍后重试。", 429, retry_after))
+            return
+        admitted_at = time.monotonic()
+        generation.timings["queue"] = admitted_at - task_started
+        # 本任务的上下文独立，截止时间会传递到会话创建、对冲尝试与上游对话请求
+        set_upstream_deadline(UPSTREAM_REQUEST_DEADLINE)
+
+        if sticky is not None and sticky.lookup_key:
+            sticky_session = STICKY_SESSIONS.checkout(sticky.lookup_key, sticky.prefix_digest)
+            if sticky_session is not None and not try_acquire_account(sticky_session[0]):
+                # 会话所属账号不可用或已满载，归档该会话并完整重放历史
+                STICKY_SESSIONS.stats["fallbacks"] += 1
+                archive_chat_later(*sticky_session)
+                sticky_session = None
+            if sticky_session is not None:
+                generation.timings["sticky"] = None
+
+        upstream_models, ttft_slo = MODEL_ROUTER.plan(model_requested)
+        failover_models = collections.deque(upstream_models[1:])
+
+        def start_attempt(upstream_model=upstream_models[0]):
+            nonlocal sticky_session
+            if sticky_session is not None: # Only the first attempt continues the kept chat; hedges replay the history
+                session, sticky_session = sticky_session, None
+                return start_chat_attempt(upstream_model, system_prompt, sticky.delta_prompt, model_label, sticky_session=session)
+            return start_chat_attempt(upstream_model, system_prompt, final_prompt, model_label)
+
+        def start_hedge():
+            # 对冲尝试优先使用路由组中的下一个模型
+            return start_attempt(failover_models.popleft() if failover_models else upstream_models[0])
+
+        async def start_failover():
+            return await start_attempt(failover_models.popleft()) if failover_models else None
+
+        primary = await start_attempt()
+        if primary is None:
+            app.logger.warning("没有可用的上游账号 (均不健康或已达到并发上限)。")
+            generation.ready.set_result(("当前没有可用的上游账号，请稍后重试。", 503, None))
+            return
+        attempts.append(primary)
+        generation.chat_id, generation.upstream_model = primary.chat_id, primary.upstream_model
+        generation_started = time.monotonic()
+        generation.timings["session"] = generation_started - admitted_at
+        generation.ready.set_result(None)
+
+        attempt, event = await race_chat_attempts(attempts, start_hedge, race_from_start=model_requested in HEDGE_RACE_MODELS,
+                                                  start_failover=start_failover if failover_models else None, failover_deadline=ttft_slo)
+        winner = attempt
+        generation.chat_id, generation.upstream_model = attempt.chat_id, attempt.upstream_model
+        generation.timings["upstream"] = time.monotonic() - generation_started
+        if len(attempts) > 1:
+            generation.timings["hedged"] = None
+        while event is not None:
+            if event[0] == "finish":
+                # 订阅者收到结束标记后会立即离开，此时上游连接仍在关闭中，不能再被取消
+                finished = generation.completed = True
+            elif sticky is not None and event[0] == "content" and type(event[1]) is str:
+                reply_parts.append(event[1])
+            await generation.publish(event)
+            event = await anext(attempt.events, None)
+        outcome = "ok" if finished else "incomplete"
+
+        if sticky is not None and finished and (reply := "".join(reply_parts).strip()):
+            key, digest = sticky.store_key(reply)
+            attempt.keep_session = True
+            STICKY_SESSIONS.checkin(key, attempt.account, attempt.chat_id, digest)
+
+        if cache_key and finished:
+            content = "".join(value for kind, value in generation.events if kind == "content" and type(value) is str)
+            reasoning = "".join(value for kind, value in generation.events if kind == "reasoning" and type(value) is str)
+            usage = next((value for kind, value in generation.events if kind == "finish"), None)
+            RESPONSE_CACHE.put(cache_key, content, reasoning, usage)
+    except asyncio.CancelledError:
+        app.logger.warning(f"所有客户端均已断开，取消 chat {generation.chat_id} 的上游生成。")
+        outcome = "cancelled"
+        raise
+    except UpstreamUnavailableError as e:
+        app.logger.warning(f"上游暂时不可用: {e}")
+        if not generation.ready.done():
+            generation.ready.set_result((str(e), e.status_code, e.retry_after))
+        else:
+            await generation.publish(e)
+    except Exception as e:
+        app.logger.error(f"处理聊天请求时发生错误: {e}", exc_info=True)
+        if not generation.ready.done():
+            generation.ready.set_result((str(e), 500, None))
+        else:
+            await generation.publish(e)
+    finally:
+        if not generation.ready.done():
+            generation.ready.set_result(("请求已取消。", 500, None))
+        if generation_started is not None:
+            METRIC_GENERATION_SECONDS.observe(time.monotonic() - generation_started, model_label, outcome)
+            METRIC_UPSTREAM_MODEL_GENERATIONS.inc(model_label, generation.upstream_model, outcome)
+        if winner is not None and outcome != "cancelled": # 首 token 之前的失败已在 race_chat_attempts 中记录
+            MODEL_ROUTER.record_outcome(winner.upstream_model, outcome == "ok")
+        generation.finish()
+        if generation.key and INFLIGHT_GENERATIONS.get(generation.key) is generation:
+            del INFLIGHT_GENERATIONS[generation.key]
+        for attempt in attempts:
+            await attempt.close() # Leaving the stream closes the upstream connection; the chat is archived in the background
+        if sticky_session is not None: # Checked out but never used
+            archive_chat_later(*sticky_session)
+            release_account(sticky_session[0])
+        if admitted_at is not None:
+            ADMISSION.release(model_requested, admitted_at)
+
+def build_ready_error_response(ready_error, stream, request_timings, request_started):
+    """把生成任务准备阶段的错误 (错误信息, 状态码, Retry-After) 转换为客户端响应。"""
+    error_message, error_status, retry_after = ready_error
+    if error_status == 429:
+        error_response, _ = create_openai_error_response(error_message, error_type="rate_limit_error", status_code=429)
+        error_response.headers["Retry-After"] = str(retry_after)
+        set_server_timing(error_response, request_timings, request_started)
+        return error_response, 429
+    if error_status in (503, 504):
+        error_response, _ = create_openai_error_response(error_message, error_type="server_error", status_code=error_status)
+        if retry_after:
+            error_response.headers["Retry-After"] = str(retry_after)
+        set_server_timing(error_response, request_timings, request_started)
+        return error_response, error_status
+    if stream:
+        async def error_stream():
+            yield f"data: {json.dumps(create_manual_openai_error_chunk(error_message))}\n\n".encode('utf-8')
+        return Response(error_stream(), mimetype='text/event-stream', status=500) # type: ignore
+    return create_openai_error_response(error_message, status_code=500)
+
+async def handle_chat_request(data, headers) -> typing.Union[Response, tuple[Response, int]]:
+    request_started = time.monotonic()
     client_messages = data.get("messages", [])
     model_requested = data.get("model", list(MODEL_MAPPING.keys())[0])
     stream = data.get("stream", False)
+    coalesce_stream = resolve_stream_coalescing(headers) if stream else False
     response_to_return = None
 
-    if not HTTP_CLIENT:
-        app.logger.error("处理聊天请求失败：关键的全局 HTTP_CLIENT 未初始化。")
+    system_prompt, final_prompt = build_prompt_with_history_and_instructions(client_messages, model_requested)
+    request_timings = {"prompt": time.monotonic() - request_started}
+    bypass_shared = request_bypasses_shared_results(headers)
+    fingerprint = None
+    if (RESPONSE_CACHE_ENABLED or INFLIGHT_COALESCE_ENABLED) and not bypass_shared:
+        fingerprint = compute_request_fingerprint(data, model_requested, system_prompt, final_prompt)
+    cache_key, cache_status = resolve_response_cache_key(data, fingerprint, bypass_shared)
+    if cache_key and (cached := RESPONSE_CACHE.get(cache_key)):
+        app.logger.info("响应缓存命中 (模型 %s)。", model_requested)
+        request_timings["cache"] = None
+        return build_cached_chat_response(cached, model_requested, stream, request_timings, request_started)
+
+    if UPSTREAM_TRANSPORT is None:
+        app.logger.error("处理聊天请求失败：上游连接池未初始化。")
         return create_openai_error_response("内部服务器配置错误，HTTP客户端丢失。", status_code=500)
-        
-    temp_vs_chat_id = None
-    try:
-        temp_vs_chat_id = await create_new_chat_session()
-        if not temp_vs_chat_id:
-            raise Exception("无法创建新的聊天会话。请检查上游服务状态或网络连接。")
 
-        system_prompt, final_prompt = build_prompt_with_history_and_instructions(client_messages)
-        vs_text_model_id = MODEL_MAPPING.get(model_requested, list(MODEL_MAPPING.values())[0])
-        
-        openai_msg_id = f"chatcmpl-{uuid.uuid4().hex}"
-        vs_msg_id = str(uuid.uuid4()).replace("-", "")[:16]
-        created_at_iso = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
-
-        payload = {
-            "message": {"id": vs_msg_id, "createdAt": created_at_iso, "role": "user", "content": final_prompt, "parts": [{"type": "text", "text": final_prompt}]},
-            "cornerType": TEXT_CORNER_TYPE, "chatId": temp_vs_chat_id,
-            "settings": {"modelId": vs_text_model_id, "customSystemPrompt": system_prompt}
-        }
-        if "claude" in vs_text_model_id:
-            payload["settings"]["reasoning"] = "on"
+    sticky = plan_sticky_turn(headers, client_messages, model_requested, system_prompt) if STICKY_SESSIONS_ENABLED else None
+
+    # 相同请求正在生成时作为订阅者加入，否则启动新的生成任务。指定了对话 ID 的请求各自延续自己的会话，不参与合并
+    shared_key = fingerprint if INFLIGHT_COALESCE_ENABLED and not (sticky and sticky.conversation_id) else None
+    generation = INFLIGHT_GENERATIONS.get(shared_key) if shared_key else None
+    if generation is not None:
+        INFLIGHT_STATS["followers"] += 1
+        app.logger.info("相同请求正在生成中，作为订阅者加入 (模型 %s)。", model_requested)
+        request_timings["coalesced"] = None # 阶段耗时属于领头请求，与本请求的时间线部分重叠
+        subscription = generation.subscribe()
+    else:
+        generation = ChatGeneration(key=shared_key, retain_events=bool(shared_key or cache_key))
+        subscription = generation.subscribe()
+        if shared_key:
+            INFLIGHT_GENERATIONS[shared_key] = generation
+            INFLIGHT_STATS["leaders"] += 1
+        generation.task = asyncio.create_task(run_chat_generation(generation, model_requested, system_prompt, final_prompt, cache_key, sticky))
 
-        chat_api_headers = {"Content-Type": "application/json", "Referer": f"{STREAM_CORNERS_BASE_URL}/{TEXT_CORNER_TYPE}/{temp_vs_chat_id}"}
+    try:
+        ready_error = await asyncio.shield(generation.ready)
+    except BaseException:
+        generation.unsubscribe(subscription)
+        raise
+    request_timings.update(generation.timings)
+    if ready_error:
+        generation.unsubscribe(subscription)
+        return build_ready_error_response(ready_error, stream, request_timings, request_started)
+
+    openai_msg_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+    if stream:
+        async def stream_generator():
+            METRIC_ACTIVE_STREAMS.inc()
+            heartbeat = HEARTBEAT_WHEEL.register(subscription)
+            chunk_encoder = SSEChunkEncoder(model_requested, openai_msg_id)
+            loop = asyncio.get_running_loop()
+            
+            stream_usage_data = None
+            # 合并模式下的待发送缓冲区
+            pending_kind, pending_parts, pending_chars, pending_deadline = None, [], 0, 0.0
+            kinds_sent = set()
+            get_task = None # A subscription.get() that outlived a timed wait; reused so no item is lost
+
+            async def next_item(timeout):
+                nonlocal get_task
+                if get_task is None:
+                    try:
+                        return subscription.get_nowait()
+                    except asyncio.QueueEmpty:
+                        pass
+                    get_task = asyncio.ensure_future(subscription.get())
+                done, _ = await asyncio.wait({get_task}, timeout=timeout)
+                if not done:
+                    return _COALESCE_TIMEOUT
+                item = get_task.result()
+                get_task = None
+                return item
+
+            def flush_pending():
+                nonlocal pending_kind, pending_parts, pending_chars
+                text = "".join(pending_parts)
+                frame = chunk_encoder.content(text) if pending_kind == "content" else chunk_encoder.reasoning(text)
+                pending_kind, pending_parts, pending_chars = None, [], 0
+                return frame
+
+            try:
+                while True:
+                    timeout = max(0.0, pending_deadline - loop.time()) if pending_kind else None
+                    item = await next_item(timeout)
+                    if item is _COALESCE_TIMEOUT:
+                        yield flush_pending()
+                        continue
+
+                    if item is None: # End of stream from the generation
+                        break
+                    
+                    if isinstance(item, Exception):
+                        raise item
+
+                    if item is _HEARTBEAT:
+                        if not pending_kind: # Tokens about to be flushed already keep the connection alive
+                            yield SSE_HEARTBEAT_FRAME
+                        continue
+
+                    heartbeat.last_activity = loop.time()
+                    kind, value = item
+                    if kind == "finish":
+                        if value:
+                            stream_usage_data = value
+                        break
+
+                    if not coalesce_stream or kind not in kinds_sent or type(value) is not str:
+                        if pending_kind:
+                            yield flush_pending()
+                        if not kinds_sent:
+                            METRIC_CLIENT_TTFT_SECONDS.observe(time.monotonic() - request_started, metric_model_label(model_requested))
+                            if generation.upstream_model != header_upstream_model:
+                                # 响应头发出之后在首 token 之前切换了模型 (故障转移或对冲)，以注释帧告知实际使用的模型
+                                yield f": x-upstream-model {generation.upstream_model}\n\n".encode()
+                        kinds_sent.add(kind)
+                        yield chunk_encoder.content(value) if kind == "content" else chunk_encoder.reasoning(value)
+                        continue
+
+                    if pending_kind and pending_kind != kind:
+                        yield flush_pending()
+                    if not pending_kind:
+                        pending_kind, pending_deadline = kind, loop.time() + SSE_COALESCE_MAX_DELAY
+                    pending_parts.append(value)
+                    pending_chars += len(value)
+                    if pending_chars >= SSE_COALESCE_MAX_CHARS:
+                        yield flush_pending()
+
+                if pending_kind:
+                    yield flush_pending()
+                yield chunk_encoder.done(stream_usage_data)
+                if SERVER_TIMING_ENABLED:
+                    # 响应头早已发出，完整的阶段耗时 (含上游首 token 与总耗时) 以 SSE 注释帧的形式附在末尾
+                    request_timings.update(generation.timings)
+                    request_timings["total"] = time.monotonic() - request_started
+                    yield f": server-timing {format_server_timing(request_timings)}\n\n".encode()
+            except asyncio.CancelledError:
+                app.logger.warning(f"客户端 for chat {generation.chat_id} 断开连接。")
+            finally:
+                if get_task is not None:
+                    get_task.cancel()
+                HEARTBEAT_WHEEL.unregister(heartbeat)
+                METRIC_ACTIVE_STREAMS.dec()
+                generation.unsubscribe(subscription) # The last subscriber leaving cancels the upstream generation
         
-        if stream:
-            queue = asyncio.Queue()
+        header_upstream_model = generation.upstream_model
+        response_to_return = Response(stream_generator(), mimetype='text/event-stream') # type: ignore
+        set_server_timing(response_to_return, request_timings) # 仅含发送响应头之前已知的阶段
+    else: # Non-streaming requests consume the same incremental event stream, without buffering the raw body
+        full_response_content, non_stream_usage_info = [], None
+        try:
+            while (item := await subscription.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                kind, value = item
+                if kind == "content":
+                    full_response_content.append(value)
+                elif kind == "finish":
+                    non_stream_usage_info = value
+        except Exception as e:
+            return create_openai_error_response(str(e), status_code=500)
+        finally:
+            generation.unsubscribe(subscription)
+        
+        final_response_text = "".join(full_response_content)
+        response_to_return = jsonify({
+            "id": openai_msg_id, "object": "chat.completion", "created": int(time.time()), "model": model_requested,
+            "choices": [{"message": {"role": "assistant", "content": final_response_text}, "index": 0, "finish_reason": "stop"}],
+            "usage": non_stream_usage_info or {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        })
+        request_timings.update(generation.timings)
+        set_server_timing(response_to_return, request_timings, request_started)
+
+    set_upstream_model_header(response_to_return, [generation])
+    if cache_status:
+        response_to_return.headers["X-Proxy-Cache"] = cache_status
+    return response_to_return
 
-            async def data_reader(target_chat_id, stream_payload_data):
-                try:
-                    async with httpx.AsyncClient(headers=BASE_HEADERS, cookies=GLOBAL_COOKIES, timeout=None, follow_redirects=False, proxies=PROXY_CONFIG) as client:
-                        async with client.stream("POST", CHAT_API_URL, json=stream_payload_data, headers=chat_api_headers) as response:
-                            if response.status_code != 200:
-                                error_body = await response.aread()
-                                await queue.put(httpx.HTTPStatusError(f"上游API流式响应错误: {response.status_code}", request=response.request, response=response))
-                                return
-
-                            async for line in response.aiter_lines():
-                                await queue.put(line)
-                except Exception as e:
-                    await queue.put(e)
-                finally:
-                    await queue.put(None) # Signal completion
+def set_upstream_model_header(response, generations):
+    """X-Upstream-Model: 实际提供回答的上游 modelId，并行生成多个选项时列出各不相同的模型。"""
+    upstream_models = dict.fromkeys(generation.upstream_model for generation in generations if generation.upstream_model)
+    if upstream_models:
+        response.headers["X-Upstream-Model"] = ", ".join(upstream_models)
 
-            async def heartbeat_sender():
-                last_activity_time = time.time()
-                while True:
-                    await asyncio.sleep(5)  # 更频繁地检查
-                    current_time = time.time()
-                    # 无论队列状态如何，每30秒发送一次心跳
-                    if current_time - last_activity_time >= 5:
-                        await queue.put(":heartbeat\n\n")
-                        last_activity_time = current_time
-
-            async def stream_generator():
-                reader_task = asyncio.create_task(data_reader(temp_vs_chat_id, payload))
-                heartbeat_task = asyncio.create_task(heartbeat_sender())
-                
-                stream_usage_data = None
-                try:
-                    while True:
-                        item = await queue.get()
-                        if item is None: # End of stream from reader
-                            break
-                        
-                        if isinstance(item, Exception):
-                            raise item
-
-                        if item == ":heartbeat\n\n":
-                            yield item.encode('utf-8')
+def format_server_timing(timings):
+    """{阶段: 秒} -> Server-Timing 头的值，耗时为 None 的阶段只输出名称 (作为标记)。"""
+    return ", ".join(name if duration is None else f"{name};dur={duration * 1000:.1f}" for name, duration in timings.items())
+
+def set_server_timing(response, timings, request_started=None):
+    if not SERVER_TIMING_ENABLED:
+        return
+    if request_started is not None:
+        timings = {**timings, "total": time.monotonic() - request_started}
+    response.headers["Server-Timing"] = format_server_timing(timings)
+
+def build_cached_chat_response(cached, model_requested, stream, request_timings, request_started):
+    """将缓存条目还原为 JSON 响应，或重放为 SSE 流 (思考内容、正文各一帧，然后是结束帧)。"""
+    content, reasoning, usage = cached
+    openai_msg_id = f"chatcmpl-{uuid.uuid4().hex}"
+    if stream:
+        chunk_encoder = SSEChunkEncoder(model_requested, openai_msg_id)
+        async def replay_stream():
+            if reasoning:
+                yield chunk_encoder.reasoning(reasoning)
+            if content:
+                yield chunk_encoder.content(content)
+            yield chunk_encoder.done(usage)
+        response = Response(replay_stream(), mimetype='text/event-stream') # type: ignore
+    else:
+        response = jsonify({
+            "id": openai_msg_id, "object": "chat.completion", "created": int(time.time()), "model": model_requested,
+            "choices": [{"message": {"role": "assistant", "content": content}, "index": 0, "finish_reason": "stop"}],
+            "usage": usage or {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        })
+    response.headers["X-Proxy-Cache"] = "HIT"
+    set_server_timing(response, request_timings, request_started)
+    return response
+
+def resolve_fanout_models(data):
+    """
+    返回每个选项 (按 index 排列) 使用的模型；普通的单选项请求返回 None。
+    扩展字段 "models" 列出多个模型时，每个模型各生成 n 个选项。参数不合法时抛出 ValueError。
+    """
+    n, models = data.get("n"), data.get("models")
+    if n is None:
+        n = 1
+    if models is None and n == 1:
+        return None
+    if type(n) is not int or n < 1:
+        raise ValueError("`n` 必须是正整数。")
+    if models is None:
+        models = [data.get("model", list(MODEL_MAPPING.keys())[0])]
+    elif not isinstance(models, list) or not models or not all(isinstance(model, str) for model in models):
+        raise ValueError("`models` 必须是非空的模型名称列表。")
+    if n * len(models) > FANOUT_MAX_CHOICES:
+        raise ValueError(f"每个请求最多 {FANOUT_MAX_CHOICES} 个选项 (n × 模型数)。")
+    return [model for model in models for _ in range(n)]
+
+def aggregate_usage(usages):
+    """逐字段累加各分支的 usage。每个分支都在上游单独处理了一遍提示词，因此提示词 token 也按分支累加。"""
+    total = {}
+    for usage in usages:
+        for key, value in (usage or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                total[key] = total.get(key, 0) + value
+    return total or None
+
+async def handle_fanout_chat_request(data, models) -> typing.Union[Response, tuple[Response, int]]:
+    """
+    并行生成多个选项: 每个选项是一次独立的生成 (独立的准入名额、账号与会话)，不参与缓存、合并与会话复用。
+    总耗时约等于最慢的分支。任一分支在准备阶段失败时取消全部分支并返回该错误；
+    开始输出后失败的分支以 finish_reason "error" 结束，其余分支不受影响。所有会话都由各自的生成任务归档。
+    """
+    request_started = time.monotonic()
+    client_messages = data.get("messages", [])
+    stream = data.get("stream", False)
+    response_model = data.get("model", models[0])
+    multi_model = len(set(models)) > 1
+
+    if UPSTREAM_TRANSPORT is None:
+        app.logger.error("处理聊天请求失败：上游连接池未初始化。")
+        return create_openai_error_response("内部服务器配置错误，HTTP客户端丢失。", status_code=500)
+
+    prompts = {}
+    for model in models:
+        if model not in prompts:
+            prompts[model] = build_prompt_with_history_and_instructions(client_messages, model)
+    request_timings = {"prompt": time.monotonic() - request_started, "fanout": None}
+
+    FANOUT_STATS["requests"] += 1
+    FANOUT_STATS["branches"] += len(models)
+    app.logger.info("并行生成 %d 个选项 (模型 %s)。", len(models), ", ".join(dict.fromkeys(models)))
+    branches = [] # (model, generation, subscription)
+    for model in models:
+        generation = ChatGeneration()
+        subscription = generation.subscribe()
+        system_prompt, final_prompt = prompts[model]
+        generation.task = asyncio.create_task(run_chat_generation(generation, model, system_prompt, final_prompt, None))
+        branches.append((model, generation, subscription))
+
+    def leave_all():
+        for _, generation, subscription in branches:
+            generation.unsubscribe(subscription) # Cancels the generation; its sessions are archived in its finally block
+
+    def collect_branch_timings():
+        # 各分支并行进行，每个阶段取最慢的分支
+        for _, generation, _ in branches:
+            for phase, duration in generation.timings.items():
+                if duration is None or duration > (request_timings.get(phase) or 0.0):
+                    request_timings[phase] = duration
+
+    try:
+        ready_errors = await asyncio.gather(*(asyncio.shield(generation.ready) for _, generation, _ in branches))
+    except BaseException:
+        leave_all()
+        raise
+    collect_branch_timings()
+    ready_error = next((error for error in ready_errors if error), None)
+    if ready_error:
+        leave_all()
+        return build_ready_error_response(ready_error, stream, request_timings, request_started)
+
+    openai_msg_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+
+    if stream:
+        async def fanout_stream_generator():
+            METRIC_ACTIVE_STREAMS.inc()
+            loop = asyncio.get_running_loop()
+            encoders = [SSEChunkEncoder(model, openai_msg_id, created, index) for index, (model, _, _) in enumerate(branches)]
+            heartbeats = [HEARTBEAT_WHEEL.register(subscription) for _, _, subscription in branches]
+            usages = [None] * len(branches)
+            # 每个分支同时只有一个未完成的 get()，分支的有界缓冲区因此仍然对上游读取形成反压
+            pending = {asyncio.ensure_future(subscription.get()): index for index, (_, _, subscription) in enumerate(branches)}
+            try:
+                while pending:
+                    done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    heartbeat_due = False
+                    for task in sorted(done, key=pending.get):
+                        index = pending.pop(task)
+                        item = task.result()
+                        if item is _HEARTBEAT:
+                            heartbeat_due = True
+                        elif item is None:
+                            yield encoders[index].done()
                             continue
-                        
-                        line_content = item
-                        try:
-                            if line_content.startswith("e:") or line_content.startswith("d:"):
-                                json_data_str = line_content[2:]
-                                if json_data_str:
-                                    end_stream_data = json.loads(json_data_str)
-                                    if end_stream_data.get("usage"):
-                                        stream_usage_data = end_stream_data["usage"]
-                                break
-                            elif line_content.startswith("g:"):
-                                yield generate_stream_reasoning_response(json.loads(line_content[2:]), model_requested, openai_msg_id).encode('utf-8')
-                            elif line_content.startswith("0:"):
-                                yield generate_stream_response(json.loads(line_content[2:]), model_requested, openai_msg_id).encode('utf-8')
-                        
-                        except (json.JSONDecodeError, Exception) as e:
-                            app.logger.warning(f"处理流数据行时出错: {line_content}, Error: {e}")
-                            
-                    yield generate_stream_done(model_requested, openai_msg_id, stream_usage_data).encode('utf-8')
-                except asyncio.CancelledError:
-                    app.logger.warning(f"客户端 for chat {temp_vs_chat_id} 断开连接。")
-                finally:
-                    heartbeat_task.cancel()
-                    reader_task.cancel() # Ensure reader task is cancelled
-                    await delete_chat_session(temp_vs_chat_id)
-            
-            response_to_return = Response(stream_generator(), mimetype='text/event-stream') # type: ignore
-        else: # Non-streaming logic remains the same
-            api_response = await make_request_with_retry("POST", CHAT_API_URL, json=payload, headers=chat_api_headers, timeout=None)
-            if not api_response or api_response.status_code != 200:
-                raise Exception("上游API请求失败或响应无效。")
-            
-            full_response_content, non_stream_usage_info = [], None
-            for line_item in api_response.text.splitlines():
-                if line_item.startswith("0:"):
-                    full_response_content.append(json.loads(line_item[2:]))
-                elif (line_item.startswith("e:") or line_item.startswith("d:")) and (json_data_str := line_item[2:]):
-                    try:
-                        end_signal_data = json.loads(json_data_str)
-                        if "usage" in end_signal_data: non_stream_usage_info = end_signal_data["usage"]
-                    except json.JSONDecodeError: pass
-            
-            final_response_text = "".join(full_response_content)
-            response_to_return = jsonify({
-                "id": openai_msg_id, "object": "chat.completion", "created": int(time.time()), "model": model_requested,
-                "choices": [{"message": {"role": "assistant", "content": final_response_text}, "index": 0, "finish_reason": "stop"}],
-                "usage": non_stream_usage_info or {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
-            })
+                        elif isinstance(item, Exception):
+                            FANOUT_STATS["branch_errors"] += 1
+                            app.logger.warning("并行生成的选项 %d 出错: %s", index, item)
+                            yield encoders[index].done(finish_reason="error")
+                            continue
+                        elif item[0] == "finish":
+                            usages[index] = item[1]
+                            yield encoders[index].done()
+                            continue
+                        else:
+                            now = loop.time()
+                            for heartbeat in heartbeats:
+                                heartbeat.last_activity = now
+                            kind, value = item
+                            yield encoders[index].content(value) if kind == "content" else encoders[index].reasoning(value)
+                        pending[asyncio.ensure_future(branches[index][2].get())] = index
+                    if heartbeat_due:
+                        yield SSE_HEARTBEAT_FRAME
+
+                usage_chunk = {"id": openai_msg_id, "object": "chat.completion.chunk", "created": created, "model": response_model, "choices": []}
+                if (usage := aggregate_usage(usages)):
+                    usage_chunk["usage"] = usage
+                yield f"data: {json.dumps(usage_chunk)}\n\n".encode('utf-8')
+                if SERVER_TIMING_ENABLED:
+                    collect_branch_timings()
+                    request_timings["total"] = time.monotonic() - request_started
+                    yield f": server-timing {format_server_timing(request_timings)}\n\n".encode()
+            except asyncio.CancelledError:
+                app.logger.warning("客户端在并行生成 %d 个选项时断开连接。", len(branches))
+            finally:
+                for task in pending:
+                    task.cancel()
+                for heartbeat in heartbeats:
+                    HEARTBEAT_WHEEL.unregister(heartbeat)
+                METRIC_ACTIVE_STREAMS.dec()
+                leave_all()
+
+        response = Response(fanout_stream_generator(), mimetype='text/event-stream') # type: ignore
+        set_server_timing(response, request_timings)
+        set_upstream_model_header(response, [generation for _, generation, _ in branches])
+        return response
+
+    async def collect_branch(index, subscription):
+        parts, usage, finish_reason = [], None, "stop"
+        try:
+            while (item := await subscription.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                kind, value = item
+                if kind == "content":
+                    parts.append(value)
+                elif kind == "finish":
+                    usage = value
+        except Exception as e:
+            FANOUT_STATS["branch_errors"] += 1
+            app.logger.warning("并行生成的选项 %d 出错: %s", index, e)
+            finish_reason = "error"
+        return "".join(parts), usage, finish_reason
 
-    except Exception as e:
-        app.logger.error(f"处理聊天请求时发生错误: {e}", exc_info=True)
-        if stream:
-            async def error_stream():
-                yield f"data: {json.dumps(create_manual_openai_error_chunk(str(e)))}\n\n".encode('utf-8')
-            return Response(error_stream(), mimetype='text/event-stream', status=500) # type: ignore
-        else:
-            return create_openai_error_response(str(e), status_code=500)
+    try:
+        results = await asyncio.gather(*(collect_branch(index, subscription) for index, (_, _, subscription) in enumerate(branches)))
     finally:
-        if not stream and temp_vs_chat_id:
-            await delete_chat_session(temp_vs_chat_id)
-
-    return response_to_return
+        leave_all()
+
+    choices = []
+    for index, ((model, _, _), (content, _, finish_reason)) in enumerate(zip(branches, results)):
+        choice = {"message": {"role": "assistant", "content": content}, "index": index, "finish_reason": finish_reason}
+        if multi_model:
+            choice["model"] = model
+        choices.append(choice)
+    response = jsonify({
+        "id": openai_msg_id, "object": "chat.completion", "created": created, "model": response_model,
+        "choices": choices,
+        "usage": aggregate_usage(usage for _, usage, _ in results) or {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    })
+    collect_branch_timings()
+    set_server_timing(response, request_timings, request_started)
+    set_upstream_model_header(response, [generation for _, generation, _ in branches])
+    return response
+
+async def dispatch_chat_completion(data, headers) -> typing.Union[Response, tuple[Response, int]]:
+    """
+    校验请求体并分派到单选项或并行多选项的处理流程。HTTP 接口与批处理任务共用，不依赖请求上下文:
+    请求头 (缓存、合并、对话 ID 等控制项) 由调用方传入，批处理任务传入空的请求头。
+    """
+    if not data.get("messages"): # Ensure messages list is present
+        return create_openai_error_response("请求体中缺少必需的 `messages` 属性。", status_code=400)
+    try:
+        fanout_models = resolve_fanout_models(data)
+    except ValueError as e:
+        return create_openai_error_response(str(e), status_code=400)
+    if fanout_models:
+        return await handle_fanout_chat_request(data, fanout_models)
+    return await handle_chat_request(data, headers)
 
 @app.route('/v1/chat/completions', methods=['POST'])
 async def chat_completions() -> typing.Union[Response, tuple[Response, int]]:
     await initialization_complete.wait() # This should pass quickly once server starts
 
-    # Check if background login/setup is still pending
-    if not login_pending.is_set(): # login_pending is clear() if task is running
+    # Check if background login/setup is still pending and no account is usable yet
+    if not login_pending.is_set() and not has_available_account(): # login_pending is clear() if task is running
         app.logger.info("后台认证/设置仍在进行中，请等待片刻...")
         try:
             # Wait for the background task to complete, with a timeout
@@ -633,20 +3357,17 @@ async def chat_completions() -> typing.Union[Response, tuple[Response, int]]:
             app.logger.warning("等待后台认证/设置超时。服务可能尚未完全就绪。")
             return create_openai_error_response("服务正在进行初始设置，请稍后重试。", status_code=503) # Service Unavailable
 
-    # After waiting (or if it wasn't pending), check the actual cookie validity
-    if not cookies_are_genuinely_valid:
-        app.logger.error("无法处理聊天请求：Cookies 无效或后台认证失败。")
-        return create_openai_error_response("认证信息无效或后台初始化失败，无法处理请求。请检查服务器日志。", status_code=503)
+    # After waiting (or if it wasn't pending), check that at least one account is usable or about to be
+    if not has_available_account() and not pending_logins():
+        app.logger.error("无法处理聊天请求：所有账号的Cookies均无效、后台认证失败或处于冷却中。")
+        return create_openai_error_response("认证信息无效或所有上游账号暂不可用，无法处理请求。请检查服务器日志。", status_code=503)
 
-    # If we reach here, background task is done (or wasn't running) AND cookies are valid.
+    # If we reach here, background task is done (or wasn't running) AND at least one account is usable.
     try:
         data = await request.get_json()
         if not data:
             return create_openai_error_response("请求体不是有效的JSON，或为空。", status_code=400)
-        if not data.get("messages"): # Ensure messages list is present
-            return create_openai_error_response("请求体中缺少必需的 `messages` 属性。", status_code=400)
-        
-        return await handle_chat_request(data)
+        return await dispatch_chat_completion(data, request.headers)
 
     except httpx.RequestError as e_req: # Catch network errors from handle_chat_request or its sub-calls
         app.logger.error(f"处理聊天完成请求时发生网络连接错误: {type(e_req).__name__} - {e_req}", exc_info=True)
@@ -658,32 +3379,636 @@ async def chat_completions() -> typing.Union[Response, tuple[Response, int]]:
 
 @app.route('/v1/models', methods=['GET'])
 async def get_models_endpoint():
-    models = [{"id": k, "object": "model", "owned_by": "vsp-text", "permission": []} for k in MODEL_MAPPING.keys()]
+    models = [{"id": k, "object": "model", "owned_by": "vsp-text", "permission": []} for k in dict.fromkeys([*MODEL_MAPPING, *MODEL_ROUTES])]
     return jsonify({"data": models, "object": "list"})
 
+# --- 批处理 (Batch API) ---
+class ProxyRequest(Request):
+    """上传批处理文件的接口允许更大的请求体且不限制接收时间，其它接口沿用 MAX_CONTENT_LENGTH。"""
+
+    def __init__(self, method, scheme, path, *args, **kwargs):
+        if method == "POST" and path == "/v1/files":
+            kwargs["max_content_length"] = BATCH_MAX_FILE_BYTES
+            kwargs["body_timeout"] = None
+        super().__init__(method, scheme, path, *args, **kwargs)
+
+app.request_class = ProxyRequest
+
+BATCH_ID_PATTERN = re.compile(r"^(file-|batch_)[A-Za-z0-9]+$")
+
+def batch_file_path(file_id):
+    return os.path.join(BATCH_DIR, "files", f"{file_id}.jsonl")
+
+def batch_file_meta_path(file_id):
+    return os.path.join(BATCH_DIR, "files", f"{file_id}.json")
+
+def batch_object_path(batch_id):
+    return os.path.join(BATCH_DIR, f"{batch_id}.json")
+
+def batch_cancel_marker(batch_id):
+    return os.path.join(BATCH_DIR, f"{batch_id}.cancel")
+
+async def read_json_file(path):
+    try:
+        async with aiofiles.open(path, 'r', encoding='utf-8') as f:
+            return json.loads(await f.read())
+    except FileNotFoundError:
+        return None
+
+async def write_json_file(path, data):
+    # 先写临时文件再原子替换，其他进程不会读到写了一半的文件
+    tmp_file = f"{path}.{WORKER_ID}.tmp"
+    async with aiofiles.open(tmp_file, 'w', encoding='utf-8') as f:
+        await f.write(json.dumps(data, ensure_ascii=False))
+    os.replace(tmp_file, path)
+
+async def iter_file_lines(path):
+    """按大块读取文件并逐行产出 (不含换行符)，不会把整个文件读入内存；最后一行没有换行符时也会产出。"""
+    async with aiofiles.open(path, 'rb') as f:
+        remainder = b""
+        while chunk := await f.read(BATCH_READ_CHUNK_SIZE):
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+            for line in lines:
+                yield line
+        if remainder:
+            yield remainder
+
+def truncate_partial_last_line(path):
+    """进程在写输出时退出，最后一行可能只写了一半: 截断到最后一个完整的行。"""
+    with open(path, 'rb+') as f:
+        size = position = f.seek(0, os.SEEK_END)
+        while position > 0:
+            step = min(65536, position)
+            position -= step
+            f.seek(position)
+            newline = f.read(step).rfind(b"\n")
+            if newline != -1:
+                if position + newline + 1 != size:
+                    f.truncate(position + newline + 1)
+                return
+        f.truncate(0)
+
+def file_object(file_id, meta):
+    path = batch_file_path(file_id)
+    return {"id": file_id, "object": "file", "bytes": os.path.getsize(path) if os.path.exists(path) else 0,
+            "created_at": meta["created_at"], "filename": meta["filename"], "purpose": meta["purpose"]}
+
+async def validate_batch_input(path, endpoint):
+    """逐行校验输入文件，返回 (请求数, 错误列表)。custom_id 必须唯一，断点续跑依靠它识别已完成的请求。"""
+    total, errors, seen = 0, [], set()
+    line_number = 0
+    async for raw_line in iter_file_lines(path):
+        line_number += 1
+        if not raw_line.strip():
+            continue
+        try:
+            item = json.loads(raw_line)
+            custom_id = item.get("custom_id")
+            if not isinstance(custom_id, str) or not custom_id:
+                message = "缺少 custom_id。"
+            elif custom_id in seen:
+                message = f"custom_id {custom_id!r} 重复。"
+            elif item.get("url", endpoint) != endpoint:
+                message = f"url 必须为 {endpoint}。"
+            elif not isinstance(item.get("body"), dict) or not item["body"].get("messages"):
+                message = "body 中缺少 messages。"
+            else:
+                message = None
+        except (ValueError, AttributeError):
+            message = "不是有效的 JSON 对象。"
+        if message:
+            errors.append({"code": "invalid_request", "message": message, "line": line_number})
+            if len(errors) >= 100:
+                break
+            continue
+        seen.add(custom_id)
+        total += 1
+    if not total and not errors:
+        errors.append({"code": "empty_file", "message": "输入文件中没有任何请求。", "line": None})
+    return total, errors
+
+async def recover_batch_output(path):
+    """读取已写入的输出，返回 (已完成的 custom_id 集合, 成功数, 失败数)。"""
+    done, completed, failed = set(), 0, 0
+    if not os.path.exists(path):
+        return done, completed, failed
+    await asyncio.to_thread(truncate_partial_last_line, path)
+    offset, malformed_tail = 0, None # malformed_tail: 末尾连续的损坏行的起始位置
+    async for raw_line in iter_file_lines(path):
+        line_start, offset = offset, offset + len(raw_line) + 1
+        try:
+            record = json.loads(raw_line)
+            custom_id = record["custom_id"]
+        except (ValueError, TypeError, KeyError):
+            app.logger.warning("批处理输出文件 %s 在偏移 %d 处有损坏的行，已跳过，对应的请求会重新执行。", path, line_start)
+            if malformed_tail is None:
+                malformed_tail = line_start
+            continue
+        malformed_tail = None
+        done.add(custom_id)
+        if record.get("error") or (record.get("response") or {}).get("status_code", 500) >= 400:
+            failed += 1
+        else:
+            completed += 1
+    if malformed_tail is not None:
+        # 崩溃时写到一半的结果: 截断，重新执行后的结果从这里接着写
+        await asyncio.to_thread(os.truncate, path, malformed_tail)
+    return done, completed, failed
+
+async def execute_batch_item(item):
+    """
+    在后台执行一行批处理请求 (总是非流式)，返回 (输出行, 是否成功)。
+    请求与在线请求走同一条处理路径；被准入控制或熔断拒绝 (429/503/504) 时按 Retry-After 或指数退避重试。
+    """
+    body = dict(item["body"])
+    body["stream"] = False
+    for attempt in range(BATCH_ITEM_MAX_ATTEMPTS):
+        try:
+            async with app.app_context(): # jsonify() 需要应用上下文
+                result = await dispatch_chat_completion(body, {})
+            response, status_code = result if isinstance(result, tuple) else (result, result.status_code)
+            response_body = await response.get_data()
+        except Exception as e:
+            app.logger.warning("批处理请求 %s 执行出错: %s", item["custom_id"], e)
+            return {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": item["custom_id"], "response": None,
+                    "error": {"code": "internal_error", "message": str(e)}}, False
+        if status_code in (429, 503, 504) and attempt < BATCH_ITEM_MAX_ATTEMPTS - 1:
+            BATCH_STATS["requests_retried"] += 1
+            retry_after = parse_retry_after(response.headers)
+            await asyncio.sleep(retry_after if retry_after is not None else retry_backoff(attempt))
+            continue
+        break
+    try:
+        parsed_body = json.loads(response_body)
+    except ValueError:
+        parsed_body = response_body.decode('utf-8', errors='replace')
+    request_id = parsed_body.get("id") if isinstance(parsed_body, dict) else None
+    return {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": item["custom_id"],
+            "response": {"status_code": status_code, "request_id": request_id, "body": parsed_body},
+            "error": None}, status_code < 400
+
+async def run_batch(batch_id, lock_fd):
+    """
+    执行 (或继续执行) 一个批处理任务: 校验输入，跳过输出文件中已有结果的请求，以 BATCH_CONCURRENCY 为上限并发执行其余请求，
+    每完成一个请求就追加一行输出。服务关闭时停止执行并保留进度；收到取消请求时等待进行中的请求完成后结束。
+    """
+    batch_path = batch_object_path(batch_id)
+    batch = await read_json_file(batch_path)
+    counts = batch["request_counts"]
+    in_flight: set = set()
+    output = None
+    last_saved = time.monotonic()
+
+    async def save_progress(force=False):
+        nonlocal last_saved
+        if force or time.monotonic() - last_saved >= BATCH_PROGRESS_INTERVAL:
+            last_saved = time.monotonic()
+            await write_json_file(batch_path, batch)
+
+    def finish(status, **fields):
+        now = int(time.time())
+        batch.update({"status": status, f"{status}_at": now, **fields})
+        BATCH_FINISHED.add(batch_id)
+        BATCH_STATS[f"batches_{status}"] += 1
+
+    try:
+        await initialization_complete.wait()
+        await login_pending.wait()
+        input_path = batch_file_path(batch["input_file_id"])
+        if batch["status"] == "validating":
+            total, errors = await validate_batch_input(input_path, batch["endpoint"])
+            if errors:
+                app.logger.warning("批处理任务 %s 的输入文件校验失败 (%d 个错误)。", batch_id, len(errors))
+                finish("failed", errors={"object": "list", "data": errors})
+                return
+            counts["total"] = total
+            batch.update({"status": "in_progress", "in_progress_at": int(time.time())})
+            await save_progress(force=True)
+
+        output_path = batch_file_path(batch["output_file_id"])
+        done_ids, counts["completed"], counts["failed"] = await recover_batch_output(output_path)
+        app.logger.info("批处理任务 %s 开始执行 (已完成 %d/%d)。", batch_id, len(done_ids), counts["total"])
+        output = await aiofiles.open(output_path, 'ab')
+        write_lock = asyncio.Lock()
+
+        async def run_item(item):
+            try:
+                record, ok = await execute_batch_item(item)
+                async with write_lock:
+                    await output.write((json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8'))
+                    await output.flush()
+                counts["completed" if ok else "failed"] += 1
+                BATCH_STATS["requests_completed" if ok else "requests_failed"] += 1
+                await save_progress()
+            finally:
+                BATCH_SEMAPHORE.release()
+
+        cancelled = False
+        async for raw_line in iter_file_lines(input_path):
+            if not raw_line.strip():
+                continue
+            item = json.loads(raw_line)
+            if item["custom_id"] in done_ids:
+                continue
+            await BATCH_SEMAPHORE.acquire()
+            if os.path.exists(batch_cancel_marker(batch_id)):
+                BATCH_SEMAPHORE.release()
+                cancelled = True
+                batch.update({"status": "cancelling", "cancelling_at": int(time.time())})
+                await save_progress(force=True)
+                break
+            task = asyncio.create_task(run_item(item))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        if in_flight:
+            await asyncio.wait(set(in_flight))
+
+        if cancelled:
+            app.logger.info("批处理任务 %s 已取消 (完成 %d/%d)。", batch_id, counts["completed"] + counts["failed"], counts["total"])
+            finish("cancelled")
+        else:
+            batch["finalizing_at"] = int(time.time())
+            app.logger.info("批处理任务 %s 已完成: 成功 %d，失败 %d。", batch_id, counts["completed"], counts["failed"])
+            finish("completed")
+    except asyncio.CancelledError:
+        # 服务关闭: 停止执行，已完成的结果都在输出文件中，下次启动时从断点继续
+        for task in in_flight:
+            task.cancel()
+        if in_flight:
+            await asyncio.wait(set(in_flight))
+        raise
+    except Exception as e:
+        app.logger.error("批处理任务 %s 执行失败: %s", batch_id, e, exc_info=True)
+        finish("failed", errors={"object": "list", "data": [{"code": "internal_error", "message": str(e), "line": None}]})
+    finally:
+        if output is not None:
+            await output.close()
+        with contextlib.suppress(Exception):
+            await write_json_file(batch_path, batch)
+        if lock_fd is not None:
+            os.close(lock_fd)
+        BATCH_TASKS.pop(batch_id, None)
+
+def claim_batch(batch_id):
+    """在本进程中开始执行任务。多进程模式下通过文件锁保证同一任务只有一个进程在执行，进程退出时锁自动释放。"""
+    if batch_id in BATCH_TASKS:
+        return False
+    lock_fd = None
+    if fcntl is not None:
+        lock_fd = try_lock_file(os.path.join(BATCH_DIR, f"{batch_id}.lock"))
+        if lock_fd is None:
+            return False
+    BATCH_TASKS[batch_id] = asyncio.create_task(run_batch(batch_id, lock_fd))
+    return True
+
+async def batch_supervisor_loop():
+    """启动时继续未完成的任务，之后定期接手无人执行的任务 (例如执行它的进程已退出)。"""
+    while True:
+        for path in glob.glob(os.path.join(BATCH_DIR, "batch_*.json")):
+            batch_id = os.path.basename(path)[:-len(".json")]
+            if batch_id in BATCH_TASKS or batch_id in BATCH_FINISHED:
+                continue
+            try:
+                batch = await read_json_file(path)
+            except ValueError:
+                continue
+            if batch and batch.get("status") in BATCH_ACTIVE_STATUSES:
+                if claim_batch(batch_id):
+                    app.logger.info("接手未完成的批处理任务 %s (状态 %s)。", batch_id, batch["status"])
+            elif batch:
+                BATCH_FINISHED.add(batch_id)
+        await asyncio.sleep(BATCH_SCAN_INTERVAL)
+
+def start_batch_supervisor():
+    global BATCH_SUPERVISOR_TASK
+    os.makedirs(os.path.join(BATCH_DIR, "files"), exist_ok=True)
+    BATCH_SUPERVISOR_TASK = asyncio.create_task(batch_supervisor_loop())
+
+async def stop_batch_runners():
+    global BATCH_SUPERVISOR_TASK
+    tasks = list(BATCH_TASKS.values())
+    if BATCH_SUPERVISOR_TASK:
+        tasks.append(BATCH_SUPERVISOR_TASK)
+        BATCH_SUPERVISOR_TASK = None
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+@app.route('/v1/files', methods=['POST'])
+async def upload_file_endpoint():
+    """上传批处理输入文件: multipart/form-data (字段 file 与 purpose)，或直接以请求体上传 JSONL (?purpose=batch&filename=...)。"""
+    file_id = f"file-{uuid.uuid4().hex[:24]}"
+    path = batch_file_path(file_id)
+    too_large = create_openai_error_response(f"文件超过 {BATCH_MAX_FILE_BYTES} 字节的上限。", status_code=413)
+    try:
+        if request.mimetype == "multipart/form-data":
+            form, files = await request.form, await request.files
+            upload = files.get("file")
+            if upload is None:
+                return create_openai_error_response("缺少 file 字段。", status_code=400)
+            purpose, filename = form.get("purpose", "batch"), upload.filename or "input.jsonl"
+            await upload.save(path)
+            if os.path.getsize(path) > BATCH_MAX_FILE_BYTES:
+                os.remove(path)
+                return too_large
+        else:
+            purpose, filename = request.args.get("purpose", "batch"), request.args.get("filename", "input.jsonl")
+            # 分块传输的请求没有 Content-Length，边接收边计数，超过上限立即中止
+            received = 0
+            async with aiofiles.open(path, 'wb') as f:
+                async for chunk in request.body:
+                    received += len(chunk)
+                    if received > BATCH_MAX_FILE_BYTES:
+                        break
+                    await f.write(chunk)
+            if received > BATCH_MAX_FILE_BYTES:
+                os.remove(path)
+                return too_large
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path) # 不保留写了一半的文件
+        raise
+    if purpose != "batch":
+        os.remove(path)
+        return create_openai_error_response("仅支持 purpose=batch 的文件。", status_code=400)
+    meta = {"created_at": int(time.time()), "filename": filename, "purpose": purpose}
+    await write_json_file(batch_file_meta_path(file_id), meta)
+    return jsonify(file_object(file_id, meta))
+
+@app.route('/v1/files/<file_id>', methods=['GET'])
+async def get_file_endpoint(file_id):
+    meta = await read_json_file(batch_file_meta_path(file_id)) if BATCH_ID_PATTERN.match(file_id) else None
+    if meta is None:
+        return create_openai_error_response(f"文件 {file_id} 不存在。", status_code=404)
+    return jsonify(file_object(file_id, meta))
+
+@app.route('/v1/files/<file_id>/content', methods=['GET'])
+async def get_file_content_endpoint(file_id):
+    """以流的形式下载文件 (包括进行中任务的部分结果)，不会把整个文件读入内存。"""
+    path = batch_file_path(file_id)
+    if not BATCH_ID_PATTERN.match(file_id) or not os.path.exists(path):
+        return create_openai_error_response(f"文件 {file_id} 不存在。", status_code=404)
+
+    async def read_chunks():
+        async with aiofiles.open(path, 'rb') as f:
+            while chunk := await f.read(BATCH_READ_CHUNK_SIZE):
+                yield chunk
+    return Response(read_chunks(), mimetype="application/jsonl") # type: ignore
+
+async def load_batch_object(batch_id):
+    batch = await read_json_file(batch_object_path(batch_id)) if BATCH_ID_PATTERN.match(batch_id) else None
+    if batch and batch["status"] in ("validating", "in_progress") and os.path.exists(batch_cancel_marker(batch_id)):
+        batch["status"] = "cancelling" # 执行任务的进程尚未看到取消请求
+    return batch
+
+@app.route('/v1/batches', methods=['POST'])
+async def create_batch_endpoint():
+    data = await request.get_json(silent=True) or {}
+    input_file_id = data.get("input_file_id") or ""
+    endpoint = data.get("endpoint", "/v1/chat/completions")
+    if endpoint != "/v1/chat/completions":
+        return create_openai_error_response("仅支持 endpoint=/v1/chat/completions。", status_code=400)
+    if not BATCH_ID_PATTERN.match(input_file_id) or await read_json_file(batch_file_meta_path(input_file_id)) is None:
+        return create_openai_error_response(f"输入文件 {input_file_id} 不存在。", status_code=400)
+
+    batch_id = f"batch_{uuid.uuid4().hex}"
+    output_file_id = f"file-{uuid.uuid4().hex[:24]}"
+    now = int(time.time())
+    await write_json_file(batch_file_meta_path(output_file_id), {"created_at": now, "filename": f"{batch_id}_output.jsonl", "purpose": "batch_output"})
+    batch = {
+        "id": batch_id, "object": "batch", "endpoint": endpoint, "errors": None, "input_file_id": input_file_id,
+        "completion_window": data.get("completion_window", "24h"), "status": "validating",
+        "output_file_id": output_file_id, "error_file_id": None, "created_at": now, "in_progress_at": None,
+        "finalizing_at": None, "completed_at": None, "failed_at": None, "cancelling_at": None, "cancelled_at": None,
+        "request_counts": {"total": 0, "completed": 0, "failed": 0}, "metadata": data.get("metadata"),
+    }
+    await write_json_file(batch_object_path(batch_id), batch)
+    claim_batch(batch_id)
+    app.logger.info("已创建批处理任务 %s (输入文件 %s)。", batch_id, input_file_id)
+    return jsonify(batch)
+
+@app.route('/v1/batches', methods=['GET'])
+async def list_batches_endpoint():
+    limit = request.args.get("limit", 20, type=int)
+    batches = []
+    for path in glob.glob(os.path.join(BATCH_DIR, "batch_*.json")):
+        if (batch := await load_batch_object(os.path.basename(path)[:-len(".json")])) is not None:
+            batches.append(batch)
+    batches.sort(key=lambda batch: batch["created_at"], reverse=True)
+    return jsonify({"object": "list", "data": batches[:limit], "has_more": len(batches) > limit})
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+async def get_batch_endpoint(batch_id):
+    batch = await load_batch_object(batch_id)
+    if batch is None:
+        return create_openai_error_response(f"批处理任务 {batch_id} 不存在。", status_code=404)
+    return jsonify(batch)
+
+@app.route('/v1/batches/<batch_id>/cancel', methods=['POST'])
+async def cancel_batch_endpoint(batch_id):
+    """请求取消任务: 写入取消标记，执行任务的进程 (可能是其他进程) 停止提交新请求，等待进行中的请求完成后结束。"""
+    batch = await load_batch_object(batch_id)
+    if batch is None:
+        return create_openai_error_response(f"批处理任务 {batch_id} 不存在。", status_code=404)
+    if batch["status"] in ("validating", "in_progress"):
+        async with aiofiles.open(batch_cancel_marker(batch_id), 'w') as f:
+            await f.write(str(int(time.time())))
+        batch["status"] = "cancelling"
+    return jsonify(batch)
+
+# --- 响应压缩 (Compression) ---
+class StreamCompressor:
+    """流式压缩器: compress() 返回的数据已 flush 到字节边界，客户端收到后即可解压出完整的帧。"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self.compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY, lgwin=COMPRESSION_STREAM_WINDOW_BITS)
+        else:
+            self.compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + COMPRESSION_STREAM_WINDOW_BITS) # 16+: gzip 格式
+
+    def compress(self, data):
+        if self.encoding == "br":
+            return self.compressor.process(data) + self.compressor.flush()
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.finish() if self.encoding == "br" else self.compressor.flush()
+
+def compress_body(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=COMPRESSION_GZIP_LEVEL, mtime=0)
+
+async def compress_stream(body, compressor):
+    """逐帧压缩流式响应体。客户端断开时关闭原始的生成器，使其 finally 中的清理 (取消上游生成等) 照常执行。"""
+    async with body as chunks:
+        async for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            compressed = compressor.compress(chunk)
+            COMPRESSION_STATS["bytes_in"] += len(chunk)
+            COMPRESSION_STATS["bytes_out"] += len(compressed)
+            yield compressed
+    yield compressor.finish()
+
+@app.after_request
+async def compress_response(response):
+    if (not COMPRESSION_ENABLED or response.mimetype not in COMPRESSION_MIMETYPES or "Content-Encoding" in response.headers
+            or response.status_code in (204, 304) or request.method == "HEAD"):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(COMPRESSION_ENCODINGS)
+    if encoding is None:
+        return response
+    if isinstance(response.response, IterableBody):
+        response.response = IterableBody(compress_stream(response.response, StreamCompressor(encoding)))
+        response.headers.pop("Content-Length", None)
+        COMPRESSION_STATS["streams"] += 1
+    elif isinstance(response.response, DataBody):
+        data = await response.get_data()
+        if len(data) < COMPRESSION_MIN_BYTES:
+            COMPRESSION_STATS["skipped_small"] += 1
+            return response
+        if len(data) >= COMPRESSION_OFFLOAD_BYTES:
+            compressed = await asyncio.to_thread(compress_body, data, encoding)
+        else:
+            compressed = compress_body(data, encoding)
+        response.set_data(compressed)
+        COMPRESSION_STATS["bytes_in"] += len(data)
+        COMPRESSION_STATS["bytes_out"] += len(compressed)
+    else:
+        return response
+    COMPRESSION_STATS[encoding] += 1
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+def collect_runtime_gauges():
+    """抓取时计算的状态量: 队列长度、账号并发、会话池大小与 Cookie 年龄等。"""
+    now = datetime.now(timezone.utc)
+    gauges = [
+        ("vs_active_generations", "Upstream generations currently running; each holds one admission slot.", {(): ADMISSION.active}),
+        ("vs_admission_queue_depth", "Requests waiting in the admission queue.", {(): len(ADMISSION.waiters)}),
+        ("vs_archive_queue_size", "Chats waiting in the archive queue.", {(): ARCHIVE_QUEUE.qsize() if ARCHIVE_QUEUE else 0}),
+        ("vs_archive_pending", "Chats not yet archived, including retries and overflow.", {(): len(ARCHIVE_PENDING)}),
+        ("vs_response_cache_bytes", "Bytes held by the response cache.", {(): RESPONSE_CACHE.total_bytes}),
+        ("vs_sticky_sessions", "Upstream chats kept for follow-up turns.", {(): len(STICKY_SESSIONS.entries)}),
+        ("vs_circuit_breaker_state", "Upstream circuit breaker state: 0 closed, 1 half-open, 2 open.", {(): ("closed", "half_open", "open").index(UPSTREAM_BREAKER.state)}),
+        ("vs_account_inflight", "In-flight upstream requests per account.", {(account.label,): account.inflight for account in ACCOUNTS}),
+        ("vs_account_available", "Whether the account is currently routable.", {(account.label,): int(account.is_available()) for account in ACCOUNTS}),
+        ("vs_chat_pool_size", "Pre-created chat sessions per account.", {(account.label,): len(account.chat_pool) for account in ACCOUNTS}),
+        ("vs_cookie_age_seconds", "Seconds since the account cookies were last refreshed.", {(account.label,): round((now - account.last_refresh).total_seconds(), 1) for account in ACCOUNTS if account.last_refresh}),
+    ]
+    lines = []
+    for name, documentation, values in gauges:
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in values.items():
+            lines.append(f"{name}{_format_metric_labels(('account',) if labels else (), labels)} {value}")
+    for name, documentation, field in (
+        ("vs_upstream_model_ttft_ewma_seconds", "EWMA time to first token per upstream modelId.", "ttft"),
+        ("vs_upstream_model_error_rate", "EWMA error rate per upstream modelId.", "error_rate"),
+    ):
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} gauge")
+        for upstream_model, health in MODEL_ROUTER.health.items():
+            if (value := getattr(health, field)) is not None:
+                lines.append(f"{name}{_format_metric_labels(('upstream_model',), (upstream_model,))} {round(value, 4)}")
+    # 已有的统计计数器以 counter 形式导出
+    for name, documentation, stats in (
+        ("vs_chat_pool_events_total", "Chat session pool events.", CHAT_POOL_STATS),
+        ("vs_archive_events_total", "Archive queue events.", ARCHIVE_STATS),
+        ("vs_response_cache_events_total", "Response cache events.", RESPONSE_CACHE.stats),
+        ("vs_inflight_events_total", "In-flight coalescing events.", INFLIGHT_STATS),
+        ("vs_sticky_session_events_total", "Sticky conversation session events.", STICKY_SESSIONS.stats),
+        ("vs_fanout_events_total", "Parallel n>1 / multi-model requests and branches.", FANOUT_STATS),
+        ("vs_batch_events_total", "Batch API requests and batches.", BATCH_STATS),
+        ("vs_admission_events_total", "Admission control events.", ADMISSION.stats),
+        ("vs_hedge_events_total", "TTFT hedging events.", HEDGE_STATS),
+        ("vs_routing_events_total", "Model routing failovers, probes and unknown models.", ROUTING_STATS),
+        ("vs_retry_budget_events_total", "Upstream retry budget events.", RETRY_BUDGET.stats),
+        ("vs_circuit_breaker_events_total", "Upstream circuit breaker events.", UPSTREAM_BREAKER.stats),
+        ("vs_stream_events_total", "SSE heartbeat, backpressure and upstream decode error events.", STREAM_STATS),
+        ("vs_compression_events_total", "Compressed responses by encoding, compressed streams, skipped small bodies and bytes in/out.", COMPRESSION_STATS),
+        ("vs_log_events_total", "Log records dropped (queue full) or sampled out.", LOG_STATS),
+    ):
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} counter")
+        for event, value in stats.items():
+            lines.append(f'{name}{{event="{event}"}} {value}')
+    return lines
+
+@app.route('/metrics', methods=['GET'])
+async def get_metrics_endpoint():
+    lines = []
+    for metric in (METRIC_SESSION_STEP_SECONDS, METRIC_SESSION_CREATE_SECONDS, METRIC_UPSTREAM_TTFB_SECONDS, METRIC_CLIENT_TTFT_SECONDS,
+                   METRIC_GENERATION_SECONDS, METRIC_ARCHIVE_SECONDS, METRIC_LOGIN_SECONDS, METRIC_UPSTREAM_RETRIES, METRIC_ACTIVE_STREAMS,
+                   METRIC_UPSTREAM_MODEL_GENERATIONS):
+        lines.extend(metric.render())
+    lines.extend(collect_runtime_gauges())
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+@app.route('/stats', methods=['GET'])
+async def get_stats_endpoint():
+    return jsonify({
+        "accounts": [account.snapshot() for account in ACCOUNTS],
+        "chat_pool": {**CHAT_POOL_STATS, "size": sum(len(account.chat_pool) for account in ACCOUNTS), "target_size_per_account": CHAT_POOL_TARGET_SIZE},
+        "archive_queue": {**ARCHIVE_STATS, "pending": len(ARCHIVE_PENDING), "queued": ARCHIVE_QUEUE.qsize() if ARCHIVE_QUEUE else 0, "overflow": len(ARCHIVE_OVERFLOW)},
+        "response_cache": {**RESPONSE_CACHE.snapshot(), "enabled": RESPONSE_CACHE_ENABLED},
+        "inflight": {**INFLIGHT_STATS, "active": len(INFLIGHT_GENERATIONS), "enabled": INFLIGHT_COALESCE_ENABLED},
+        "fanout": {**FANOUT_STATS, "max_choices": FANOUT_MAX_CHOICES},
+        "compression": {**COMPRESSION_STATS, "enabled": COMPRESSION_ENABLED},
+        "batches": {**BATCH_STATS, "running": len(BATCH_TASKS), "concurrency": BATCH_CONCURRENCY},
+        "sticky_sessions": {**STICKY_SESSIONS.stats, "size": len(STICKY_SESSIONS.entries), "enabled": STICKY_SESSIONS_ENABLED},
+        "admission": ADMISSION.snapshot(),
+        "retry_budget": {**RETRY_BUDGET.stats, "tokens": round(RETRY_BUDGET.tokens, 2)},
+        "circuit_breaker": UPSTREAM_BREAKER.snapshot(),
+        "routing": {**ROUTING_STATS, "upstream_models": MODEL_ROUTER.snapshot()},
+        "hedging": {**HEDGE_STATS, "ttft_deadline": HEDGE_TTFT_DEADLINE, "race_models": sorted(HEDGE_RACE_MODELS)},
+        "streams": {**STREAM_STATS, "heartbeat_registered": HEARTBEAT_WHEEL.registered, "buffer_events": STREAM_BUFFER_EVENTS},
+        "logging": {**LOG_STATS, "queued": LOG_QUEUE.qsize(), "format": LOG_FORMAT},
+    })
+
 # --- Server Startup & Shutdown ---
 @app.before_serving
 async def startup():
-    global HTTP_CLIENT
-    # Initialize the global HTTP client first
-    # Cookies will be added to it by initialize() or background_login_and_setup() via login_and_get_cookies()
-    HTTP_CLIENT = httpx.AsyncClient(headers=BASE_HEADERS, timeout=DEFAULT_REQUEST_TIMEOUT, follow_redirects=True, proxies=PROXY_CONFIG)
-    app.logger.info("全局 HTTP_CLIENT 已在启动时创建。")
+    global UPSTREAM_TRANSPORT
+    # Initialize the shared connection pool first; initialize() creates one client per account on top of it.
+    # Proxy settings must be loaded before the transport is built.
+    # Cookies will be added to the clients by initialize() or background_login_and_setup() via login_and_get_cookies()
+    load_proxy_config()
+    UPSTREAM_TRANSPORT = create_upstream_transport()
+    app.logger.info("共享上游连接池已在启动时创建。")
 
     # Run the main initialization logic. This will set initialization_complete event quickly.
     # Actual login might happen in the background.
     await initialize()
+    start_worker_coordination() # 需在归档队列之前完成主进程选举
+    await start_archive_workers()
+    start_chat_pool()
+    start_batch_supervisor()
     # Log after initialize() has run, which sets initialization_complete
     app.logger.info("服务核心启动流程完成。可开始接受请求。后台任务可能仍在运行。")
 
 @app.after_serving
 async def shutdown():
-    global HTTP_CLIENT
-    if HTTP_CLIENT:
-        app.logger.info("正在关闭全局 HTTP_CLIENT...")
-        await HTTP_CLIENT.aclose()
-        HTTP_CLIENT = None
-        app.logger.info("全局 HTTP_CLIENT 已关闭。")
+    global UPSTREAM_TRANSPORT
+    await stop_batch_runners() # Progress is already on disk; unfinished batches resume on the next start
+    await stop_chat_pool()
+    STICKY_SESSIONS.clear() # Kept conversations are archived along with everything else
+    await stop_archive_workers() # Flush pending archives while the connection pool is still open
+    await HEARTBEAT_WHEEL.stop()
+    stop_worker_coordination()
+    for account in ACCOUNTS:
+        if account.refresh_task:
+            account.refresh_task.cancel()
+    if UPSTREAM_TRANSPORT:
+        app.logger.info("正在关闭共享上游连接池...")
+        await UPSTREAM_TRANSPORT.aclose()
+        UPSTREAM_TRANSPORT = None
+        app.logger.info("共享上游连接池已关闭。")
     app.logger.info("服务器已关闭。")
 
 if __name__ == "__main__":
@@ -700,7 +4025,23 @@ if __name__ == "__main__":
     # 添加这些关键配置
     config.worker_class = "asyncio"  # 确保使用asyncio工作模式
 
-    app.config['RESPONSE_TIMEOUT'] = 3600  # 设置Quart的响应超时
-    
-    # Run the app with Hypercorn asyncio server
-    asyncio.run(serve(app, config))
+    uvloop = None
+    if EVENT_LOOP == "uvloop":
+        try:
+            import uvloop
+            config.worker_class = "uvloop"
+        except ImportError:
+            app.logger.warning("EVENT_LOOP=uvloop 但未安装 uvloop (pip install uvloop)，改用默认的 asyncio 事件循环。")
+
+    if MULTI_WORKER:
+        # 工作进程以 spawn 方式启动并重新导入本模块，各自执行 startup/shutdown
+        from hypercorn.run import run as hypercorn_run
+        config.application_path = f"{os.path.abspath(__file__)}:app"
+        config.workers = WORKERS
+        app.logger.info(f"以多进程模式启动: {WORKERS} 个工作进程 ({config.worker_class})。")
+        sys.exit(hypercorn_run(config))
+    elif uvloop:
+        uvloop.run(serve(app, config))
+    else:
+        # Run the app with Hypercorn asyncio server
+        asyncio.run(serve(app, config))
@@ -0,0 +1,146 @@
+"""
+历史记录预算微基准: 对比旧的 len() 截断实现与 app.build_prompt_with_history_and_instructions。
+
+用法:
+    python bench/bench_history_budget.py [--messages 1000]
+
+模拟一个不断增长的多轮对话: 第 n 轮提交前 n 条消息，分别测量
+旧实现、新实现 (冷缓存) 与新实现 (多轮对话中的热缓存) 每轮的耗时，
+并输出 heuristic 估算器在英文/中文样本上与 len() 的差异。
+
+与线上一样，每轮的消息内容都是新的字符串对象 (线上每个请求重新解析 JSON)，
+因此 Python 缓存在字符串对象上的哈希值不会让热缓存显得更快: 每轮仍要对每条保留的消息计算哈希，
+热缓存省下的只是估算器本身的开销。
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from app import build_prompt_with_history_and_instructions, estimate_tokens_heuristic, TOKEN_COUNT_CACHE  # noqa: E402
+
+MODEL = "gpt-4o"
+
+ENGLISH = "The quick brown fox jumps over the lazy dog while the proxy streams tokens back to the client. "
+CHINESE = "这是一段用于测试历史记录截断的中文文本，包含标点符号和常见词汇。"
+CODE = "def handler(request):\n    return {\"status\": \"ok\", \"items\": [1, 2, 3]}\n"
+
+
+def make_history(count):
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    samples = (ENGLISH * 8, CHINESE * 6, CODE * 5)
+    for i in range(count):
+        role = "user" if i % 2 == 0 else "assistant"
+        messages.append({"role": role, "content": f"[{i}] " + samples[i % len(samples)]})
+    return messages
+
+
+# --- 旧实现 (逐字复制自重构前的 app.py，去掉日志) ---
+def legacy_build_prompt(messages_array, max_history_tokens=100000):
+    system_prompts, history_messages = [], []
+    for message in messages_array:
+        role = message.get("role", "user").lower()
+        content = message.get("content", "")
+        if not isinstance(content, str):
+            continue
+        content = content.strip()
+        if not content:
+            continue
+        if role == "system":
+            system_prompts.append(content)
+        else:
+            history_messages.append({"role": role, "content": content})
+    system_prompt_content = "\n\n".join(system_prompts)
+    final_history_parts, current_token_count = [], 0
+    for message in reversed(history_messages):
+        role, content = message["role"], message["content"]
+        part_str = ""
+        if role in ["user", "human"]:
+            part_str = f"\n\nHuman: {content}"
+        elif role in ["assistant", "ai"]:
+            part_str = f"\n\nAssistant: {content}"
+        part_token_count = len(part_str)
+        if current_token_count + part_token_count > max_history_tokens:
+            break
+        final_history_parts.append(part_str)
+        current_token_count += part_token_count
+    formatted_history = "".join(reversed(final_history_parts)).strip()
+    final_prompt_elements = []
+    if formatted_history:
+        final_prompt_elements.append(formatted_history)
+    final_prompt_elements.append("\n\nAssistant:")
+    return system_prompt_content, "".join(final_prompt_elements)
+
+
+def fresh_copy(messages):
+    """模拟重新解析的请求体: 内容相同、但字符串对象是新的 (没有缓存的哈希值)。"""
+    return [{"role": message["role"], "content": (message["content"] + " ")[:-1]} for message in messages]
+
+
+def run_conversation(build, history, turns):
+    requests = [fresh_copy(history[:n + 1]) for n in turns]
+    start = time.perf_counter()
+    for messages in requests:
+        build(messages)
+    return (time.perf_counter() - start) / len(turns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000, help="对话的消息数")
+    parser.add_argument("--turns", type=int, default=50, help="计时的轮数 (取对话末尾的若干轮)")
+    args = parser.parse_args()
+
+    app.app.logger.disabled = True # 截断日志会淹没输出
+    history = make_history(args.messages)
+    turns = list(range(args.messages - args.turns + 1, args.messages + 1))
+
+    legacy = run_conversation(legacy_build_prompt, history, turns)
+
+    def build_cold(messages):
+        TOKEN_COUNT_CACHE.clear()
+        return build_prompt_with_history_and_instructions(messages, MODEL)
+    cold = run_conversation(build_cold, history, turns)
+
+    TOKEN_COUNT_CACHE.clear()
+    build_prompt_with_history_and_instructions(history[:turns[0]], MODEL) # 前面的轮次已经计算过的消息
+    warm = run_conversation(lambda messages: build_prompt_with_history_and_instructions(messages, MODEL), history, turns)
+
+    # 新预算保留的历史更多，用同样的保留字符数再测一次旧实现，便于按相同工作量比较
+    _, new_prompt = build_prompt_with_history_and_instructions(history, MODEL)
+    legacy_same = run_conversation(lambda messages: legacy_build_prompt(messages, len(new_prompt)), history, turns)
+
+    print(f"{args.messages} 条消息，计时最后 {args.turns} 轮:")
+    print(f"{'legacy len()':<34} {legacy * 1e3:8.3f} ms/turn")
+    print(f"{'legacy len() (same kept chars)':<34} {legacy_same * 1e3:8.3f} ms/turn")
+    print(f"{'token budget (cold cache)':<34} {cold * 1e3:8.3f} ms/turn")
+    print(f"{'token budget (warm cache)':<34} {warm * 1e3:8.3f} ms/turn")
+
+    tiktoken_estimator = app.load_tiktoken_estimator()
+    if tiktoken_estimator is not None:
+        app.register_token_estimator("tiktoken", tiktoken_estimator)
+        app.TOKEN_ESTIMATOR = "tiktoken"
+        tiktoken_cold = run_conversation(build_cold, history, turns)
+        build_prompt_with_history_and_instructions(history[:turns[0]], MODEL)
+        tiktoken_warm = run_conversation(lambda messages: build_prompt_with_history_and_instructions(messages, MODEL), history, turns)
+        app.TOKEN_ESTIMATOR = "heuristic"
+        TOKEN_COUNT_CACHE.clear()
+        print(f"{'tiktoken (cold cache)':<34} {tiktoken_cold * 1e3:8.3f} ms/turn")
+        print(f"{'tiktoken (warm cache)':<34} {tiktoken_warm * 1e3:8.3f} ms/turn")
+    else:
+        print("(未安装 tiktoken，跳过精确估算器的对比)")
+
+    print("\nheuristic 估算器与 len() 的对比 (每个样本重复 100 次):")
+    for name, sample in (("英文", ENGLISH), ("中文", CHINESE), ("代码", CODE)):
+        text = sample * 100
+        print(f"{name:<4} len()={len(text):>6}  heuristic={estimate_tokens_heuristic(text):>6}")
+
+    _, legacy_prompt = legacy_build_prompt(history)
+    print(f"\n完整历史保留的字符数: legacy={len(legacy_prompt)}  token budget={len(new_prompt)} (预算 {app.get_history_budget(MODEL)} tokens)")
+
+
+if __name__ == "__main__":
+    main()
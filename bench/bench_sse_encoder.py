@@ -0,0 +1,95 @@
+"""
+SSE chunk 编码器微基准: 对比旧的逐 token json.dumps 整个 chunk 的实现与 app.SSEChunkEncoder。
+
+用法:
+    python bench/bench_sse_encoder.py [--tokens 200000]
+
+先校验两种实现的输出逐字节一致，再分别计时。
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import SSEChunkEncoder  # noqa: E402
+
+MODEL = "claude-4-sonnet-thinking"
+MESSAGE_ID = "chatcmpl-0123456789abcdef0123456789abcdef"
+CREATED = 1750000000
+
+# 贴近真实流的 token 样本: 英文、中文、转义字符、代码片段
+SAMPLE_TOKENS = [
+    "Hello", " world", ",", " the", " quick", " brown", " fox", "\n\n",
+    "你好", "，世界", "。", "思考", "中", "...",
+    "def", " main", "():", "\n    ", "return", ' "ok"', "\t", "\\", "😀",
+]
+
+
+# --- 旧实现 (逐字复制自重构前的 app.py，created 固定以便逐字节比较) ---
+def legacy_stream_response(content_chunk, model, message_id):
+    chunk_data = {"id": message_id, "object": "chat.completion.chunk", "created": CREATED, "model": model,
+                  "choices": [{"delta": {"content": content_chunk}, "index": 0, "finish_reason": None}]}
+    return f"data: {json.dumps(chunk_data)}\n\n"
+
+
+def legacy_stream_reasoning_response(reasoning_chunk, model, message_id):
+    chunk_data = {"id": message_id, "object": "chat.completion.chunk", "created": CREATED, "model": model,
+                  "choices": [{"delta": {"reasoning_content": reasoning_chunk}, "index": 0, "finish_reason": None}]}
+    return f"data: {json.dumps(chunk_data)}\n\n"
+
+
+def legacy_stream_done(model, message_id, usage=None):
+    done_data = {"id": message_id, "object": "chat.completion.chunk", "created": CREATED, "model": model,
+                 "choices": [{"delta": {}, "index": 0, "finish_reason": "stop"}]}
+    if usage:
+        done_data['usage'] = usage
+    return f"data: {json.dumps(done_data)}\n\n"
+
+
+def check_byte_compatibility():
+    encoder = SSEChunkEncoder(MODEL, MESSAGE_ID, created=CREATED)
+    for token in SAMPLE_TOKENS + ["", "a" * 4096, "  \x00\x1f"]:
+        assert encoder.content(token) == legacy_stream_response(token, MODEL, MESSAGE_ID).encode('utf-8'), token
+        assert encoder.reasoning(token) == legacy_stream_reasoning_response(token, MODEL, MESSAGE_ID).encode('utf-8'), token
+    usage = {"prompt_tokens": 12, "completion_tokens": 34, "total_tokens": 46}
+    assert encoder.done(usage) == legacy_stream_done(MODEL, MESSAGE_ID, usage).encode('utf-8')
+    assert encoder.done() == legacy_stream_done(MODEL, MESSAGE_ID).encode('utf-8')
+
+
+def run_legacy(tokens):
+    for token in tokens:
+        # 旧实现每个 token 还会调用一次 time.time()
+        time.time()
+        legacy_stream_response(token, MODEL, MESSAGE_ID).encode('utf-8')
+
+
+def run_encoder(tokens):
+    encoder = SSEChunkEncoder(MODEL, MESSAGE_ID)
+    for token in tokens:
+        encoder.content(token)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=200000, help="每轮编码的 token 数")
+    parser.add_argument("--repeat", type=int, default=5, help="重复轮数，取最好成绩")
+    args = parser.parse_args()
+
+    check_byte_compatibility()
+    print("字节兼容性校验通过。")
+
+    tokens = [SAMPLE_TOKENS[i % len(SAMPLE_TOKENS)] for i in range(args.tokens)]
+    results = {}
+    for name, func in (("legacy json.dumps", run_legacy), ("SSEChunkEncoder", run_encoder)):
+        best = min(timeit.repeat(lambda: func(tokens), number=1, repeat=args.repeat))
+        results[name] = best
+        print(f"{name:<20} {best * 1e9 / args.tokens:8.1f} ns/token  ({args.tokens / best:,.0f} tokens/s)")
+    print(f"加速比: {results['legacy json.dumps'] / results['SSEChunkEncoder']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+上游数据流解码器的模糊测试与吞吐量基准: 对比旧的 aiter_lines() + 逐行 json.loads 路径与 app.UpstreamStreamDecoder。
+
+用法:
+    python bench/bench_stream_decoder.py [--iterations 2000] [--megabytes 8] [transcript ...]
+
+默认使用 bench/transcripts/ 下录制的上游响应 (纯文本/中英混合、含转义的代码、CRLF 与非对话行)。
+模糊测试:
+  1. 把每个录制的响应随机切成大小不一的块 (可能切在多字节 UTF-8 字符中间)，解码结果必须与旧路径完全一致；
+  2. 随机破坏字节后，解码器不能抛出异常，且结果与切块方式无关。
+吞吐量: 把响应重复到指定大小，按不同的块大小分别测量两条路径的 MB/s 与 events/s。
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import time
+
+from httpx._decoders import LineDecoder, TextDecoder
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+from app import UpstreamStreamDecoder  # noqa: E402
+
+TRANSCRIPT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transcripts")
+
+
+# --- 旧实现 (逐字复制自重构前的 app.py) ---
+def parse_upstream_line(line):
+    if line.startswith("0:"):
+        return "content", json.loads(line[2:])
+    if line.startswith("g:"):
+        return "reasoning", json.loads(line[2:])
+    if line.startswith("e:") or line.startswith("d:"):
+        json_data_str = line[2:]
+        usage = json.loads(json_data_str).get("usage") if json_data_str else None
+        return "finish", usage
+    return None
+
+
+def legacy_decode(chunks):
+    """与 response.aiter_lines() 相同的文本解码与分行，然后逐行解析。"""
+    text_decoder, line_decoder, events = TextDecoder("utf-8"), LineDecoder(), []
+
+    def parse_lines(lines):
+        for line in lines:
+            try:
+                event = parse_upstream_line(line)
+            except Exception:
+                continue
+            if event is not None:
+                events.append(event)
+
+    for chunk in chunks:
+        parse_lines(line_decoder.decode(text_decoder.decode(chunk)))
+    parse_lines(line_decoder.decode(text_decoder.flush()))
+    parse_lines(line_decoder.flush())
+    return events
+
+
+def new_decode(chunks):
+    decoder, events = UpstreamStreamDecoder(), []
+    for chunk in chunks:
+        events.extend(decoder.feed(chunk))
+    events.extend(decoder.flush())
+    return events
+
+
+def random_chunks(data, rng, max_size=64):
+    chunks, position = [], 0
+    while position < len(data):
+        size = rng.choice((1, 2, 3, rng.randint(1, max_size), rng.randint(1, 4096)))
+        chunks.append(data[position:position + size])
+        position += size
+    return chunks
+
+
+def corrupt(data, rng):
+    data = bytearray(data)
+    for _ in range(rng.randint(1, 8)):
+        position = rng.randrange(len(data))
+        data[position] = rng.choice((rng.randrange(256), ord("\n"), ord('"'), ord("\\"), 0xE4))
+    return bytes(data)
+
+
+def fuzz(transcripts, iterations, rng):
+    failures = 0
+    for name, data in transcripts.items():
+        expected = legacy_decode([data])
+        assert expected, f"{name}: 旧路径没有解析出任何事件"
+        for _ in range(iterations):
+            chunks = random_chunks(data, rng)
+            if new_decode(chunks) != expected:
+                failures += 1
+                print(f"不一致: {name}, 切块大小 {[len(chunk) for chunk in chunks][:20]}...")
+                break
+        for _ in range(iterations // 4):
+            damaged = corrupt(data, rng)
+            whole = new_decode([damaged])
+            if new_decode(random_chunks(damaged, rng)) != whole:
+                failures += 1
+                print(f"破坏后的结果依赖切块方式: {name}")
+                break
+        print(f"{name:<28} {len(expected):>5} events  ok" if not failures else f"{name:<28} FAILED")
+    return failures
+
+
+def throughput(decode, data, chunk_size, rounds):
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    best, events = float("inf"), 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        events = len(decode(chunks))
+        best = min(best, time.perf_counter() - start)
+    return len(data) / best / 1e6, events / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("transcripts", nargs="*", help="录制的上游响应文件，默认为 bench/transcripts/*.txt")
+    parser.add_argument("--iterations", type=int, default=2000, help="每个响应的随机切块次数")
+    parser.add_argument("--megabytes", type=float, default=8, help="吞吐量测试的数据量")
+    parser.add_argument("--rounds", type=int, default=3, help="吞吐量测试取最好成绩的轮数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app.app.logger.disabled = True # 破坏后的数据会产生大量解析警告
+    paths = args.transcripts or sorted(glob.glob(os.path.join(TRANSCRIPT_DIR, "*.txt")))
+    transcripts = {}
+    for path in paths:
+        with open(path, "rb") as f:
+            transcripts[os.path.basename(path)] = f.read()
+
+    print("模糊测试:")
+    failures = fuzz(transcripts, args.iterations, random.Random(args.seed))
+
+    corpus = b"".join(data if data.endswith(b"\n") else data + b"\n" for data in transcripts.values())
+    data = corpus * max(1, int(args.megabytes * 1e6 / len(corpus)))
+    print(f"\n吞吐量 ({len(data) / 1e6:.1f} MB):")
+    print(f"{'chunk':>7} {'legacy MB/s':>12} {'decoder MB/s':>13} {'legacy ev/s':>12} {'decoder ev/s':>13} {'speedup':>8}")
+    for chunk_size in (64, 1024, 16384, 65536):
+        legacy_mb, legacy_events = throughput(legacy_decode, data, chunk_size, args.rounds)
+        new_mb, new_events = throughput(new_decode, data, chunk_size, args.rounds)
+        print(f"{chunk_size:>7} {legacy_mb:>12.1f} {new_mb:>13.1f} {legacy_events:>12.0f} {new_events:>13.0f} {new_mb / legacy_mb:>7.2f}x")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+"""
+/v1/chat/completions 压测工具: 以固定并发驱动代理，统计 TTFT p50/p99、tokens/s、req/s 以及代理进程的 RSS 与 CPU，
+输出机器可读的 JSON 报告，便于在不同版本之间对比。
+
+用法:
+    # 自动启动本地模拟上游与代理 (使用临时数据目录，不会读写真实的 Cookie)，依次压测流式与非流式
+    python bench/load_test.py --spawn --concurrency 32 --requests 500 --output report.json
+
+    # 压测一个已在运行的代理，并采样其进程资源占用
+    python bench/load_test.py --url http://127.0.0.1:7860 --pid 12345 --mode stream
+
+    # 与之前的报告对比
+    python bench/load_test.py --spawn --output new.json --compare old.json
+
+--spawn 模式下，--mock-arg 会原样传给 bench/mock_upstream.py (例如 --mock-arg=--token-rate=500)，
+--proxy-env 会设置代理的环境变量 (例如 --proxy-env SSE_COALESCE_ENABLED=true)。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    """最近秩百分位数; 输入需已排序。"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize_ms(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        "p50": round(percentile(ordered, 0.50) * 1000, 2),
+        "p90": round(percentile(ordered, 0.90) * 1000, 2),
+        "p99": round(percentile(ordered, 0.99) * 1000, 2),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 2),
+        "max": round(ordered[-1] * 1000, 2),
+    }
+
+
+def usage_completion_tokens(usage):
+    if not isinstance(usage, dict):
+        return None
+    return usage.get("completion_tokens", usage.get("completionTokens"))
+
+
+# --- 进程资源采样 (Linux /proc) ---
+class ProcessSampler:
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.rss_samples = []
+        self.cpu_start = None
+        self.cpu_end = None
+        self.task = None
+        self.clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def available(self):
+        return self.pid is not None and os.path.exists(f"/proc/{self.pid}/stat")
+
+    def read_cpu_seconds(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        # utime 与 stime 是 stat 的第 14、15 个字段 (去掉 pid 与 comm 后的第 12、13 个)
+        return (int(fields[11]) + int(fields[12])) / self.clock_ticks
+
+    def read_rss_mb(self):
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+        return None
+
+    async def _run(self):
+        while True:
+            rss = self.read_rss_mb()
+            if rss is not None:
+                self.rss_samples.append(rss)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if not self.available():
+            return
+        self.cpu_start = self.read_cpu_seconds()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self, elapsed):
+        if self.task is None:
+            return None
+        self.task.cancel()
+        self.cpu_end = self.read_cpu_seconds()
+        cpu_seconds = self.cpu_end - self.cpu_start
+        return {
+            "cpu_seconds": round(cpu_seconds, 3),
+            "cpu_percent": round(cpu_seconds / elapsed * 100, 1) if elapsed else None,
+            "rss_mb_peak": round(max(self.rss_samples), 1) if self.rss_samples else None,
+            "rss_mb_avg": round(sum(self.rss_samples) / len(self.rss_samples), 1) if self.rss_samples else None,
+        }
+
+
+# --- 单个请求 ---
+async def run_request(client, url, body, stream):
+    started = time.perf_counter()
+    result = {"status": None, "ttft": None, "latency": None, "tokens": 0, "error": None}
+    try:
+        if stream:
+            frames, usage_tokens = 0, None
+            async with client.stream("POST", url, json=body) as response:
+                result["status"] = response.status_code
+                if response.status_code != 200:
+                    await response.aread()
+                    return result
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    chunk = json.loads(line[5:])
+                    if "error" in chunk:
+                        result["error"] = chunk["error"].get("message")
+                        continue
+                    delta = chunk["choices"][0]["delta"]
+                    if delta.get("content") or delta.get("reasoning_content"):
+                        frames += 1
+                        if result["ttft"] is None:
+                            result["ttft"] = time.perf_counter() - started
+                    if "usage" in chunk:
+                        usage_tokens = usage_completion_tokens(chunk["usage"])
+            # 开启 SSE 合并后帧数少于 token 数，优先使用 usage 中的 token 数
+            result["tokens"] = usage_tokens if usage_tokens is not None else frames
+        else:
+            response = await client.post(url, json=body)
+            result["status"] = response.status_code
+            if response.status_code == 200:
+                data = response.json()
+                content = data["choices"][0]["message"]["content"]
+                usage_tokens = usage_completion_tokens(data.get("usage"))
+                result["tokens"] = usage_tokens if usage_tokens else len(content.split())
+                result["ttft"] = time.perf_counter() - started # 非流式请求的首字节即完整响应
+    except (httpx.HTTPError, json.JSONDecodeError, KeyError) as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        result["latency"] = time.perf_counter() - started
+    return result
+
+
+# --- 一个压测场景 ---
+async def run_scenario(args, base_url, stream, pid):
+    url = f"{base_url}/v1/chat/completions"
+    filler = ("Please summarize the following text. " * max(1, args.prompt_words // 6)).strip()
+    counter = iter(range(10 ** 12))
+    results = []
+    deadline = time.perf_counter() + args.duration if args.duration else None
+
+    def next_body():
+        index = next(counter)
+        if args.requests and index >= args.requests:
+            return None
+        if deadline and time.perf_counter() >= deadline:
+            return None
+        # 默认每个请求的提示词都不同，避免被响应缓存或进行中请求合并吸收
+        suffix = "" if args.identical_prompts else f" [request {index}]"
+        return {"model": args.model, "stream": stream, "temperature": 0,
+                "messages": [{"role": "user", "content": filler + suffix}]}
+
+    async def worker(client):
+        while (body := next_body()) is not None:
+            results.append(await run_request(client, url, body, stream))
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(args.timeout), limits=limits) as client:
+        sampler = ProcessSampler(pid)
+        started = time.perf_counter()
+        sampler.start()
+        await asyncio.gather(*(worker(client) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        process = await sampler.stop(elapsed)
+
+    ok = [r for r in results if r["status"] == 200 and not r["error"]]
+    statuses: dict = {}
+    for r in results:
+        key = str(r["status"]) if r["status"] is not None else "transport_error"
+        if r["status"] == 200 and r["error"]:
+            key = "stream_error"
+        statuses[key] = statuses.get(key, 0) + 1
+    total_tokens = sum(r["tokens"] for r in ok)
+    return {
+        "mode": "stream" if stream else "non_stream",
+        "concurrency": args.concurrency,
+        "requests": len(results),
+        "ok": len(ok),
+        "statuses": statuses,
+        "duration_s": round(elapsed, 3),
+        "req_per_s": round(len(ok) / elapsed, 2) if elapsed else None,
+        "tokens_per_s": round(total_tokens / elapsed, 1) if elapsed else None,
+        "ttft_ms": summarize_ms([r["ttft"] for r in ok if r["ttft"] is not None]) if stream else None,
+        "latency_ms": summarize_ms([r["latency"] for r in ok]),
+        "process": process,
+    }
+
+
+# --- 启动模拟上游与代理 ---
+async def wait_until_ready(url, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2.0) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} 在 {timeout}s 内未就绪")
+
+
+def spawn_processes(args, data_dir):
+    mock_port, proxy_port = free_port(), free_port()
+    log = open(os.path.join(data_dir, "processes.log"), "w")
+    mock = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "mock_upstream.py"), "--port", str(mock_port), *args.mock_arg],
+                            stdout=log, stderr=subprocess.STDOUT)
+    env = {**os.environ, "VS_BASE_URL": f"http://127.0.0.1:{mock_port}", "VS_DATA_DIR": data_dir,
+           "VS_EMAIL": "bench@example.com", "VS_PASSWORD": "bench", "PORT": str(proxy_port)}
+    env.pop("VS_ACCOUNTS", None)
+    env.pop("PROXY", None)
+    for item in args.proxy_env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    # cwd 设为临时目录，避免代理加载仓库中的 .env
+    proxy = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "app.py")], cwd=data_dir, env=env,
+                             stdout=log, stderr=subprocess.STDOUT)
+    return mock, proxy, mock_port, proxy_port
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten_numbers(data, prefix=""):
+    flat = {}
+    if isinstance(data, dict):
+        for key, value in data.items():
+            flat.update(flatten_numbers(value, f"{prefix}.{key}" if prefix else key))
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        flat[prefix] = data
+    return flat
+
+
+def print_comparison(baseline, current):
+    old, new = flatten_numbers(baseline["scenarios"]), flatten_numbers(current["scenarios"])
+    print(f"\n对比 {baseline['meta'].get('git_commit')} -> {current['meta'].get('git_commit')}:")
+    for key in sorted(set(old) & set(new)):
+        if old[key] == new[key]:
+            continue
+        change = f"{(new[key] - old[key]) / old[key] * 100:+.1f}%" if old[key] else "n/a"
+        print(f"  {key:<40} {old[key]:>12} -> {new[key]:>12}  ({change})")
+
+
+async def main_async(args):
+    modes = {"stream": [True], "non-stream": [False], "both": [True, False]}[args.mode]
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "scenarios": {},
+    }
+
+    mock = proxy = None
+    with tempfile.TemporaryDirectory(prefix="vs-bench-") as data_dir:
+        try:
+            if args.spawn:
+                mock, proxy, mock_port, proxy_port = spawn_processes(args, data_dir)
+                base_url, pid = f"http://127.0.0.1:{proxy_port}", proxy.pid
+                await wait_until_ready(f"http://127.0.0.1:{mock_port}/_stats")
+                await wait_until_ready(f"{base_url}/v1/models")
+            else:
+                base_url, pid = args.url.rstrip("/"), args.pid
+
+            # 预热: 完成登录并填充会话池，不计入结果
+            async with httpx.AsyncClient(timeout=args.timeout) as client:
+                body = {"model": args.model, "messages": [{"role": "user", "content": "warmup"}]}
+                for _ in range(args.warmup):
+                    await client.post(f"{base_url}/v1/chat/completions", json=body)
+
+            for stream in modes:
+                scenario = await run_scenario(args, base_url, stream, pid)
+                report["scenarios"][scenario["mode"]] = scenario
+                print(json.dumps(scenario, ensure_ascii=False, indent=2))
+        finally:
+            for process in (proxy, mock):
+                if process is not None:
+                    process.terminate()
+                    try:
+                        process.wait(timeout=10)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+        print(f"报告已写入 {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:7860", help="已在运行的代理地址 (未使用 --spawn 时)")
+    parser.add_argument("--pid", type=int, default=None, help="要采样 RSS/CPU 的代理进程 PID (未使用 --spawn 时)")
+    parser.add_argument("--spawn", action="store_true", help="自动启动本地模拟上游与代理")
+    parser.add_argument("--mock-arg", action="append", default=[], help="传给 mock_upstream.py 的参数，可重复")
+    parser.add_argument("--proxy-env", action="append", default=[], help="代理的环境变量 KEY=VALUE，可重复")
+    parser.add_argument("--mode", choices=["stream", "non-stream", "both"], default="both")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200, help="每个场景的请求总数 (0 表示只按 --duration 限制)")
+    parser.add_argument("--duration", type=float, default=0, help="每个场景的最长时间 (秒)，0 表示不限制")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--prompt-words", type=int, default=200, help="提示词的大致单词数")
+    parser.add_argument("--identical-prompts", action="store_true", help="所有请求使用相同的提示词 (用于测试缓存与请求合并)")
+    parser.add_argument("--warmup", type=int, default=2, help="正式计时前的预热请求数")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", help="JSON 报告的输出路径")
+    parser.add_argument("--compare", help="用于对比的旧报告")
+    args = parser.parse_args()
+    if not args.requests and not args.duration:
+        parser.error("--requests 与 --duration 至少需要设置一个")
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""
+本地模拟的 Vertical Studio 上游，用于离线压测与回归测试，不会访问 app.verticalstudio.ai。
+
+实现了代理用到的全部接口: 登录 (login / login-password.data)、stream 预热、stream.data、
+corner 重定向 (返回带 Chat ID 的 Location)、/api/chat 行协议 (f:/g:/0:/e:/d:) 以及归档接口。
+
+用法:
+    python bench/mock_upstream.py --port 18080 --token-rate 200 --tokens 256
+    VS_BASE_URL=http://127.0.0.1:18080 VS_EMAIL=bench@example.com VS_PASSWORD=x python app.py
+
+可配置延迟、token 速率、错误注入、卡住的会话与 Cookie 过期 (401)。控制接口:
+    GET /_stats            各接口调用次数 (JSON)
+    GET /_expire           立即使所有已签发的 auth-token 失效
+    GET /_config?k=v       运行时修改配置项 (与命令行参数同名，横线换成下划线)
+    GET /_model?id=m&k=v   只对 settings.modelId 为 m 的对话覆盖配置项 (例如模拟某个模型全部出错或首 token 很慢)
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from quart import Quart, Response, make_response, request
+
+app = Quart(__name__)
+
+CONFIG = {
+    "latency": 0.01,             # 登录、会话创建、归档等普通接口的延迟 (秒)
+    "first_token_latency": 0.05, # /api/chat 返回第一个 token 之前的延迟 (秒)
+    "token_rate": 200.0,         # 每秒输出的 token 数，0 表示不限速
+    "tokens": 128,               # 每个回答的正文 token 数
+    "reasoning_tokens": 16,      # 每个回答的思考 token 数 (g: 行)
+    "error_rate": 0.0,           # /api/chat 返回 500 的概率
+    "rate_limit_rate": 0.0,      # /api/chat 返回 429 的概率
+    "disconnect_rate": 0.0,      # /api/chat 在输出一半时断开连接的概率
+    "stall_rate": 0.0,           # /api/chat 建立连接后迟迟不输出第一个 token 的概率
+    "stall_duration": 300.0,     # 卡住的会话在输出第一个 token 之前等待的时间 (秒)
+    "token_ttl": 0.0,            # auth-token 签发后多久过期 (秒)，0 表示不过期
+}
+
+MODEL_CONFIG: dict = {} # modelId -> 覆盖的配置项
+TOKENS: dict = {} # auth-token -> 签发时间
+CHAT_TURNS: dict = {} # chat ID -> 已收到的消息数
+STATS = {"login": 0, "stream": 0, "stream_data": 0, "corner": 0, "chat": 0, "chat_500": 0, "chat_429": 0,
+         "chat_disconnect": 0, "chat_stall": 0, "unauthorized": 0, "archive": 0,
+         "chat_continued": 0, "prompt_chars": 0, "models": {}}
+
+SAMPLE_WORDS = ["Hello", " world", ",", " the", " quick", " brown", " fox", "\n", "你好", "世界", "。", "代码", " def", " main", "():"]
+
+
+def is_authorized():
+    issued_at = TOKENS.get(request.cookies.get("auth-token", ""))
+    if issued_at is None:
+        return False
+    if CONFIG["token_ttl"] and time.monotonic() - issued_at > CONFIG["token_ttl"]:
+        return False
+    return True
+
+
+def unauthorized():
+    STATS["unauthorized"] += 1
+    return "unauthorized", 401
+
+
+@app.route("/login")
+async def login_page():
+    await asyncio.sleep(CONFIG["latency"])
+    return "ok"
+
+
+@app.route("/login-password.data", methods=["GET", "POST"])
+async def login_password():
+    await asyncio.sleep(CONFIG["latency"])
+    if request.method == "GET":
+        return "ok"
+    STATS["login"] += 1
+    form = await request.form
+    if not form.get("email") or not form.get("password"):
+        return "missing credentials", 400
+    token = uuid.uuid4().hex
+    TOKENS[token] = time.monotonic()
+    response = await make_response("ok")
+    response.set_cookie("auth-token", token)
+    return response
+
+
+@app.route("/stream")
+async def stream_page():
+    await asyncio.sleep(CONFIG["latency"])
+    STATS["stream"] += 1
+    return "ok" if is_authorized() else unauthorized()
+
+
+@app.route("/stream.data", methods=["POST"])
+async def stream_data():
+    await asyncio.sleep(CONFIG["latency"])
+    STATS["stream_data"] += 1
+    return "ok" if is_authorized() else unauthorized()
+
+
+@app.route("/stream/corners/<corner_type>.data")
+async def corner_data(corner_type):
+    await asyncio.sleep(CONFIG["latency"])
+    STATS["corner"] += 1
+    if not is_authorized():
+        return unauthorized()
+    return "", 302, {"Location": f"/stream/corners/{corner_type}/{uuid.uuid4()}"}
+
+
+@app.route("/api/chat", methods=["POST"])
+async def chat():
+    if not is_authorized():
+        return unauthorized()
+    body = await request.get_json()
+    model_id = body.get("settings", {}).get("modelId")
+    STATS["models"][model_id] = STATS["models"].get(model_id, 0) + 1
+    config = {**CONFIG, **MODEL_CONFIG.get(model_id, {})}
+    roll = random.random()
+    if roll < config["error_rate"]:
+        STATS["chat_500"] += 1
+        return "internal error", 500
+    if roll < config["error_rate"] + config["rate_limit_rate"]:
+        STATS["chat_429"] += 1
+        return "slow down", 429, {"Retry-After": "1"}
+    STATS["chat"] += 1
+    chat_id = body.get("chatId")
+    if CHAT_TURNS.get(chat_id):
+        STATS["chat_continued"] += 1 # 在已有会话上继续的对话
+    CHAT_TURNS[chat_id] = CHAT_TURNS.get(chat_id, 0) + 1
+    STATS["prompt_chars"] += len(body.get("message", {}).get("content", ""))
+
+    tokens, reasoning_tokens = int(config["tokens"]), int(config["reasoning_tokens"])
+    interval = 1.0 / config["token_rate"] if config["token_rate"] else 0.0
+    disconnect_at = tokens // 2 if random.random() < config["disconnect_rate"] else None
+    stalled = random.random() < config["stall_rate"]
+    if stalled:
+        STATS["chat_stall"] += 1
+
+    async def generate():
+        await asyncio.sleep(config["stall_duration"] if stalled else config["first_token_latency"])
+        yield f'f:{{"messageId":"msg-{uuid.uuid4().hex[:16]}"}}\n'.encode()
+        started = time.monotonic()
+        for i in range(reasoning_tokens + tokens):
+            if interval:
+                # 按绝对时间排程，避免 sleep 误差累积导致速率偏低
+                delay = started + (i + 1) * interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if disconnect_at is not None and i - reasoning_tokens == disconnect_at:
+                STATS["chat_disconnect"] += 1
+                raise ConnectionError("injected disconnect")
+            prefix = "g:" if i < reasoning_tokens else "0:"
+            yield (prefix + json.dumps(SAMPLE_WORDS[i % len(SAMPLE_WORDS)]) + "\n").encode()
+        usage = {"promptTokens": 32, "completionTokens": tokens}
+        yield ('e:' + json.dumps({"finishReason": "stop", "usage": usage, "isContinued": False}) + "\n").encode()
+        yield ('d:' + json.dumps({"finishReason": "stop", "usage": usage}) + "\n").encode()
+
+    return Response(generate(), mimetype="text/plain")
+
+
+@app.route("/api/chat/archive.data", methods=["POST"])
+async def archive():
+    await asyncio.sleep(CONFIG["latency"])
+    STATS["archive"] += 1
+    return "ok" if is_authorized() else unauthorized()
+
+
+@app.route("/_stats")
+async def get_stats():
+    return STATS
+
+
+@app.route("/_expire")
+async def expire_tokens():
+    TOKENS.clear()
+    return "ok"
+
+
+@app.route("/_model")
+async def update_model_config():
+    overrides = MODEL_CONFIG.setdefault(request.args["id"], {})
+    for key, value in request.args.items():
+        if key in CONFIG:
+            overrides[key] = float(value)
+    return MODEL_CONFIG
+
+
+@app.route("/_config")
+async def update_config():
+    for key, value in request.args.items():
+        if key in CONFIG:
+            CONFIG[key] = float(value)
+    return CONFIG
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    for key, default in CONFIG.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=float, default=default)
+    parser.add_argument("--seed", type=int, default=None, help="错误注入的随机种子")
+    args = parser.parse_args()
+
+    for key in CONFIG:
+        CONFIG[key] = getattr(args, key)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    config = Config()
+    config.bind = [f"{args.host}:{args.port}"]
+    config.accesslog = None
+    asyncio.run(serve(app, config))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import asyncio
+import collections
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+
+# app.py 在导入时读取环境变量，必须在导入之前设置
+os.environ.setdefault("VS_EMAIL", "test@example.com")
+os.environ.setdefault("VS_PASSWORD", "x")
+os.environ.setdefault("VS_DATA_DIR", tempfile.mkdtemp(prefix="vs-test-"))
+os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+import pytest  # noqa: E402
+
+import app  # noqa: E402
+
+
+class FakeClock:
+    """只替换 app 模块看到的 time，asyncio 事件循环仍使用真实时钟。"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(app, "time", fake)
+    return fake
+
+
+class FakeAttempt:
+    """模拟 ChatAttempt: 在 delay 秒后产出第一个事件，或抛出 error。"""
+
+    def __init__(self, upstream_model, delay=0.0, error=None, event=("content", "hi")):
+        self.account = None
+        self.chat_id = f"chat-{upstream_model}"
+        self.upstream_model = upstream_model
+        self.started_at = app.time.monotonic()
+        self.delay, self.error, self.event = delay, error, event
+        self.closed = False
+
+    async def first_event(self):
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.event
+
+    def wait_first_event(self):
+        return asyncio.ensure_future(self.first_event())
+
+    async def close(self):
+        self.closed = True
+
+
+def upstream_chunks(*tokens, reasoning=(), usage=None, delay=0.0):
+    """按上游对话接口的行格式生成 [(延迟秒数, 字节)]: 先输出 reasoning，再输出 tokens，最后是结束事件。"""
+    lines = [f"g:{json.dumps(token)}\n" for token in reasoning] + [f"0:{json.dumps(token)}\n" for token in tokens]
+    lines.append("e:" + json.dumps({"finishReason": "stop", "usage": usage or {"promptTokens": 3, "completionTokens": len(tokens)}}) + "\n")
+    return [(delay, line.encode()) for line in lines]
+
+
+class FakeUpstream:
+    """通过 httpx.MockTransport 模拟上游: 对话接口按 script(payload) 返回的 [(延迟秒数, 字节)] 逐块输出。"""
+
+    def __init__(self):
+        self.payloads = []
+        self.closed_early = 0 # 输出完成前被客户端关闭的流
+        self.script = lambda payload: upstream_chunks("Hello", " world")
+        self.chat_ids = itertools.count(1)
+
+    def handler(self, request):
+        if request.url.path != "/api/chat":
+            return httpx.Response(200, json={})
+        payload = json.loads(request.content)
+        self.payloads.append(payload)
+        return httpx.Response(200, content=self.body(self.script(payload)))
+
+    async def body(self, chunks):
+        finished = False
+        try:
+            for position, (delay, data) in enumerate(chunks):
+                if delay:
+                    await asyncio.sleep(delay)
+                finished = position == len(chunks) - 1
+                yield data
+        finally:
+            if not finished:
+                self.closed_early += 1
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    fake = FakeUpstream()
+    account = app.UpstreamAccount(0, "test@example.com", "x")
+    account.valid = True
+    account.client = httpx.AsyncClient(transport=httpx.MockTransport(fake.handler))
+
+    async def create_new_chat_session(account, corner_type=app.TEXT_CORNER_TYPE):
+        return f"chat-{next(fake.chat_ids)}"
+
+    ready = asyncio.Event()
+    ready.set()
+    monkeypatch.setattr(app, "ACCOUNTS", [account])
+    monkeypatch.setattr(app, "UPSTREAM_TRANSPORT", object())
+    monkeypatch.setattr(app, "CHAT_POOL_TARGET_SIZE", 0)
+    monkeypatch.setattr(app, "create_new_chat_session", create_new_chat_session)
+    monkeypatch.setattr(app, "ARCHIVE_PENDING", {})
+    monkeypatch.setattr(app, "ARCHIVE_OVERFLOW", collections.deque())
+    monkeypatch.setattr(app, "initialization_complete", ready)
+    fake.account = account
+    return fake
+
+
+async def chat_request(body, headers=None, disconnect_after=None):
+    """调用 /v1/chat/completions，返回 (状态码, 响应头, [(收到时的 loop.time(), 字节块)])。
+    disconnect_after 为收到该数量的字节块后模拟客户端断开。"""
+    loop = asyncio.get_running_loop()
+    client = app.app.test_client()
+    chunks = []
+    async with client.request("/v1/chat/completions", method="POST", headers={"Content-Type": "application/json", **(headers or {})}) as connection:
+        await connection.send(json.dumps(body).encode())
+        await connection.send_complete()
+        while disconnect_after is None or len(chunks) < disconnect_after:
+            data = await connection.receive()
+            if not data:
+                break
+            chunks.append((loop.time(), data))
+        if disconnect_after is not None:
+            await connection.disconnect()
+    return connection.status_code, connection.headers, chunks
+
+
+def sse_events(chunks):
+    """把响应字节块解析为 data 帧的列表 (JSON 解码，[DONE] 保持为字符串)，忽略注释帧。"""
+    events = []
+    for frame in b"".join(data for _, data in chunks).decode().split("\n\n"):
+        if frame.startswith("data: "):
+            payload = frame[len("data: "):]
+            events.append(payload if payload == "[DONE]" else json.loads(payload))
+    return events
@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+
+import app
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_admits_up_to_max_concurrency_then_rejects_when_queue_full():
+    async def scenario():
+        admission = app.AdmissionController(2, {}, 0, 1.0)
+        assert await admission.acquire("gpt-4o") == (True, None)
+        assert await admission.acquire("o3") == (True, None)
+        admitted, retry_after = await admission.acquire("gpt-4o")
+        assert admitted is False and retry_after >= 1
+        assert admission.stats["rejected_queue_full"] == 1
+        assert admission.active == 2
+
+    run(scenario())
+
+
+def test_queue_full_rejects_without_waiting():
+    async def scenario():
+        admission = app.AdmissionController(1, {}, 1, 5.0)
+        await admission.acquire("gpt-4o")
+        queued = asyncio.ensure_future(admission.acquire("gpt-4o"))
+        await asyncio.sleep(0)
+        assert len(admission.waiters) == 1
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        assert (await admission.acquire("gpt-4o"))[0] is False
+        assert loop.time() - started < 0.1
+        assert admission.stats == {"admitted": 1, "queued": 1, "rejected_queue_full": 1, "rejected_timeout": 0}
+
+        admission.release("gpt-4o", app.time.monotonic())
+        assert await queued == (True, None)
+
+    run(scenario())
+
+
+def test_wait_timeout_rejects_and_leaves_queue():
+    async def scenario():
+        admission = app.AdmissionController(1, {}, 4, 0.05)
+        admission.hold_time_ewma = 30.0
+        await admission.acquire("gpt-4o")
+        admitted, retry_after = await admission.acquire("gpt-4o")
+        assert admitted is False
+        assert retry_after == 1 # 不超过 max_wait (向上取整)
+        assert admission.stats["rejected_timeout"] == 1
+        assert not admission.waiters
+        assert admission.active == 1
+
+    run(scenario())
+
+
+def test_release_hands_slot_to_waiters_in_fifo_order():
+    async def scenario():
+        admission = app.AdmissionController(1, {}, 4, 5.0)
+        await admission.acquire("gpt-4o")
+        order = []
+
+        async def hold(name):
+            await admission.acquire("gpt-4o")
+            order.append(name)
+            await asyncio.sleep(0)
+            admission.release("gpt-4o", app.time.monotonic())
+
+        tasks = [asyncio.ensure_future(hold(name)) for name in ("a", "b", "c")]
+        await asyncio.sleep(0)
+        admission.release("gpt-4o", app.time.monotonic())
+        # 名额直接转交给队首，新到达的请求不能插队
+        assert admission.active == 1
+        assert not admission.can_admit("gpt-4o")
+        await asyncio.gather(*tasks)
+        assert order == ["a", "b", "c"]
+        assert admission.active == 0
+        assert admission.stats["admitted"] == 4
+
+    run(scenario())
+
+
+def test_cancelled_waiter_is_removed_from_queue():
+    async def scenario():
+        admission = app.AdmissionController(1, {}, 4, 5.0)
+        await admission.acquire("gpt-4o")
+        waiting = asyncio.ensure_future(admission.acquire("gpt-4o"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert not admission.waiters
+        admission.release("gpt-4o", app.time.monotonic())
+        assert admission.active == 0
+
+    run(scenario())
+
+
+def test_slot_granted_to_cancelled_waiter_is_passed_on():
+    async def scenario():
+        admission = app.AdmissionController(1, {}, 4, 5.0)
+        await admission.acquire("gpt-4o")
+        first = asyncio.ensure_future(admission.acquire("gpt-4o"))
+        second = asyncio.ensure_future(admission.acquire("gpt-4o"))
+        await asyncio.sleep(0)
+        admission.release("gpt-4o", app.time.monotonic()) # 名额转交给 first
+        first.cancel() # first 在被唤醒之前离开
+        (outcome,) = await asyncio.gather(first, return_exceptions=True)
+        if not isinstance(outcome, asyncio.CancelledError):
+            # 某些 Python 版本的 wait_for 在内部 future 已完成时忽略取消，请求仍然持有名额
+            assert outcome == (True, None)
+            admission.release("gpt-4o", app.time.monotonic())
+        assert await second == (True, None)
+        assert admission.active == 1
+
+    run(scenario())
+
+
+def test_model_limit_does_not_block_other_models():
+    async def scenario():
+        admission = app.AdmissionController(0, {"o3": 1}, 4, 5.0)
+        await admission.acquire("o3")
+        limited = asyncio.ensure_future(admission.acquire("o3"))
+        await asyncio.sleep(0)
+        assert await admission.acquire("gpt-4o") == (True, None)
+        assert not limited.done()
+        admission.release("o3", app.time.monotonic())
+        assert await limited == (True, None)
+        assert admission.active_by_model == {"o3": 1, "gpt-4o": 1}
+
+    run(scenario())
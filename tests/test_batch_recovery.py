@@ -0,0 +1,171 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def batch_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "BATCH_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "BATCH_FINISHED", set())
+    monkeypatch.setattr(app, "BATCH_STATS", dict.fromkeys(app.BATCH_STATS, 0))
+    os.makedirs(tmp_path / "files")
+    return tmp_path
+
+
+def result_line(custom_id, status_code=200):
+    record = {"id": f"batch_req_{custom_id}", "custom_id": custom_id,
+              "response": {"status_code": status_code, "request_id": None, "body": {}}, "error": None}
+    return (json.dumps(record) + "\n").encode()
+
+
+def write_input(custom_ids):
+    with open(app.batch_file_path("file-input"), "wb") as f:
+        for custom_id in custom_ids:
+            item = {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                    "body": {"model": "gpt-4o", "messages": [{"role": "user", "content": custom_id}]}}
+            f.write((json.dumps(item) + "\n").encode())
+
+
+def write_batch(status="in_progress", total=0):
+    batch = {"id": "batch_test", "endpoint": "/v1/chat/completions", "input_file_id": "file-input",
+             "output_file_id": "file-output", "status": status,
+             "request_counts": {"total": total, "completed": 0, "failed": 0}}
+    with open(app.batch_object_path("batch_test"), "w") as f:
+        json.dump(batch, f)
+
+
+def read_output():
+    with open(app.batch_file_path("file-output"), "rb") as f:
+        return [json.loads(line) for line in f.read().splitlines()]
+
+
+def run_batch(monkeypatch, execute):
+    """在新的事件循环中执行 run_batch("batch_test")，execute_batch_item 替换为 execute。"""
+    monkeypatch.setattr(app, "execute_batch_item", execute)
+
+    async def scenario():
+        # 模块级的同步原语不能跨事件循环使用
+        monkeypatch.setattr(app, "BATCH_SEMAPHORE", asyncio.Semaphore(3))
+        monkeypatch.setattr(app, "initialization_complete", asyncio.Event())
+        monkeypatch.setattr(app, "login_pending", asyncio.Event())
+        app.initialization_complete.set()
+        app.login_pending.set()
+        await app.run_batch("batch_test", None)
+
+    asyncio.run(scenario())
+    with open(app.batch_object_path("batch_test")) as f:
+        return json.load(f)
+
+
+def recording_executor(executed, fail_ids=()):
+    async def execute(item):
+        executed.append(item["custom_id"])
+        await asyncio.sleep(0)
+        status_code = 500 if item["custom_id"] in fail_ids else 200
+        return json.loads(result_line(item["custom_id"], status_code)), status_code < 400
+
+    return execute
+
+
+def test_truncate_partial_last_line(tmp_path):
+    path = tmp_path / "out.jsonl"
+    path.write_bytes(b'{"a":1}\n{"b":2}\n{"c":')
+    app.truncate_partial_last_line(str(path))
+    assert path.read_bytes() == b'{"a":1}\n{"b":2}\n'
+    app.truncate_partial_last_line(str(path))
+    assert path.read_bytes() == b'{"a":1}\n{"b":2}\n'
+
+    path.write_bytes(b'{"no newline at all"')
+    app.truncate_partial_last_line(str(path))
+    assert path.read_bytes() == b""
+
+
+def test_recover_output_skips_malformed_lines_and_truncates_torn_tail(batch_dir):
+    path = app.batch_file_path("file-output")
+    good = result_line("a") + b"garbage in the middle\n" + result_line("b", 500) + result_line("c")
+    with open(path, "wb") as f:
+        f.write(good + b'{"custom_id": "d", "resp\n' + b"[1, 2]\n" + b'{"custom_id": "e"')
+
+    done, completed, failed = asyncio.run(app.recover_batch_output(path))
+    assert done == {"a", "b", "c"}
+    assert (completed, failed) == (2, 1)
+    with open(path, "rb") as f:
+        assert f.read() == good # 末尾的损坏行被截断，中间的保留
+
+
+def test_recover_output_missing_file(batch_dir):
+    assert asyncio.run(app.recover_batch_output(app.batch_file_path("file-missing"))) == (set(), 0, 0)
+
+
+def test_validate_rejects_duplicate_custom_id(batch_dir):
+    write_input(["a", "b", "a"])
+    total, errors = asyncio.run(app.validate_batch_input(app.batch_file_path("file-input"), "/v1/chat/completions"))
+    assert total == 2
+    assert [error["line"] for error in errors] == [3]
+
+
+def test_resume_after_crash_runs_only_missing_items(batch_dir, monkeypatch):
+    ids = [f"req-{i}" for i in range(10)]
+    write_input(ids)
+    write_batch(total=len(ids))
+    # 崩溃前写入了 4 个结果，第 5 个只写了一半
+    with open(app.batch_file_path("file-output"), "wb") as f:
+        f.write(b"".join(result_line(custom_id) for custom_id in ids[:3]) + result_line(ids[3], 500) + b'{"custom_id": "req-4", "respo')
+
+    executed = []
+    batch = run_batch(monkeypatch, recording_executor(executed, fail_ids={"req-9"}))
+    assert sorted(executed) == ids[4:]
+    assert batch["status"] == "completed"
+    assert batch["request_counts"] == {"total": 10, "completed": 8, "failed": 2}
+    assert sorted(record["custom_id"] for record in read_output()) == ids
+
+
+def test_interrupted_batch_resumes_without_duplicates(batch_dir, monkeypatch):
+    ids = [f"req-{i}" for i in range(20)]
+    write_input(ids)
+    write_batch(status="validating")
+
+    async def slow_after_five(item):
+        if int(item["custom_id"].split("-")[1]) >= 5:
+            await asyncio.sleep(3600) # 服务在这些请求完成前关闭
+        return json.loads(result_line(item["custom_id"])), True
+
+    monkeypatch.setattr(app, "execute_batch_item", slow_after_five)
+
+    async def interrupted():
+        monkeypatch.setattr(app, "BATCH_SEMAPHORE", asyncio.Semaphore(8))
+        monkeypatch.setattr(app, "initialization_complete", asyncio.Event())
+        app.initialization_complete.set()
+        task = asyncio.create_task(app.run_batch("batch_test", None))
+        while len(read_output() if os.path.exists(app.batch_file_path("file-output")) else []) < 5:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(interrupted())
+    with open(app.batch_object_path("batch_test")) as f:
+        assert json.load(f)["status"] == "in_progress"
+    assert len(read_output()) == 5
+
+    executed = []
+    batch = run_batch(monkeypatch, recording_executor(executed))
+    assert sorted(executed) == sorted(ids[5:])
+    assert batch["status"] == "completed"
+    assert batch["request_counts"] == {"total": 20, "completed": 20, "failed": 0}
+    output_ids = [record["custom_id"] for record in read_output()]
+    assert len(output_ids) == len(set(output_ids)) == 20
+
+
+def test_cancel_marker_stops_batch(batch_dir, monkeypatch):
+    write_input([f"req-{i}" for i in range(10)])
+    write_batch(total=10)
+    open(app.batch_cancel_marker("batch_test"), "w").close()
+    executed = []
+    batch = run_batch(monkeypatch, recording_executor(executed))
+    assert executed == []
+    assert batch["status"] == "cancelled"
@@ -0,0 +1,126 @@
+import pytest
+
+import app
+
+
+def make_breaker(**overrides):
+    params = dict(failure_ratio=0.5, min_requests=4, window=30.0, open_seconds=10.0, half_open_probes=1)
+    params.update(overrides)
+    return app.CircuitBreaker(**params)
+
+
+def trip(breaker):
+    for _ in range(breaker.min_requests):
+        breaker.record(breaker.before_request(), False)
+    assert breaker.state == "open"
+
+
+def test_disabled_breaker_never_rejects():
+    breaker = make_breaker(failure_ratio=0)
+    for _ in range(10):
+        ticket = breaker.before_request()
+        assert ticket is None
+        breaker.record(ticket, False)
+    assert breaker.state == "closed"
+
+
+def test_stays_closed_below_min_requests(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record(breaker.before_request(), False)
+    assert breaker.state == "closed"
+
+
+def test_opens_when_failure_ratio_reached(clock):
+    breaker = make_breaker()
+    for success in (True, False, True, False):
+        breaker.record(breaker.before_request(), success)
+    assert breaker.state == "open"
+    assert breaker.stats["opened"] == 1
+
+    with pytest.raises(app.UpstreamUnavailableError) as excinfo:
+        breaker.before_request()
+    assert excinfo.value.retry_after == 10
+    assert breaker.stats["rejected"] == 1
+
+
+def test_old_outcomes_leave_the_window(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record(breaker.before_request(), False)
+    clock.advance(31)
+    for _ in range(3):
+        breaker.record(breaker.before_request(), True)
+    assert breaker.state == "closed"
+    assert breaker.snapshot()["window_failures"] == 0
+
+
+def test_half_open_limits_probes(clock):
+    breaker = make_breaker(half_open_probes=2)
+    trip(breaker)
+    clock.advance(10)
+
+    first = breaker.before_request()
+    assert first == (True, breaker.epoch)
+    assert breaker.state == "half_open"
+    breaker.before_request()
+    with pytest.raises(app.UpstreamUnavailableError) as excinfo:
+        breaker.before_request()
+    assert excinfo.value.retry_after == 1
+
+
+def test_probe_success_closes(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    clock.advance(10)
+    breaker.record(breaker.before_request(), True)
+    assert breaker.state == "closed"
+    assert breaker.before_request() == (False, breaker.epoch)
+
+
+def test_probe_failure_reopens(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    clock.advance(10)
+    breaker.record(breaker.before_request(), False)
+    assert breaker.state == "open"
+    assert breaker.stats["opened"] == 2
+    with pytest.raises(app.UpstreamUnavailableError):
+        breaker.before_request()
+
+
+def test_cancelled_probe_releases_slot(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    clock.advance(10)
+    breaker.record(breaker.before_request(), None)
+    assert breaker.state == "half_open"
+    assert breaker.probes_inflight == 0
+    assert breaker.before_request()[0] is True
+
+
+def test_stale_ticket_from_before_trip_is_ignored(clock):
+    breaker = make_breaker()
+    slow = breaker.before_request() # 熔断打开之前放行的慢请求
+    trip(breaker)
+    clock.advance(10)
+    probe = breaker.before_request()
+
+    # 慢请求在半开期间才结束：既不能关闭熔断器，也不能占用或释放探测名额
+    breaker.record(slow, True)
+    assert breaker.state == "half_open"
+    assert breaker.probes_inflight == 1
+    breaker.record(slow, False)
+    assert breaker.state == "half_open"
+
+    breaker.record(probe, True)
+    assert breaker.state == "closed"
+
+
+def test_non_probe_results_ignored_while_half_open(clock):
+    breaker = make_breaker()
+    trip(breaker)
+    clock.advance(10)
+    breaker.before_request()
+    breaker.record((False, breaker.epoch), False)
+    assert breaker.state == "half_open"
@@ -0,0 +1,122 @@
+import asyncio
+import gzip
+import json
+import zlib
+
+import brotli
+import pytest
+
+import app
+from conftest import chat_request, upstream_chunks
+
+FRAMES = [f'data: {{"n": {i}, "text": "{"token " * (i % 7)}"}}\n\n'.encode() for i in range(40)] + [b":heartbeat\n\n", "data: 你好\n\n".encode()]
+
+
+def decompressor(encoding):
+    if encoding == "br":
+        return brotli.Decompressor().process
+    return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+
+
+def decompress(data, encoding):
+    return brotli.decompress(data) if encoding == "br" else gzip.decompress(data)
+
+
+@pytest.fixture(autouse=True)
+def compression(monkeypatch):
+    monkeypatch.setattr(app, "COMPRESSION_ENABLED", True)
+    monkeypatch.setattr(app, "COMPRESSION_STATS", dict.fromkeys(app.COMPRESSION_STATS, 0))
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br"])
+def test_each_frame_is_flushed(encoding):
+    compressor = app.StreamCompressor(encoding)
+    decode = decompressor(encoding)
+    stream = b""
+    for frame in FRAMES:
+        compressed = compressor.compress(frame)
+        assert compressed
+        # 收到这一块之后客户端立即可以解压出完整的帧，不需要等待后续数据
+        assert decode(compressed) == frame
+        stream += compressed
+    stream += compressor.finish()
+    assert decompress(stream, encoding) == b"".join(FRAMES)
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br"])
+def test_compress_body_roundtrip(encoding):
+    data = b"".join(FRAMES)
+    assert decompress(app.compress_body(data, encoding), encoding) == data
+    assert app.compress_body(data, "gzip") == app.compress_body(data, "gzip") # mtime=0，输出稳定
+
+
+def stream_body(**extra):
+    return {"model": "gpt-4o", "stream": True, "messages": [{"role": "user", "content": "hi"}], **extra}
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br"])
+def test_sse_stream_is_compressed_frame_by_frame(upstream, encoding):
+    tokens = [f"token {i} " for i in range(20)]
+    upstream.script = lambda payload: upstream_chunks(*tokens, delay=0.002)
+    status, headers, chunks = asyncio.run(chat_request(stream_body(), {"Accept-Encoding": encoding}))
+    assert status == 200
+    assert headers["Content-Encoding"] == encoding
+    assert "Accept-Encoding" in headers["Vary"]
+    decode, text = decompressor(encoding), ""
+    for _, data in chunks:
+        frames = decode(data)
+        if not frames:
+            continue # 结束时的压缩流尾部
+        assert frames.endswith(b"\n\n")
+        for frame in frames.decode().split("\n\n")[:-1]:
+            if frame.startswith("data: "):
+                text += json.loads(frame[len("data: "):])["choices"][0]["delta"].get("content", "")
+    assert text == "".join(tokens)
+    assert app.COMPRESSION_STATS["streams"] == 1 and app.COMPRESSION_STATS[encoding] == 1
+
+
+def test_client_disconnect_closes_upstream_through_compressor(upstream):
+    upstream.script = lambda payload: upstream_chunks(*[f"t{i}" for i in range(50)], delay=0.01)
+
+    async def scenario():
+        await chat_request(stream_body(), {"Accept-Encoding": "gzip"}, disconnect_after=2)
+        for _ in range(50):
+            if upstream.closed_early:
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+    assert upstream.closed_early == 1
+
+
+def test_small_json_body_is_not_compressed(upstream):
+    status, headers, chunks = asyncio.run(chat_request({"model": "gpt-4o", "messages": [{"role": "user", "content": "hi"}]}, {"Accept-Encoding": "gzip"}))
+    assert status == 200
+    assert "Content-Encoding" not in headers
+    assert "Accept-Encoding" in headers["Vary"]
+    assert json.loads(b"".join(data for _, data in chunks))["choices"][0]["message"]["content"] == "Hello world"
+    assert app.COMPRESSION_STATS["skipped_small"] == 1
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br"])
+def test_large_json_body_is_compressed(upstream, encoding):
+    long_text = "lorem ipsum " * 500
+    upstream.script = lambda payload: upstream_chunks(long_text)
+    _, headers, chunks = asyncio.run(chat_request({"model": "gpt-4o", "messages": [{"role": "user", "content": "hi"}]}, {"Accept-Encoding": f"{encoding}, identity"}))
+    assert headers["Content-Encoding"] == encoding
+    body = b"".join(data for _, data in chunks)
+    assert len(body) < len(long_text) / 4
+    assert json.loads(decompress(body, encoding))["choices"][0]["message"]["content"] == long_text
+
+
+def test_without_accept_encoding_nothing_is_compressed(upstream):
+    upstream.script = lambda payload: upstream_chunks("lorem ipsum " * 500)
+    _, headers, chunks = asyncio.run(chat_request({"model": "gpt-4o", "messages": [{"role": "user", "content": "hi"}]}))
+    assert "Content-Encoding" not in headers
+    assert json.loads(b"".join(data for _, data in chunks))["object"] == "chat.completion"
+
+
+def test_br_preferred_when_client_accepts_both(upstream):
+    upstream.script = lambda payload: upstream_chunks("lorem ipsum " * 500)
+    _, headers, _ = asyncio.run(chat_request({"model": "gpt-4o", "messages": [{"role": "user", "content": "hi"}]}, {"Accept-Encoding": "gzip, deflate, br"}))
+    assert headers["Content-Encoding"] == "br"
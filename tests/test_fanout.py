@@ -0,0 +1,106 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import app
+from conftest import chat_request, sse_events, upstream_chunks
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+@pytest.fixture
+def fanout_upstream(upstream, monkeypatch):
+    monkeypatch.setattr(app, "FANOUT_STATS", dict.fromkeys(app.FANOUT_STATS, 0))
+    monkeypatch.setattr(app, "FANOUT_MAX_CHOICES", 8)
+
+    def script(payload):
+        model = payload["settings"]["modelId"]
+        return upstream_chunks(f"{model}:", payload["chatId"], usage={"promptTokens": 3, "completionTokens": 2}, delay=0.005)
+
+    upstream.script = script
+    return upstream
+
+
+def test_resolve_fanout_models():
+    assert app.resolve_fanout_models({"model": "gpt-4o"}) is None
+    assert app.resolve_fanout_models({"model": "gpt-4o", "n": 1}) is None
+    assert app.resolve_fanout_models({"model": "gpt-4o", "n": 3}) == ["gpt-4o"] * 3
+    assert app.resolve_fanout_models({"model": "gpt-4o", "n": 2, "models": ["o3", "gpt-4o"]}) == ["o3", "o3", "gpt-4o", "gpt-4o"]
+
+
+@pytest.mark.parametrize("data", [{"n": 0}, {"n": "2"}, {"n": True, "models": ["o3"]}, {"models": []}, {"models": "o3"}, {"n": 9}, {"n": 3, "models": ["o3", "gpt-4o", "o3"]}])
+def test_invalid_fanout_parameters(data, monkeypatch):
+    monkeypatch.setattr(app, "FANOUT_MAX_CHOICES", 8)
+    with pytest.raises(ValueError):
+        app.resolve_fanout_models({"model": "gpt-4o", **data})
+
+
+def test_aggregate_usage_sums_numeric_fields():
+    usages = [{"promptTokens": 3, "completionTokens": 2, "note": "x"}, None, {"promptTokens": 3, "completionTokens": 5, "cached": True}]
+    assert app.aggregate_usage(usages) == {"promptTokens": 6, "completionTokens": 7}
+    assert app.aggregate_usage([None, {}]) is None
+
+
+def test_encoder_index():
+    encoder = app.SSEChunkEncoder("gpt-4o", "chatcmpl-x", 1700000000, 3)
+    for frame in (encoder.content("a"), encoder.reasoning("b"), encoder.done()):
+        assert json.loads(frame[len(b"data: "):])["choices"][0]["index"] == 3
+
+
+def test_streamed_choices_carry_their_index_and_summed_usage(fanout_upstream):
+    status, _, chunks = asyncio.run(chat_request({"model": "gpt-4o", "stream": True, "n": 2, "models": ["gpt-4o", "o3"], "messages": MESSAGES}))
+    assert status == 200
+    events = sse_events(chunks)
+    texts, finishes = {}, {}
+    for event in events[:-1]:
+        (choice,) = event["choices"]
+        assert event["id"] == events[0]["id"]
+        if choice["finish_reason"]:
+            finishes[choice["index"]] = choice["finish_reason"]
+        else:
+            texts[choice["index"]] = texts.get(choice["index"], "") + choice["delta"]["content"]
+    assert finishes == dict.fromkeys(range(4), "stop")
+    assert [text.split(":")[0] for _, text in sorted(texts.items())] == ["gpt-4o", "gpt-4o", "o3", "o3"]
+    # 每个选项有自己的会话
+    assert len({text.split(":")[1] for text in texts.values()}) == 4
+
+    assert events[-1]["choices"] == []
+    assert events[-1]["usage"] == {"promptTokens": 12, "completionTokens": 8}
+    assert len(fanout_upstream.payloads) == 4
+    assert app.FANOUT_STATS == {"requests": 1, "branches": 4, "branch_errors": 0}
+
+
+def test_non_stream_choices_have_index_and_model(fanout_upstream):
+    status, _, chunks = asyncio.run(chat_request({"model": "gpt-4o", "n": 2, "models": ["gpt-4o", "o3"], "messages": MESSAGES}))
+    assert status == 200
+    response = json.loads(b"".join(data for _, data in chunks))
+    assert [(choice["index"], choice["model"]) for choice in response["choices"]] == [(0, "gpt-4o"), (1, "gpt-4o"), (2, "o3"), (3, "o3")]
+    assert all(choice["message"]["content"].startswith(choice["model"] + ":") for choice in response["choices"])
+    assert response["usage"] == {"promptTokens": 12, "completionTokens": 8}
+
+
+def test_single_model_choices_omit_model(fanout_upstream):
+    _, _, chunks = asyncio.run(chat_request({"model": "gpt-4o", "n": 3, "messages": MESSAGES}))
+    response = json.loads(b"".join(data for _, data in chunks))
+    assert [choice["index"] for choice in response["choices"]] == [0, 1, 2]
+    assert all("model" not in choice for choice in response["choices"])
+    assert response["usage"] == {"promptTokens": 9, "completionTokens": 6}
+
+
+def test_failed_branch_ends_with_error_finish_reason(fanout_upstream, monkeypatch):
+    original = app.iter_upstream_chat_events
+
+    async def reset_second_chat(account, payload, *args):
+        async for event in original(account, payload, *args):
+            if event[0] == "finish" and payload["chatId"] == "chat-2":
+                raise httpx.ReadError("connection reset") # 上游在结束标记之前断开
+            yield event
+
+    monkeypatch.setattr(app, "iter_upstream_chat_events", reset_second_chat)
+    _, _, chunks = asyncio.run(chat_request({"model": "gpt-4o", "n": 2, "messages": MESSAGES}))
+    response = json.loads(b"".join(data for _, data in chunks))
+    outcomes = {choice["message"]["content"]: choice["finish_reason"] for choice in response["choices"]}
+    assert outcomes == {"gpt-4o:chat-1": "stop", "gpt-4o:chat-2": "error"} # 出错之前的内容仍然返回
+    assert app.FANOUT_STATS["branch_errors"] == 1
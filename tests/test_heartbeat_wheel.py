@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+
+import app
+from conftest import chat_request, upstream_chunks
+
+INTERVAL, RESOLUTION = 0.1, 0.01
+
+
+class RecordingSubscription:
+    def __init__(self):
+        self.beats = []
+
+    def heartbeat(self):
+        self.beats.append(asyncio.get_running_loop().time())
+
+
+@pytest.fixture(autouse=True)
+def wheel(monkeypatch):
+    wheel = app.HeartbeatWheel(INTERVAL, RESOLUTION)
+    monkeypatch.setattr(app, "HEARTBEAT_WHEEL", wheel)
+    monkeypatch.setattr(app, "STREAM_STATS", dict.fromkeys(app.STREAM_STATS, 0))
+    return wheel
+
+
+def test_no_heartbeat_before_interval_of_idleness(wheel):
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        subscription = RecordingSubscription()
+        handle = wheel.register(subscription)
+        registered_at = handle.last_activity
+        await asyncio.sleep(INTERVAL * 0.8)
+        assert subscription.beats == []
+        await asyncio.sleep(INTERVAL * 0.5)
+        assert len(subscription.beats) == 1
+        assert subscription.beats[0] - registered_at >= INTERVAL - RESOLUTION / 2
+        await asyncio.sleep(INTERVAL)
+        assert len(subscription.beats) == 2 # 仍然空闲，每个间隔一次
+        wheel.unregister(handle)
+        await asyncio.sleep(INTERVAL * 1.5)
+        assert len(subscription.beats) == 2
+        assert loop.time() - registered_at >= 3 * INTERVAL
+
+    asyncio.run(scenario())
+    assert app.STREAM_STATS["heartbeats"] == 2
+
+
+def test_activity_postpones_heartbeat(wheel):
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        subscription = RecordingSubscription()
+        handle = wheel.register(subscription)
+        for _ in range(10):
+            await asyncio.sleep(INTERVAL / 3)
+            handle.last_activity = loop.time()
+        assert subscription.beats == []
+        last_activity = handle.last_activity
+        await asyncio.sleep(INTERVAL * 1.5)
+        assert len(subscription.beats) == 1
+        assert subscription.beats[0] - last_activity >= INTERVAL - RESOLUTION / 2
+        wheel.unregister(handle)
+
+    asyncio.run(scenario())
+
+
+def test_wheel_task_stops_when_no_streams_remain(wheel):
+    async def scenario():
+        handle = wheel.register(RecordingSubscription())
+        task = wheel.task
+        wheel.unregister(handle)
+        wheel.unregister(handle) # 重复注销不影响计数
+        assert wheel.registered == 0
+        await asyncio.wait_for(task, INTERVAL * 3)
+        assert all(not slot for slot in wheel.slots)
+
+    asyncio.run(scenario())
+
+
+def test_bounded_buffer_applies_backpressure():
+    async def scenario():
+        generation = app.ChatGeneration()
+        subscription = app.BufferedSubscription(generation, 2)
+        generation.subscribers.add(subscription)
+        await subscription.push(("content", "a"))
+        await subscription.push(("content", "b"))
+        blocked = asyncio.ensure_future(subscription.push(("content", "c")))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        assert app.STREAM_STATS["backpressure_waits"] == 1
+        assert await subscription.get() == ("content", "a")
+        await asyncio.wait_for(blocked, 1)
+        assert list(subscription.buffer) == [("content", "b"), ("content", "c")]
+
+        stuck = asyncio.ensure_future(subscription.push(("content", "d")))
+        await asyncio.sleep(0)
+        subscription.close() # 客户端离开，生成任务不再等待
+        await asyncio.wait_for(stuck, 1)
+        assert not subscription.buffer
+
+    asyncio.run(scenario())
+
+
+def test_idle_stream_gets_heartbeat_frames_only_while_idle(upstream):
+    def script(payload):
+        chunks = upstream_chunks(*[f"t{i}" for i in range(8)], delay=INTERVAL / 4)
+        return chunks[:4] + [(INTERVAL * 3.5, chunks[4][1])] + chunks[5:]
+
+    upstream.script = script
+    body = {"model": "gpt-4o", "stream": True, "messages": [{"role": "user", "content": "hi"}]}
+    _, _, chunks = asyncio.run(chat_request(body))
+    frames = [data for _, data in chunks]
+    beats = [position for position, data in enumerate(frames) if data == app.SSE_HEARTBEAT_FRAME]
+    assert 2 <= len(beats) <= 3
+    # 心跳只出现在第 4 个与第 5 个 token 之间的空闲期
+    assert beats == list(range(beats[0], beats[-1] + 1))
+    assert b'"t3"' in frames[beats[0] - 1]
+    assert b'"t4"' in frames[beats[-1] + 1]
+
+
+def test_pending_heartbeat_never_precedes_buffered_data():
+    async def scenario():
+        generation = app.ChatGeneration()
+        subscription = generation.subscribe()
+        subscription.heartbeat()
+        await generation.publish(("content", "a"))
+        subscription.heartbeat()
+        assert subscription.get_nowait() == ("content", "a")
+        # 数据已经让连接保持活跃，积压的心跳被丢弃
+        with pytest.raises(asyncio.QueueEmpty):
+            subscription.get_nowait()
+        subscription.heartbeat()
+        assert subscription.get_nowait() is app._HEARTBEAT
+        generation.finish()
+        assert subscription.get_nowait() is None
+
+    asyncio.run(scenario())
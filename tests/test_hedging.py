@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+import app
+from conftest import FakeAttempt
+
+
+@pytest.fixture(autouse=True)
+def hedging(monkeypatch):
+    monkeypatch.setattr(app, "HEDGE_TTFT_DEADLINE", 0.05)
+    monkeypatch.setattr(app, "HEDGE_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(app, "HEDGE_STATS", dict.fromkeys(app.HEDGE_STATS, 0))
+    monkeypatch.setattr(app, "MODEL_ROUTER", app.ModelRouter({}))
+
+
+def slow_setup(attempt, seconds, finish_when_cancelled=False):
+    """模拟需要多次上游往返的会话准备；finish_when_cancelled 模拟取消到达时准备恰好完成。"""
+    started = []
+
+    async def start():
+        started.append(attempt)
+        try:
+            await asyncio.sleep(seconds)
+        except asyncio.CancelledError:
+            if not finish_when_cancelled:
+                raise
+        return attempt
+
+    return start, started
+
+
+def test_hedge_wins_when_primary_stalls():
+    primary, hedge = FakeAttempt("gpt-4o", delay=5.0), FakeAttempt("gpt-4o", delay=0.0)
+    start_hedge, _ = slow_setup(hedge, 0)
+    attempts = [primary]
+    winner, _ = asyncio.run(app.race_chat_attempts(attempts, start_hedge))
+    assert winner is hedge
+    assert primary.closed and attempts == [hedge]
+    assert app.HEDGE_STATS["hedged"] == 1 and app.HEDGE_STATS["hedge_won"] == 1
+
+
+def test_primary_token_is_not_held_back_by_hedge_setup():
+    primary, hedge = FakeAttempt("gpt-4o", delay=0.1), FakeAttempt("gpt-4o")
+    start_hedge, started = slow_setup(hedge, 5.0)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        began = loop.time()
+        winner, event = await app.race_chat_attempts([primary], start_hedge)
+        return winner, event, loop.time() - began
+
+    winner, event, elapsed = asyncio.run(scenario())
+    assert started == [hedge] # 对冲已经开始准备
+    assert winner is primary and event == ("content", "hi")
+    assert elapsed < 1.0
+    assert not hedge.closed # 准备被取消，尚未取得会话
+
+
+def test_setup_finishing_after_the_race_is_cleaned_up():
+    primary, hedge = FakeAttempt("gpt-4o", delay=0.1), FakeAttempt("gpt-4o")
+    start_hedge, _ = slow_setup(hedge, 5.0, finish_when_cancelled=True)
+    attempts = [primary]
+    winner, _ = asyncio.run(app.race_chat_attempts(attempts, start_hedge))
+    assert winner is primary
+    assert hedge.closed # 会话归档、账号释放
+    assert attempts == [primary]
+    assert app.HEDGE_STATS["losers_cancelled"] == 1
+
+
+def test_raced_hedge_setup_does_not_delay_primary():
+    primary, hedge = FakeAttempt("gpt-4o", delay=0.0), FakeAttempt("gpt-4o")
+    start_hedge, started = slow_setup(hedge, 5.0)
+    winner, _ = asyncio.run(app.race_chat_attempts([primary], start_hedge, race_from_start=True))
+    assert winner is primary and started == [hedge]
+
+
+def test_failed_hedge_setup_keeps_waiting_for_primary():
+    primary = FakeAttempt("gpt-4o", delay=0.15)
+
+    async def start_hedge():
+        raise Exception("无法创建新的聊天会话。")
+
+    winner, _ = asyncio.run(app.race_chat_attempts([primary], start_hedge))
+    assert winner is primary
+    assert app.HEDGE_STATS["hedged"] == 0
+
+
+def test_cancelled_race_cancels_setup():
+    primary, hedge = FakeAttempt("gpt-4o", delay=5.0), FakeAttempt("gpt-4o")
+    start_hedge, started = slow_setup(hedge, 5.0, finish_when_cancelled=True)
+
+    async def scenario():
+        race = asyncio.ensure_future(app.race_chat_attempts([primary], start_hedge))
+        await asyncio.sleep(0.1)
+        race.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await race
+
+    asyncio.run(scenario())
+    assert started == [hedge] and hedge.closed
@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+import app
+from conftest import chat_request, sse_events, upstream_chunks
+
+BODY = {"model": "gpt-4o", "stream": True, "messages": [{"role": "user", "content": "hi"}]}
+TOKENS = [f"t{i} " for i in range(10)]
+
+
+@pytest.fixture(autouse=True)
+def inflight(monkeypatch):
+    monkeypatch.setattr(app, "INFLIGHT_COALESCE_ENABLED", True)
+    monkeypatch.setattr(app, "INFLIGHT_GENERATIONS", {})
+    monkeypatch.setattr(app, "INFLIGHT_STATS", dict.fromkeys(app.INFLIGHT_STATS, 0))
+
+
+@pytest.fixture
+def slow_upstream(upstream):
+    upstream.script = lambda payload: upstream_chunks(*TOKENS, delay=0.02)
+    return upstream
+
+
+def text(chunks):
+    return "".join(event["choices"][0]["delta"].get("content", "") for event in sse_events(chunks) if isinstance(event, dict))
+
+
+async def leader_and_follower(upstream, leader_disconnect_after=None, follower_disconnect_after=None):
+    """先发起领头请求，等它开始生成后再发起相同的请求。"""
+    leader = asyncio.ensure_future(chat_request(BODY, disconnect_after=leader_disconnect_after))
+    while not upstream.payloads:
+        await asyncio.sleep(0.005)
+    follower = await chat_request(BODY, disconnect_after=follower_disconnect_after)
+    return await leader, follower
+
+
+def test_identical_concurrent_requests_share_one_upstream_call(slow_upstream):
+    leader, follower = asyncio.run(leader_and_follower(slow_upstream))
+    assert len(slow_upstream.payloads) == 1
+    assert text(leader[2]) == text(follower[2]) == "".join(TOKENS) # 晚加入的订阅者从头读起
+    assert app.INFLIGHT_STATS == {"leaders": 1, "followers": 1, "cancelled": 0}
+    assert not app.INFLIGHT_GENERATIONS
+
+
+def test_upstream_survives_while_a_subscriber_remains(slow_upstream):
+    leader, follower = asyncio.run(leader_and_follower(slow_upstream, leader_disconnect_after=1))
+    assert text(follower[2]) == "".join(TOKENS)
+    assert slow_upstream.closed_early == 0
+    assert app.INFLIGHT_STATS["cancelled"] == 0
+
+
+def test_upstream_cancelled_when_last_subscriber_leaves(slow_upstream):
+    async def scenario():
+        await leader_and_follower(slow_upstream, leader_disconnect_after=1, follower_disconnect_after=2)
+        for _ in range(50):
+            if slow_upstream.closed_early:
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+    assert app.INFLIGHT_STATS["cancelled"] == 1
+    assert slow_upstream.closed_early == 1
+    assert not app.INFLIGHT_GENERATIONS
+
+
+def test_different_requests_are_not_merged(slow_upstream):
+    async def scenario():
+        return await asyncio.gather(chat_request(BODY), chat_request({**BODY, "messages": [{"role": "user", "content": "other"}]}))
+
+    asyncio.run(scenario())
+    assert len(slow_upstream.payloads) == 2
+    assert app.INFLIGHT_STATS["followers"] == 0
+
+
+def test_unsubscribe_cancels_only_after_last_subscriber():
+    async def scenario():
+        generation = app.ChatGeneration(key="fingerprint")
+        generation.task = asyncio.ensure_future(asyncio.sleep(3600))
+        first, second = generation.subscribe(), generation.subscribe()
+        generation.unsubscribe(first)
+        await asyncio.sleep(0)
+        assert not generation.task.done()
+        generation.unsubscribe(second)
+        await asyncio.sleep(0)
+        assert generation.task.cancelled()
+
+    asyncio.run(scenario())
+
+
+def test_finished_generation_is_not_cancelled():
+    async def scenario():
+        generation = app.ChatGeneration(key="fingerprint")
+        generation.task = asyncio.ensure_future(asyncio.sleep(3600))
+        subscription = generation.subscribe()
+        generation.finish()
+        generation.unsubscribe(subscription)
+        await asyncio.sleep(0)
+        assert not generation.task.done()
+        generation.task.cancel()
+
+    asyncio.run(scenario())
+    assert app.INFLIGHT_STATS["cancelled"] == 0
+
+
+def test_late_subscriber_reads_from_the_start():
+    async def scenario():
+        generation = app.ChatGeneration(key="fingerprint")
+        early = generation.subscribe()
+        await generation.publish(("content", "a"))
+        assert await early.get() == ("content", "a")
+        await generation.publish(("content", "b"))
+        late = generation.subscribe()
+        generation.finish()
+        return [await late.get() for _ in range(3)], await early.get()
+
+    late_events, early_next = asyncio.run(scenario())
+    assert late_events == [("content", "a"), ("content", "b"), None]
+    assert early_next == ("content", "b")
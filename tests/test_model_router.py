@@ -0,0 +1,195 @@
+import asyncio
+import collections
+import random
+
+import httpx
+import pytest
+
+import app
+from conftest import FakeAttempt
+
+
+@pytest.fixture
+def router(monkeypatch):
+    routes = {
+        "smart": ["gpt-4o", "claude-4-sonnet-thinking", "o3"],
+        "fast": {"models": ["gpt-4.1-mini", "o4-mini"], "ttft_slo": 2.0},
+        "mix": {"gpt-4.1": 3, "grok-3": 1},
+    }
+    monkeypatch.setattr(app, "ROUTING_MIN_SAMPLES", 3)
+    monkeypatch.setattr(app, "ROUTING_PROBE_INTERVAL", 30.0)
+    monkeypatch.setattr(app, "ROUTING_STATS", dict.fromkeys(app.ROUTING_STATS, 0))
+    router = app.ModelRouter(routes)
+    monkeypatch.setattr(app, "MODEL_ROUTER", router)
+    return router
+
+
+def fail(router, upstream_model, times):
+    for _ in range(times):
+        router.record_outcome(upstream_model, False)
+
+
+def test_aliases_are_translated_to_upstream_ids(router):
+    models, slo = router.plan("smart")
+    assert models == ["gpt-4o", "claude-4-sonnet-20250514", "o3"]
+    assert slo == app.ROUTING_TTFT_SLO
+    assert router.plan("fast") == (["gpt-4.1-mini", "o4-mini"], 2.0)
+
+
+def test_plain_model_and_unknown_alias(router):
+    assert router.plan("deepseek-v3") == (["deepseek-chat"], app.ROUTING_TTFT_SLO)
+    default_plan = router.plan(router.default_alias)
+    assert router.plan("no-such-model") == default_plan
+    assert app.ROUTING_STATS["unknown_model"] == 1
+
+
+@pytest.mark.parametrize("spec", [[], {}, {"gpt-4o": 0}, {"models": "gpt-4o"}, [1, 2], "gpt-4o"])
+def test_invalid_route_raises_value_error(spec):
+    with pytest.raises(ValueError):
+        app.ModelRouter.parse_route("bad", spec)
+
+
+def test_not_degraded_before_min_samples(clock, router):
+    fail(router, "gpt-4o", 2)
+    assert not router.health["gpt-4o"].is_degraded(0)
+    assert router.plan("smart")[0][0] == "gpt-4o"
+    assert app.ROUTING_STATS["probes"] == 0
+
+
+def test_error_rate_demotes_model(clock, router):
+    fail(router, "gpt-4o", 4) # EWMA 错误率 0.59 > 0.5
+    assert router.plan("smart")[0][0] == "gpt-4o" # 降级后的第一个请求作为探测放行
+    clock.advance(1)
+    assert router.plan("smart")[0] == ["claude-4-sonnet-20250514", "o3", "gpt-4o"]
+    assert router.snapshot()["gpt-4o"]["degraded"] is True
+
+
+def test_ttft_slo_demotes_model(clock, router):
+    for _ in range(3):
+        router.record_outcome("gpt-4.1-mini", True)
+        router.record_ttft("gpt-4.1-mini", 5.0)
+    router.plan("fast") # 探测
+    assert router.plan("fast")[0] == ["o4-mini", "gpt-4.1-mini"]
+    # 同一个模型在没有 SLO 的路由组中不受延迟影响
+    assert router.health["gpt-4.1-mini"].is_degraded(0) is False
+
+
+def test_degraded_model_is_probed_after_interval(clock, router):
+    fail(router, "gpt-4o", 4)
+    assert router.plan("smart")[0][0] == "gpt-4o" # 探测
+    assert app.ROUTING_STATS["probes"] == 1
+    clock.advance(10)
+    assert router.plan("smart")[0][-1] == "gpt-4o"
+    assert app.ROUTING_STATS["degraded_skipped"] == 1
+    clock.advance(30)
+    assert router.plan("smart")[0][0] == "gpt-4o"
+    assert app.ROUTING_STATS["probes"] == 2
+
+
+def test_recovered_model_returns_to_front(clock, router):
+    fail(router, "gpt-4o", 4)
+    for _ in range(10):
+        router.record_outcome("gpt-4o", True)
+    assert router.plan("smart")[0][0] == "gpt-4o"
+    assert router.snapshot()["gpt-4o"]["degraded"] is False
+
+
+def test_weighted_route_follows_weights(router, monkeypatch):
+    monkeypatch.setattr(app, "random", random.Random(1234))
+    first = collections.Counter(router.plan("mix")[0][0] for _ in range(4000))
+    assert set(first) == {"gpt-4.1", "grok-3"}
+    assert 0.7 < first["gpt-4.1"] / 4000 < 0.8
+
+
+def race(attempts, failover, failover_deadline=0.0):
+    """按 run_chat_generation 的方式使用 race_chat_attempts: failover 为路由组中余下的尝试。"""
+    remaining = collections.deque(failover)
+
+    async def start_failover():
+        return remaining.popleft() if remaining else None
+
+    async def start_hedge():
+        return None
+
+    return asyncio.run(app.race_chat_attempts(attempts, start_hedge, start_failover=start_failover, failover_deadline=failover_deadline))
+
+
+def test_failover_on_error(router):
+    primary = FakeAttempt("gpt-4o", error=httpx.ConnectError("down"))
+    secondary = FakeAttempt("claude-4-sonnet-20250514")
+    attempts = [primary]
+    winner, event = race(attempts, [secondary])
+    assert winner is secondary and event == ("content", "hi")
+    assert primary.closed and attempts == [secondary]
+    assert app.ROUTING_STATS["failover_error"] == 1
+
+
+def test_all_failover_targets_fail_raises_last_error(router):
+    attempts = [FakeAttempt("gpt-4o", error=httpx.ConnectError("first"))]
+    with pytest.raises(httpx.ConnectError, match="second"):
+        race(attempts, [FakeAttempt("o3", error=httpx.ConnectError("second"))])
+
+
+def test_failover_on_slo_records_censored_sample(router):
+    slow = FakeAttempt("gpt-4.1-mini", delay=5.0)
+    fast = FakeAttempt("o4-mini", delay=0.0)
+    attempts = [slow]
+    winner, _ = race(attempts, [fast], failover_deadline=0.05)
+    assert winner is fast
+    assert slow.closed
+    assert app.ROUTING_STATS["failover_slo"] == 1
+    assert router.health["o4-mini"].ttft is not None
+    assert router.health["gpt-4.1-mini"].ttft >= 0.05
+    assert router.health["gpt-4.1-mini"].samples == 1
+
+
+def test_model_missing_slo_is_demoted(router):
+    router.routes["fast"] = app.ModelRouter.parse_route("fast", {"models": ["gpt-4.1-mini", "o4-mini"], "ttft_slo": 0.02})
+    for _ in range(app.ROUTING_MIN_SAMPLES):
+        models, slo = router.plan("fast")
+        assert models[0] == "gpt-4.1-mini"
+        attempts = [FakeAttempt(models[0], delay=5.0)]
+        winner, _ = race(attempts, [FakeAttempt(models[1])], failover_deadline=slo)
+        assert winner.upstream_model == "o4-mini"
+    health = router.health["gpt-4.1-mini"]
+    assert health.samples == app.ROUTING_MIN_SAMPLES
+    assert health.ttft > slo
+    assert health.is_degraded(slo)
+    router.plan("fast") # 降级后的第一个请求作为探测放行
+    assert router.plan("fast")[0] == ["o4-mini", "gpt-4.1-mini"]
+
+
+def test_slow_winner_is_not_counted_as_slo_miss(router):
+    slow = FakeAttempt("gpt-4.1-mini", delay=0.05)
+    failing = FakeAttempt("o4-mini", error=httpx.ConnectError("down"))
+    winner, _ = race([slow], [failing], failover_deadline=0.01)
+    assert winner is slow
+    assert router.health["gpt-4.1-mini"].samples == 0 # 成功与否在生成结束后由 run_chat_generation 记录
+
+
+def test_every_internal_5xx_retry_is_recorded(router, monkeypatch):
+    statuses = iter([502, 503])
+
+    def handler(request):
+        status = next(statuses, 200)
+        if status != 200:
+            return httpx.Response(status, text="busy")
+        return httpx.Response(200, content=b'0:"ok"\ne:{"finishReason":"stop"}\n')
+
+    monkeypatch.setattr(app, "retry_backoff", lambda attempt: 0)
+    monkeypatch.setattr(app, "UPSTREAM_BREAKER", app.CircuitBreaker(0, 1, 30, 15, 1))
+    monkeypatch.setattr(app, "RETRY_BUDGET", app.RetryBudget(1.0, 100, 100))
+    account = app.UpstreamAccount(0, "test@example.com", "x")
+    payload = {"settings": {"modelId": "gpt-4o"}}
+
+    async def consume():
+        account.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        try:
+            return [event async for event in app.iter_upstream_chat_events(account, payload, {})]
+        finally:
+            await account.client.aclose()
+
+    assert asyncio.run(consume()) == [("content", "ok"), ("finish", None)]
+    health = router.health["gpt-4o"]
+    assert health.samples == 2
+    assert health.error_rate == pytest.approx(1 - (1 - app.ROUTING_EWMA_ALPHA) ** 2)
@@ -0,0 +1,150 @@
+import asyncio
+
+import pytest
+
+import app
+from conftest import chat_request, sse_events, upstream_chunks
+
+OVERHEAD = app.ResponseCache.ENTRY_OVERHEAD
+
+
+def body(temperature=0, stream=False, content="hi"):
+    data = {"model": "gpt-4o", "stream": stream, "messages": [{"role": "user", "content": content}]}
+    if temperature is not None:
+        data["temperature"] = temperature
+    return data
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = app.ResponseCache(1 << 20, 60.0)
+    monkeypatch.setattr(app, "RESPONSE_CACHE", cache)
+    monkeypatch.setattr(app, "RESPONSE_CACHE_ENABLED", True)
+    monkeypatch.setattr(app, "RESPONSE_CACHE_DETERMINISTIC_ONLY", True)
+    return cache
+
+
+def test_lru_eviction_by_byte_budget(clock):
+    cache = app.ResponseCache(3 * (OVERHEAD + 10), 60.0)
+    for key in "abc":
+        cache.put(key, "x" * 10, "", None)
+    assert cache.total_bytes == 3 * (OVERHEAD + 10)
+    assert cache.get("a") == ("x" * 10, "", None) # 访问使 a 成为最近使用的条目
+
+    cache.put("d", "x" * 10, "", None)
+    assert list(cache.entries) == ["c", "a", "d"]
+    assert cache.get("b") is None
+    assert cache.stats["evicted"] == 1
+
+    cache.put("e", "x" * 10 + "y" * (OVERHEAD + 10), "", None) # 占用两个条目的空间
+    assert list(cache.entries) == ["d", "e"]
+    assert cache.total_bytes <= cache.max_bytes
+    assert cache.stats["evicted"] == 3
+
+
+def test_size_counts_utf8_bytes_of_content_and_reasoning(clock):
+    cache = app.ResponseCache(1 << 20, 60.0)
+    cache.put("k", "你好", "think", {"promptTokens": 1})
+    assert cache.total_bytes == OVERHEAD + 6 + 5
+    cache.put("k", "", "", None) # 覆盖同一个键不重复计数
+    assert cache.total_bytes == OVERHEAD
+    assert len(cache.entries) == 1
+
+
+def test_oversized_entry_is_rejected(clock):
+    cache = app.ResponseCache(OVERHEAD + 10, 60.0)
+    cache.put("small", "x" * 10, "", None)
+    cache.put("big", "x" * 11, "", None)
+    assert list(cache.entries) == ["small"]
+    assert cache.stats["rejected"] == 1
+
+
+def test_ttl_expiry(clock):
+    cache = app.ResponseCache(1 << 20, 60.0)
+    cache.put("k", "cached", "", None)
+    clock.advance(59.9)
+    assert cache.get("k") == ("cached", "", None)
+    clock.advance(0.1)
+    assert cache.get("k") is None
+    assert cache.stats["expired"] == 1
+    assert cache.total_bytes == 0 and not cache.entries
+
+
+def test_hit_does_not_extend_ttl(clock):
+    cache = app.ResponseCache(1 << 20, 60.0)
+    cache.put("k", "cached", "", None)
+    clock.advance(50)
+    assert cache.get("k") is not None
+    clock.advance(10)
+    assert cache.get("k") is None
+
+
+def test_deterministic_request_is_served_from_cache(upstream, cache):
+    async def scenario():
+        first = await chat_request(body())
+        second = await chat_request(body())
+        return first, second
+
+    (status, headers, chunks), (hit_status, hit_headers, hit_chunks) = asyncio.run(scenario())
+    assert status == hit_status == 200
+    assert headers["X-Proxy-Cache"] == "MISS"
+    assert hit_headers["X-Proxy-Cache"] == "HIT"
+    assert len(upstream.payloads) == 1
+    assert cache.stats["hits"] == 1
+
+
+def test_cached_response_replays_as_stream(upstream, cache):
+    upstream.script = lambda payload: upstream_chunks("Hel", "lo", reasoning=["think"])
+
+    async def scenario():
+        await chat_request(body())
+        return await chat_request(body(stream=True))
+
+    status, headers, chunks = asyncio.run(scenario())
+    assert status == 200 and headers["X-Proxy-Cache"] == "HIT"
+    events = sse_events(chunks)
+    text = "".join(event["choices"][0]["delta"].get("content", "") for event in events if isinstance(event, dict) and event["choices"])
+    assert text == "Hello"
+    assert len(upstream.payloads) == 1
+
+
+@pytest.mark.parametrize("temperature", [0.7, None, "0"])
+def test_temperature_gate(upstream, cache, temperature):
+    async def scenario():
+        return [await chat_request(body(temperature)) for _ in range(2)]
+
+    responses = asyncio.run(scenario())
+    assert len(upstream.payloads) == 2
+    assert all("X-Proxy-Cache" not in headers for _, headers, _ in responses)
+    assert not cache.entries
+
+
+def test_nondeterministic_requests_cached_when_gate_disabled(upstream, cache, monkeypatch):
+    monkeypatch.setattr(app, "RESPONSE_CACHE_DETERMINISTIC_ONLY", False)
+
+    async def scenario():
+        return [await chat_request(body(0.7)) for _ in range(2)]
+
+    assert asyncio.run(scenario())[1][1]["X-Proxy-Cache"] == "HIT"
+    assert len(upstream.payloads) == 1
+
+
+@pytest.mark.parametrize("headers", [{"Cache-Control": "no-cache"}, {"X-Proxy-Cache": "bypass"}])
+def test_bypass_headers_skip_the_cache(upstream, cache, headers):
+    async def scenario():
+        await chat_request(body())
+        return await chat_request(body(), headers)
+
+    _, response_headers, _ = asyncio.run(scenario())
+    assert response_headers["X-Proxy-Cache"] == "BYPASS"
+    assert len(upstream.payloads) == 2
+    assert cache.stats["bypassed"] == 1
+
+
+def test_different_prompts_do_not_share_entries(upstream, cache):
+    async def scenario():
+        await chat_request(body(content="one"))
+        return await chat_request(body(content="two"))
+
+    assert asyncio.run(scenario())[1]["X-Proxy-Cache"] == "MISS"
+    assert len(upstream.payloads) == 2
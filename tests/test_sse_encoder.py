@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+import app
+
+MESSAGE_ID = "chatcmpl-0123456789abcdef"
+CREATED = 1700000000
+
+DELTAS = [
+    "Hello",
+    "",
+    " world",
+    'quote " and backslash \\',
+    "line\nbreak\ttab\r\x00\x1f\x7f",
+    "你好，世界",
+    "emoji 😀 and surrogate-pair 𝄞",
+    "</script>&<>'",
+    "  ",
+    42,
+    3.5,
+    None,
+    ["list", 1],
+    {"nested": "dict"},
+]
+
+
+# 参考实现: 重构之前每个 token 都对完整的 chunk 调用 json.dumps
+def legacy_chunk(model, key, delta):
+    chunk_data = {"id": MESSAGE_ID, "object": "chat.completion.chunk", "created": CREATED, "model": model,
+                  "choices": [{"delta": {key: delta}, "index": 0, "finish_reason": None}]}
+    return f"data: {json.dumps(chunk_data)}\n\n".encode("utf-8")
+
+
+def legacy_done(model, usage=None):
+    done_data = {"id": MESSAGE_ID, "object": "chat.completion.chunk", "created": CREATED, "model": model,
+                 "choices": [{"delta": {}, "index": 0, "finish_reason": "stop"}]}
+    if usage:
+        done_data["usage"] = usage
+    return f"data: {json.dumps(done_data)}\n\n".encode("utf-8")
+
+
+@pytest.mark.parametrize("model", ["gpt-4o", "claude-4-sonnet-20250514", "模型 \"quoted\""])
+@pytest.mark.parametrize("delta", DELTAS, ids=repr)
+def test_content_and_reasoning_match_json_dumps(model, delta):
+    encoder = app.SSEChunkEncoder(model, MESSAGE_ID, CREATED)
+    assert encoder.content(delta) == legacy_chunk(model, "content", delta)
+    assert encoder.reasoning(delta) == legacy_chunk(model, "reasoning_content", delta)
+
+
+@pytest.mark.parametrize("usage", [None, {}, {"promptTokens": 12, "completionTokens": 34}])
+def test_done_matches_json_dumps(usage):
+    encoder = app.SSEChunkEncoder("gpt-4o", MESSAGE_ID, CREATED)
+    assert encoder.done(usage) == legacy_done("gpt-4o", usage)
+
+
+def test_frames_are_valid_json():
+    encoder = app.SSEChunkEncoder("gpt-4o", MESSAGE_ID, CREATED)
+    for delta in DELTAS:
+        frame = encoder.content(delta)
+        assert frame.startswith(b"data: ") and frame.endswith(b"\n\n")
+        assert json.loads(frame[len(b"data: "):])["choices"][0]["delta"]["content"] == delta
+
+
+def test_created_defaults_to_current_time():
+    encoder = app.SSEChunkEncoder("gpt-4o", MESSAGE_ID)
+    assert abs(encoder.created - int(app.time.time())) <= 1
+    assert json.loads(encoder.content("x")[len(b"data: "):])["created"] == encoder.created
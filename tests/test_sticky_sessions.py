@@ -0,0 +1,154 @@
+import asyncio
+import collections
+
+import pytest
+
+import app
+from conftest import chat_request, upstream_chunks
+
+
+def user(content):
+    return {"role": "user", "content": content}
+
+
+def assistant(content):
+    return {"role": "assistant", "content": content}
+
+
+def plan(messages, headers=None, system_prompt=""):
+    return app.plan_sticky_turn(headers or {}, messages, "gpt-4o", system_prompt)
+
+
+@pytest.fixture
+def archived(monkeypatch):
+    monkeypatch.setattr(app, "ARCHIVE_PENDING", {})
+    monkeypatch.setattr(app, "ARCHIVE_OVERFLOW", collections.deque())
+    return app.ARCHIVE_PENDING
+
+
+@pytest.fixture
+def account():
+    return app.UpstreamAccount(0, "test@example.com", "x")
+
+
+def test_first_turn_has_nothing_to_reuse():
+    turn = plan([{"role": "system", "content": "be brief"}, user("hello")])
+    assert turn.lookup_key is None
+    assert turn.delta_prompt == "Human: hello\n\nAssistant:"
+
+
+def test_turn_ending_with_assistant_has_nothing_to_send():
+    assert plan([user("hello"), assistant("hi")]).lookup_key is None
+
+
+def test_store_key_chains_to_next_turn_lookup():
+    first = plan([user("hello")])
+    key, digest = first.store_key("Hi there")
+    second = plan([user("hello"), assistant("  Hi there "), user("how are you?"), user("and today?")])
+    assert (second.lookup_key, second.prefix_digest) == (key, digest)
+    # 增量只包含最后一条 assistant 消息之后的用户消息
+    assert second.delta_prompt == "Human: how are you?\n\nHuman: and today?\n\nAssistant:"
+
+    third = plan([user("hello"), assistant("Hi there"), user("how are you?"), user("and today?"), assistant("Fine"), user("bye")])
+    assert third.lookup_key == second.store_key("Fine")[0]
+    assert third.delta_prompt == "Human: bye\n\nAssistant:"
+
+
+def test_digest_depends_on_history_model_and_system_prompt():
+    key, _ = plan([user("hello")]).store_key("Hi")
+    assert plan([user("hello"), assistant("Hello"), user("x")]).lookup_key != key
+    assert plan([user("hi"), assistant("Hi"), user("x")]).lookup_key != key
+    assert plan([user("hello"), assistant("Hi"), user("x")], system_prompt="other").lookup_key != key
+    assert app.plan_sticky_turn({}, [user("hello"), assistant("Hi"), user("x")], "o3", "").lookup_key != key
+
+
+def test_conversation_id_keys_by_header():
+    headers = {"X-Conversation-Id": "conv-1"}
+    first = plan([user("hello")], headers)
+    key, digest = first.store_key("Hi")
+    assert key == "conversation:conv-1"
+    second = plan([user("hello"), assistant("Hi"), user("more")], headers)
+    assert (second.lookup_key, second.prefix_digest) == (key, digest)
+
+
+def test_store_checkout_takes_the_session_out(clock, archived, account):
+    store = app.StickySessionStore(10, 60.0)
+    assert store.checkout("k", "d") is None
+    store.checkin("k", account, "chat-1", "d")
+    assert store.checkout("k", "d") == (account, "chat-1")
+    assert store.checkout("k", "d") is None # 使用期间不能被第二个请求取出
+    assert store.stats["hits"] == 1 and store.stats["misses"] == 2
+    assert not archived
+
+
+def test_store_digest_mismatch_archives_session(clock, archived, account):
+    store = app.StickySessionStore(10, 60.0)
+    store.checkin("conversation:c", account, "chat-1", "old")
+    assert store.checkout("conversation:c", "new") is None
+    assert store.stats["mismatched"] == 1
+    assert list(archived) == ["chat-1"]
+
+
+def test_store_ttl_expiry(clock, archived, account):
+    store = app.StickySessionStore(10, 60.0)
+    store.checkin("a", account, "chat-a", "d")
+    clock.advance(30)
+    store.checkin("b", account, "chat-b", "d")
+    clock.advance(30)
+    assert store.checkout("a", "d") is None
+    assert store.stats["expired"] == 1
+    assert list(archived) == ["chat-a"]
+    assert store.checkout("b", "d") == (account, "chat-b")
+
+
+def test_store_evicts_least_recently_used(clock, archived, account):
+    store = app.StickySessionStore(2, 60.0)
+    for key in "abc":
+        store.checkin(key, account, f"chat-{key}", "d")
+    assert list(store.entries) == ["b", "c"]
+    assert list(archived) == ["chat-a"]
+    assert store.stats["evicted"] == 1
+
+
+@pytest.fixture
+def sticky(upstream, monkeypatch):
+    store = app.StickySessionStore(10, 60.0)
+    monkeypatch.setattr(app, "STICKY_SESSIONS_ENABLED", True)
+    monkeypatch.setattr(app, "STICKY_SESSIONS", store)
+    upstream.script = lambda payload: upstream_chunks(f"reply {len(upstream.payloads)}")
+    return store
+
+
+def prompts(upstream):
+    return [(payload["chatId"], payload["message"]["content"]) for payload in upstream.payloads]
+
+
+def test_follow_up_turn_sends_only_the_delta(upstream, sticky):
+    async def scenario():
+        await chat_request({"model": "gpt-4o", "messages": [user("hello")]})
+        await chat_request({"model": "gpt-4o", "messages": [user("hello"), assistant("reply 1"), user("next")]})
+        await chat_request({"model": "gpt-4o", "stream": True, "messages": [user("hello"), assistant("reply 1"), user("next"), assistant("reply 2"), user("last")]})
+
+    asyncio.run(scenario())
+    assert prompts(upstream) == [
+        ("chat-1", "Human: hello\n\nAssistant:"),
+        ("chat-1", "Human: next\n\nAssistant:"),
+        ("chat-1", "Human: last\n\nAssistant:"),
+    ]
+    assert sticky.stats["hits"] == 2
+    assert not upstream.account.inflight
+    assert "chat-1" not in app.ARCHIVE_PENDING
+
+
+def test_edited_history_starts_a_new_chat(upstream, sticky):
+    async def scenario():
+        await chat_request({"model": "gpt-4o", "messages": [user("hello")]})
+        await chat_request({"model": "gpt-4o", "messages": [user("hello"), assistant("something else"), user("next")]})
+
+    asyncio.run(scenario())
+    assert prompts(upstream) == [
+        ("chat-1", "Human: hello\n\nAssistant:"),
+        ("chat-2", "Human: hello\n\nAssistant: something else\n\nHuman: next\n\nAssistant:"),
+    ]
+    assert sticky.stats["misses"] == 1
+    assert len(sticky.entries) == 2 # 原来的会话仍按原来的键保留，直到过期
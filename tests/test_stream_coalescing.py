@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+import pytest
+
+import app
+from conftest import chat_request, upstream_chunks
+
+BODY = {"model": "gpt-4o", "stream": True, "messages": [{"role": "user", "content": "hi"}]}
+
+
+@pytest.fixture(autouse=True)
+def coalescing(monkeypatch):
+    monkeypatch.setattr(app, "SSE_COALESCE_ENABLED", False)
+    monkeypatch.setattr(app, "SSE_COALESCE_MAX_DELAY", 0.05)
+    monkeypatch.setattr(app, "SSE_COALESCE_MAX_CHARS", 2048)
+
+
+def deltas(chunks):
+    """每个 data 帧的 (收到的时间, 类型, 文本)，结束帧与注释帧除外。"""
+    frames = []
+    for received_at, data in chunks:
+        if not data.startswith(b"data: "):
+            continue
+        delta = json.loads(data[len(b"data: "):])["choices"][0]["delta"]
+        for kind in ("content", "reasoning_content"):
+            if kind in delta:
+                frames.append((received_at, kind, delta[kind]))
+    return frames
+
+
+def stream(headers=None):
+    return asyncio.run(chat_request(BODY, headers))
+
+
+def test_disabled_sends_one_frame_per_token(upstream):
+    upstream.script = lambda payload: upstream_chunks("a", "b", "c", reasoning=["r1", "r2"])
+    status, _, chunks = stream()
+    assert status == 200
+    assert [(kind, text) for _, kind, text in deltas(chunks)] == [
+        ("reasoning_content", "r1"), ("reasoning_content", "r2"), ("content", "a"), ("content", "b"), ("content", "c")]
+
+
+def test_header_enables_coalescing_per_request(upstream):
+    upstream.script = lambda payload: upstream_chunks("a", "b", "c")
+    _, _, chunks = stream({"X-Stream-Coalesce": "1"})
+    assert [text for _, _, text in deltas(chunks)] == ["a", "bc"]
+
+
+def test_header_disables_coalescing(upstream, monkeypatch):
+    monkeypatch.setattr(app, "SSE_COALESCE_ENABLED", True)
+    upstream.script = lambda payload: upstream_chunks("a", "b", "c")
+    _, _, chunks = stream({"X-Stream-Coalesce": "off"})
+    assert [text for _, _, text in deltas(chunks)] == ["a", "b", "c"]
+
+
+def test_flush_at_deadline_not_at_next_token(upstream):
+    def script(payload):
+        chunks = upstream_chunks("first", "a", "b", "c", "late")
+        return chunks[:1] + [(0.005, data) for _, data in chunks[1:4]] + [(0.3, chunks[4][1]), chunks[5]]
+
+    upstream.script = script
+    _, _, chunks = stream({"X-Stream-Coalesce": "1"})
+    frames = deltas(chunks)
+    assert [text for _, _, text in frames] == ["first", "abc", "late"]
+    first_at, merged_at, late_at = (received_at for received_at, _, _ in frames)
+    # 第一个 token 立即发出；随后的 token 最多等待 SSE_COALESCE_MAX_DELAY，而不是等到下一个 token 到达
+    assert 0.04 <= merged_at - first_at < 0.2
+    assert late_at - merged_at >= 0.15
+
+
+def test_kind_switch_flushes_pending_tokens(upstream, monkeypatch):
+    monkeypatch.setattr(app, "SSE_COALESCE_MAX_DELAY", 10.0)
+    upstream.script = lambda payload: upstream_chunks("c1", "c2", "c3", reasoning=["r1", "r2", "r3"])
+    _, _, chunks = stream({"X-Stream-Coalesce": "1"})
+    assert [(kind, text) for _, kind, text in deltas(chunks)] == [
+        ("reasoning_content", "r1"), ("reasoning_content", "r2r3"), ("content", "c1"), ("content", "c2c3")]
+
+
+def test_max_chars_flushes_early(upstream, monkeypatch):
+    monkeypatch.setattr(app, "SSE_COALESCE_MAX_DELAY", 10.0)
+    monkeypatch.setattr(app, "SSE_COALESCE_MAX_CHARS", 4)
+    upstream.script = lambda payload: upstream_chunks("x", "aa", "bb", "cc", "d")
+    _, _, chunks = stream({"X-Stream-Coalesce": "1"})
+    assert [text for _, _, text in deltas(chunks)] == ["x", "aabb", "ccd"]
+
+
+def test_coalesced_stream_has_the_same_text(upstream):
+    tokens = [f"t{i} " for i in range(50)]
+    upstream.script = lambda payload: upstream_chunks(*tokens)
+    _, _, plain = stream()
+    _, _, merged = stream({"X-Stream-Coalesce": "1"})
+    assert "".join(text for _, _, text in deltas(merged)) == "".join(text for _, _, text in deltas(plain)) == "".join(tokens)
+    assert len(deltas(merged)) < len(deltas(plain))
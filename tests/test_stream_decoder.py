@@ -0,0 +1,128 @@
+import glob
+import json
+import os
+import random
+
+import pytest
+from httpx._decoders import LineDecoder, TextDecoder
+
+import app
+
+TRANSCRIPTS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench", "transcripts", "*.txt")))
+
+
+# 参考实现: 与 bench/bench_stream_decoder.py 相同的旧路径 (aiter_lines() + 逐行 json.loads)
+def parse_upstream_line(line):
+    if line.startswith("0:"):
+        return "content", json.loads(line[2:])
+    if line.startswith("g:"):
+        return "reasoning", json.loads(line[2:])
+    if line.startswith("e:") or line.startswith("d:"):
+        json_data_str = line[2:]
+        usage = json.loads(json_data_str).get("usage") if json_data_str else None
+        return "finish", usage
+    return None
+
+
+def legacy_decode(chunks):
+    text_decoder, line_decoder, events = TextDecoder("utf-8"), LineDecoder(), []
+
+    def parse_lines(lines):
+        for line in lines:
+            try:
+                event = parse_upstream_line(line)
+            except Exception:
+                continue
+            if event is not None:
+                events.append(event)
+
+    for chunk in chunks:
+        parse_lines(line_decoder.decode(text_decoder.decode(chunk)))
+    parse_lines(line_decoder.decode(text_decoder.flush()))
+    parse_lines(line_decoder.flush())
+    return events
+
+
+def decode(chunks):
+    decoder, events = app.UpstreamStreamDecoder(), []
+    for chunk in chunks:
+        events.extend(decoder.feed(chunk))
+    events.extend(decoder.flush())
+    return events
+
+
+def random_chunks(data, rng, max_size=64):
+    chunks, position = [], 0
+    while position < len(data):
+        size = rng.choice((1, 2, 3, rng.randint(1, max_size), rng.randint(1, 4096)))
+        chunks.append(data[position:position + size])
+        position += size
+    return chunks
+
+
+def corrupt(data, rng):
+    data = bytearray(data)
+    for _ in range(rng.randint(1, 8)):
+        position = rng.randrange(len(data))
+        data[position] = rng.choice((rng.randrange(256), ord("\n"), ord('"'), ord("\\"), 0xE4))
+    return bytes(data)
+
+
+@pytest.fixture(autouse=True)
+def quiet_logger(monkeypatch):
+    monkeypatch.setattr(app.app.logger, "disabled", True) # 破坏后的数据会产生大量解析警告
+
+
+@pytest.mark.parametrize("path", TRANSCRIPTS, ids=os.path.basename)
+def test_random_chunking_matches_reference(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    expected = legacy_decode([data])
+    assert expected
+    rng = random.Random(path)
+    for _ in range(300):
+        chunks = random_chunks(data, rng)
+        assert decode(chunks) == expected, [len(chunk) for chunk in chunks][:20]
+
+
+@pytest.mark.parametrize("path", TRANSCRIPTS, ids=os.path.basename)
+def test_corrupted_input_is_independent_of_chunking(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    rng = random.Random(path)
+    for _ in range(100):
+        damaged = corrupt(data, rng)
+        assert decode(random_chunks(damaged, rng)) == decode([damaged])
+
+
+def test_multibyte_character_split_across_chunks():
+    data = '0:"你好，世界"\n'.encode("utf-8")
+    split = data.index("好".encode("utf-8")) + 1
+    decoder = app.UpstreamStreamDecoder()
+    assert decoder.feed(data[:split]) == []
+    assert decoder.feed(data[split:]) == [("content", "你好，世界")]
+
+
+def test_escapes_and_line_types():
+    data = b'g:"think"\n0:"a\\nb \\"q\\" \\u00e9"\n2:[{"ignored":true}]\nd:{"finishReason":"stop","usage":{"promptTokens":3}}\n'
+    assert decode([data]) == [("reasoning", "think"), ("content", 'a\nb "q" \u00e9'), ("finish", {"promptTokens": 3})]
+
+
+def test_crlf_line_endings():
+    assert decode([b'0:"a"\r\n0:"b"\r\ne:{}\r\n']) == [("content", "a"), ("content", "b"), ("finish", None)]
+
+
+def test_last_line_without_newline_is_flushed():
+    decoder = app.UpstreamStreamDecoder()
+    assert decoder.feed(b'0:"a"\n0:"tail"') == [("content", "a")]
+    assert decoder.flush() == [("content", "tail")]
+    assert decoder.flush() == []
+
+
+def test_malformed_lines_are_counted_and_skipped(monkeypatch):
+    monkeypatch.setitem(app.STREAM_STATS, "upstream_decode_errors", 0)
+    decoder = app.UpstreamStreamDecoder()
+    events = decoder.feed(b'0:"unterminated\n0:{bad json\n0:"ok"\n')
+    assert events == [("content", "ok")]
+    assert decoder.errors == 2
+    assert app.STREAM_STATS["upstream_decode_errors"] == 2